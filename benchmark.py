@@ -0,0 +1,404 @@
+"""
+Performance benchmarks of the assembler and the simulator.
+
+    python benchmark.py                          # run all the benchmarks
+    python benchmark.py --save baseline.json     # ... and record the results
+    python benchmark.py --compare baseline.json  # ... and compare them with the recorded ones
+
+Each benchmark is run several times and its best time is kept. When comparing, a benchmark
+slower than the baseline by more than the threshold is reported as a regression, and the exit
+status is 1.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from epater.assembler import parse as ASMparser
+from epater.bytecodeinterpreter import BCInterpreter
+from epater.simulator import decodedInstrCache
+
+
+ALU_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    MOV R0, #0
+    MOV R1, #1
+boucle
+    ADD R2, R0, R1
+    EOR R3, R2, R1, LSL #3
+    ORR R4, R3, R0, LSR #2
+    BIC R5, R4, #0xF0
+    ADDS R6, R6, R5
+    ADC R7, R7, #0
+    MUL R8, R2, R3
+    RSB R9, R8, R4, ROR #5
+    ADD R0, R0, #1
+    CMP R0, #1024
+    BNE boucle
+    B main
+SECTION DATA
+"""
+
+MEMORY_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R0, =tab
+    MOV R1, #0
+boucle
+    LDR R2, [R0, R1, LSL #2]
+    ADD R2, R2, R1
+    STR R2, [R0, R1, LSL #2]
+    LDRB R3, [R0, R1]
+    STRB R3, [R0, R1, LSL #1]
+    LDRH R4, [R0]
+    STRH R4, [R0, #2]
+    ADD R1, R1, #1
+    CMP R1, #64
+    BNE boucle
+    B main
+SECTION DATA
+tab ALLOC32 64
+"""
+
+# Same algorithm as samples/eratosthenes.asm
+SIEVE_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R10, =nombres
+    MOV R11, #256
+    ADD R12, R10, R11
+    MOV R0, #0
+boucleInit
+    STRB R0, [R10], #1
+    ADD R0, R0, #1
+    CMP R10, R12
+    BNE boucleInit
+    MOV R5, #2
+bouclePrincipale
+    LDR R10, =nombres
+boucleRecherche
+    CMP R5, R11, LSR #1
+    BGE main
+    LDRB R1, [R10, R5]
+    CMP R1, #0
+    ADDEQ R5, R5, #1
+    BEQ boucleRecherche
+    ADD R10, R10, R5
+    MOV R1, #0
+boucleMiseAZero
+    ADD R10, R10, R5
+    CMP R10, R12
+    BGE finBoucleMiseAZero
+    STRB R1, [R10]
+    B boucleMiseAZero
+finBoucleMiseAZero
+    ADD R5, R5, #1
+    B bouclePrincipale
+SECTION DATA
+nombres ALLOC8 256
+"""
+
+BUBBLESORT_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R0, =tab
+    MOV R1, #32
+init
+    SUBS R1, R1, #1
+    STR R1, [R0], #4
+    BNE init
+    MOV R1, #31
+passe
+    LDR R0, =tab
+    MOV R2, R1
+comparaison
+    LDR R3, [R0]
+    LDR R4, [R0, #4]
+    CMP R3, R4
+    STRGT R4, [R0]
+    STRGT R3, [R0, #4]
+    ADD R0, R0, #4
+    SUBS R2, R2, #1
+    BNE comparaison
+    SUBS R1, R1, #1
+    BNE passe
+    B main
+SECTION DATA
+tab ALLOC32 32
+"""
+
+MEMCPY_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R0, =source
+    LDR R1, =destination
+    ADD R2, R0, #256
+boucle
+    LDMIA R0!, {R3-R10}
+    STMIA R1!, {R3-R10}
+    CMP R0, R2
+    BNE boucle
+    B main
+SECTION DATA
+source ALLOC32 64
+destination ALLOC32 64
+"""
+
+FIBONACCI_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR SP, =pile
+    ADD SP, SP, #1024
+    MOV R0, #12
+    BL fib
+    B main
+fib
+    CMP R0, #2
+    MOVLT PC, LR
+    PUSH {R4, R5, LR}
+    MOV R4, R0
+    SUB R0, R4, #1
+    BL fib
+    MOV R5, R0
+    SUB R0, R4, #2
+    BL fib
+    ADD R0, R0, R5
+    POP {R4, R5, PC}
+SECTION DATA
+pile ALLOC32 256
+"""
+
+INTERRUPT_CODE = """SECTION INTVEC
+B main
+B main
+B main
+B main
+B main
+B main
+B irq
+B main
+SECTION CODE
+main
+    ADD R0, R0, #1
+    B main
+irq
+    SUB LR, LR, #4
+    ADD R11, R11, #1
+    MOVS PC, LR
+SECTION DATA
+"""
+
+
+def generateProgram(nlines):
+    """
+    Return a program of about `nlines` lines, mixing the most common instructions, as a list of lines.
+    """
+    body = ("ADD R0, R0, #1", "SUBS R1, R1, R2, LSL #2", "LDR R3, [R4, #8]", "STR R3, [R4, R5]",
+            "MOVEQ R6, R7", "CMP R0, #255", "BNE main", "PUSH {R0-R3, LR}", "POP {R0-R3, LR}", "MUL R5, R6, R7")
+    lines = ["SECTION INTVEC", "B main", "SECTION CODE", "main"]
+    i = 0
+    while len(lines) < nlines - 3:
+        if i % 50 == 0:
+            lines.append("etiquette{}".format(i))
+        lines.append("    " + body[i % len(body)])
+        i += 1
+    lines.extend(("fin B fin", "SECTION DATA", "tab ALLOC32 16"))
+    return lines
+
+
+def assemble(code):
+    lines = code.splitlines() if isinstance(code, str) else code
+    bytecode, addr2line, line2addr, assertions, snippetMode, errors = ASMparser(lines)
+    if errors:
+        raise ValueError("Erreur d'assemblage : {}".format(errors))
+    return bytecode, addr2line, assertions, snippetMode
+
+
+def buildInterpreter(code):
+    bytecode, addr2line, assertions, snippetMode = assemble(code)
+    return BCInterpreter(bytecode, addr2line, assertions, snippetMode=snippetMode)
+
+
+# Each benchmark takes the size of the workload and returns (elapsed time in seconds, number of operations done)
+
+def benchAssembler(nlines):
+    def bench(scale):
+        lines = generateProgram(nlines)
+        start = time.perf_counter()
+        assemble(lines)
+        return time.perf_counter() - start, len(lines)
+    return bench
+
+
+def benchDecode(warm):
+    # The CODE section ends where the DATA section starts (0x1000), so the program must be smaller
+    # than the ones used for the assembler
+    def bench(scale):
+        assembled = assemble(generateProgram(900))
+        if warm:
+            BCInterpreter(*assembled[:3], snippetMode=assembled[3])
+        else:
+            decodedInstrCache.clear()
+        start = time.perf_counter()
+        BCInterpreter(*assembled[:3], snippetMode=assembled[3])
+        return time.perf_counter() - start, len(assembled[1])
+    return bench
+
+
+def benchKernel(code, interrupt=False):
+    def bench(scale):
+        interpreter = buildInterpreter(code)
+        interpreter.sim.maxit = scale * 20000
+        if interrupt:
+            interpreter.setInterrupt("IRQ", False, 10, 20)
+        start = time.perf_counter()
+        interpreter.execute('run')
+        elapsed = time.perf_counter() - start
+        if interpreter.errorsPending is not None:
+            raise RuntimeError("Erreur d'exécution : {}".format(interpreter.getErrors()))
+        return elapsed, interpreter.getInstructionCount()
+    return bench
+
+
+def benchStep(scale):
+    interpreter = buildInterpreter(BUBBLESORT_CODE)
+    count = scale * 500
+    start = time.perf_counter()
+    for i in range(count):
+        interpreter.execute('into')
+    return time.perf_counter() - start, count
+
+
+def benchStepBack(scale):
+    interpreter = buildInterpreter(BUBBLESORT_CODE)
+    # The history only keeps the last maxlen steps: go forward and back by rounds of this length
+    roundLength = interpreter.sim.history.maxlen - 1
+    count = scale * 500
+    elapsed = 0
+    for done in range(0, count, roundLength):
+        steps = min(roundLength, count - done)
+        startCycles = interpreter.getCycleCount()
+        for i in range(steps):
+            interpreter.execute('into')
+        start = time.perf_counter()
+        for i in range(steps):
+            interpreter.stepBack()
+        elapsed += time.perf_counter() - start
+        if interpreter.errorsPending is not None or interpreter.getCycleCount() != startCycles:
+            raise RuntimeError("Retour en arrière incomplet : {} cycles au lieu de {} ({})".format(
+                               interpreter.getCycleCount(), startCycles, interpreter.getErrors()))
+    return elapsed, count
+
+
+def benchChanges(scale):
+    # As the web interface does after each step
+    interpreter = buildInterpreter(BUBBLESORT_CODE)
+    count = scale * 500
+    elapsed = 0
+    for i in range(count):
+        interpreter.execute('into')
+        start = time.perf_counter()
+        interpreter.getChangesFormatted(setCheckpoint=True)
+        elapsed += time.perf_counter() - start
+    return elapsed, count
+
+
+# Name, unit of the operations counted and function of each benchmark
+benchmarks = [
+    ("assembler_1k", "line", benchAssembler(1000)),
+    ("assembler_10k", "line", benchAssembler(10000)),
+    ("decode_cold", "instr", benchDecode(warm=False)),
+    ("decode_warm", "instr", benchDecode(warm=True)),
+    ("kernel_alu", "instr", benchKernel(ALU_CODE)),
+    ("kernel_memory", "instr", benchKernel(MEMORY_CODE)),
+    ("kernel_ldmstm", "instr", benchKernel(MEMCPY_CODE)),
+    ("kernel_sieve", "instr", benchKernel(SIEVE_CODE)),
+    ("kernel_bubblesort", "instr", benchKernel(BUBBLESORT_CODE)),
+    ("kernel_fibonacci", "instr", benchKernel(FIBONACCI_CODE)),
+    ("kernel_interrupts", "instr", benchKernel(INTERRUPT_CODE, interrupt=True)),
+    ("step", "step", benchStep),
+    ("stepback", "step", benchStepBack),
+    ("changes", "call", benchChanges),
+]
+
+
+def runBenchmarks(names=None, repeat=3, scale=1, out=sys.stdout):
+    """
+    Run the benchmarks (all of them, or those whose name contains one of `names`) and return a
+    dictionary associating the name of each benchmark to its results.
+    """
+    results = {}
+    for name, unit, bench in benchmarks:
+        if names and not any(n in name for n in names):
+            continue
+        best, count = min(bench(scale) for i in range(repeat))
+        results[name] = {"seconds": best, "count": count, "unit": unit}
+        out.write("{:20s} {:10.2f} ms {:12.0f} {}/s\n".format(name, best * 1000, count / max(best, 1e-9), unit))
+        out.flush()
+    return results
+
+
+def compareResults(results, baseline, threshold, out=sys.stdout):
+    """
+    Print the results next to the baseline ones, and return the names of the benchmarks slower than
+    the baseline by more than `threshold` (e.g. 0.1 for 10%). The times are compared per operation,
+    so that runs with different scales can be compared.
+    """
+    regressions = []
+    out.write("\n{:20s} {:>13s} {:>13s} {:>9s}\n".format("benchmark", "baseline", "current", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            out.write("{:20s} {:>13s} {:10.2f} ms\n".format(name, "-", result["seconds"] * 1000))
+            continue
+        reference = baseline[name]
+        # Time per operation of the baseline, scaled to the number of operations done now
+        expected = reference["seconds"] / reference["count"] * result["count"]
+        change = result["seconds"] / expected - 1
+        status = ""
+        if change > threshold:
+            status = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            status = "  faster"
+        out.write("{:20s} {:10.2f} ms {:10.2f} ms {:+8.1f}%{}\n".format(name, expected * 1000, result["seconds"] * 1000,
+                                                                         change * 100, status))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EPATER, benchmarks of the assembler and the simulator')
+    parser.add_argument('names', nargs='*', help="Tests à lancer (tous par défaut), par exemple kernel ou step")
+    parser.add_argument('--repeat', type=int, default=3, help="Nombre d'exécutions de chaque test (le meilleur temps est conservé)")
+    parser.add_argument('--scale', type=int, default=1, help="Facteur multipliant la taille des tests de simulation")
+    parser.add_argument('--save', metavar='FICHIER', help="Enregistrer les résultats dans ce fichier JSON")
+    parser.add_argument('--compare', metavar='FICHIER', help="Comparer les résultats à ceux de ce fichier JSON")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Ralentissement au-delà duquel un test est en régression (0.1 pour 10%%)")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.names, args.repeat, args.scale)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline["results"], args.threshold)
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "results": results}, f, indent=2)
+
+    sys.exit(1 if regressions else 0)
@@ -7,6 +7,7 @@ from ply.lex import LexError
 from .tokenizer import ParserError, lexer
 from . import yaccparser
 from .settings import getSetting
+from .assertions import compileAssertion, AssertionSyntaxError
 from .i18n import I18n as _
 
 memory_configs = {
@@ -162,6 +163,12 @@ def parse(code, memLayout="simulation"):
             addrToLine[max(currentAddr, 0)].append(i)
 
         if "ASSERTION" in parsedLine:
+            try:
+                # The assertion is compiled again by the simulator, here we only check its syntax
+                compileAssertion(None, i, parsedLine["ASSERTION"])
+            except AssertionSyntaxError as e:
+                listErrors.append(("codeerror", i, e.text))
+                continue
             if lastLineType is None or lastLineType in ("LABEL", "SECTION"):
                 assertions[currentAddr].append(("BEFORE", i, parsedLine["ASSERTION"]))
             elif lastLineType == "BYTECODE":
@@ -0,0 +1,180 @@
+import struct
+from collections import namedtuple
+
+
+class AssertionSyntaxError(Exception):
+    """
+    Raised when an assertion cannot be interpreted.
+    """
+    def __init__(self, text):
+        super().__init__(text)
+        self.text = text
+
+
+# An assertion, as stored by the simulator. `mode` is either "BEFORE" or "AFTER", `line` is the
+# line number of the assertion in the source code, `text` its original content (e.g. "R0=5, Z=1")
+# and `checks` a tuple of check objects (see below)
+CompiledAssertion = namedtuple("CompiledAssertion", "mode line text checks")
+
+regAliases = {'SP': 'R13', 'LR': 'R14', 'PC': 'R15'}
+
+
+class _RegisterCheck:
+    """
+    Check the value of a register, against a constant or another register.
+    """
+    __slots__ = ("target", "reg", "val", "regtarget")
+
+    def __init__(self, target, reg, val, regtarget):
+        self.target = target
+        self.reg = reg
+        self.val = val
+        self.regtarget = regtarget
+
+    def check(self, regs, mem):
+        # We directly read the register values, so that no breakpoint is triggered
+        bank = regs.banks[regs.currentMode]
+        valreg = bank[self.reg].val
+        if self.regtarget is None:
+            if valreg != self.val:
+                return "Erreur : {} devrait valoir {}, mais il vaut {}\n".format(self.target, self.val, valreg)
+        else:
+            val = bank[self.regtarget].val
+            if valreg != val:
+                return "Erreur : {} devrait valoir {} (la valeur du registre R{}), mais il vaut {}\n"\
+                    .format(self.target, val, self.regtarget, valreg)
+        return ""
+
+
+class _MemoryCheck:
+    """
+    Check the content of a memory address, against a constant or a register. A single byte is
+    checked if the expected value fits in it, a word otherwise.
+    """
+    __slots__ = ("target", "addr", "val", "regtarget")
+
+    def __init__(self, target, addr, val, regtarget):
+        self.target = target
+        self.addr = addr
+        self.val = val
+        self.regtarget = regtarget
+
+    def check(self, regs, mem):
+        if self.regtarget is None:
+            val = self.val
+        else:
+            val = regs.banks[regs.currentMode][self.regtarget].val
+        size, formatStruct = (1, "<B") if 0 <= val < 255 else (4, "<I")
+        # May raise a ComponentException if the address is invalid
+        valmem = struct.unpack(formatStruct, mem.get(self.addr, mayTriggerBkpt=False, size=size))[0]
+        if valmem != val:
+            if self.regtarget is None:
+                return "Erreur : l'adresse mémoire {} devrait contenir {}, mais elle contient {}\n"\
+                    .format(self.target, val, valmem)
+            return "Erreur : l'adresse mémoire {} devrait contenir {} (la valeur du registre R{}), mais elle contient {}\n"\
+                .format(self.target, val, self.regtarget, valmem)
+        return ""
+
+
+class _FlagCheck:
+    """
+    Check the state of a flag (N, Z, C or V).
+    """
+    __slots__ = ("target", "mask", "expectedVal")
+
+    def __init__(self, target, mask, expectedVal):
+        self.target = target
+        self.mask = mask
+        self.expectedVal = expectedVal
+
+    def check(self, regs, mem):
+        actualVal = bool(regs.regCPSR & self.mask)
+        if actualVal != self.expectedVal:
+            return "Erreur : le drapeau {} devrait signaler {}, mais il signale {}\n"\
+                .format(self.target, self.expectedVal, actualVal)
+        return ""
+
+
+class _InvalidCheck:
+    """
+    Placeholder for an assertion which could not be compiled, the error is reported each
+    time the assertion is checked.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def check(self, regs, mem):
+        return self.text
+
+
+def _compileCheck(info):
+    target, value = info.upper().split("=")
+    target, value = target.strip(), value.strip()
+    # The rest of the code assume that a register is encoded as R**, so we convert the alternative names
+    target = regAliases.get(target, target)
+    value = regAliases.get(value, value)
+
+    if value[0] == "R":
+        # The target is another register
+        regtarget, val = int(value[1:]), None
+    else:
+        # The target is a constant
+        regtarget = None
+        try:
+            val = int(value, base=0) & 0xFFFFFFFF
+        except ValueError:
+            # If this is a decimal with leading zeros, base=0 will crash
+            val = int(value, base=10) & 0xFFFFFFFF
+
+    if target[0] == "R":
+        return _RegisterCheck(target, int(target[1:]), val, regtarget)
+    elif target[:2] == "0X":
+        return _MemoryCheck(target, int(target, base=16), val, regtarget)
+    elif target in ("N", "Z", "C", "V"):
+        if value not in ("0", "1"):
+            raise AssertionSyntaxError("Assertion invalide : le drapeau {} ne peut valoir que 0 ou 1 (et non {})".format(target, value))
+        return _FlagCheck(target, 1 << {'N': 31, 'Z': 30, 'C': 29, 'V': 28}[target], value == "1")
+    raise AssertionSyntaxError("Assertion inconnue ou impossible à interpréter : ({}, {})!".format(target, value))
+
+
+def compileAssertion(mode, line, text):
+    """
+    Compile an assertion, as produced by the assembler, into a CompiledAssertion.
+    Raise an AssertionSyntaxError if the assertion is invalid.
+
+    :param mode: "BEFORE" or "AFTER"
+    :param line: line number of the assertion
+    :param text: content of the assertion (e.g. "R0=5, 0x1000=3, Z=1")
+    """
+    checks = []
+    for info in text.split(","):
+        info = info.strip()
+        if "=" not in info:
+            # Empty field (e.g. trailing comma), we skip
+            continue
+        try:
+            checks.append(_compileCheck(info))
+        except ValueError:
+            raise AssertionSyntaxError("Assertion inconnue ou impossible à interpréter : {}".format(info))
+    return CompiledAssertion(mode, line, text, tuple(checks))
+
+
+def compileAssertionOrDefer(mode, line, text):
+    """
+    Same as compileAssertion, except that an invalid assertion does not raise an exception, but
+    reports its error each time it is checked.
+    """
+    try:
+        return compileAssertion(mode, line, text)
+    except AssertionSyntaxError as err:
+        return CompiledAssertion(mode, line, text, (_InvalidCheck(err.text),))
+
+
+def checkAssertion(assertion, regs, mem):
+    """
+    Check a compiled assertion against the current state of the registers and the memory.
+    Return a string containing the errors (empty if the assertion holds).
+    """
+    return "".join(check.check(regs, mem) for check in assertion.checks)
@@ -1,10 +1,18 @@
 from struct import unpack
+import copy
 import operator
 
 from .settings import getSetting
 from .simulator import Simulator
 from .simulator import MultipleErrors
+from .simulator import decodedInstrCache
+from .simulator import InterruptSource
 from .components import Breakpoint, ComponentException
+from .devices import deviceTypes, defaultAddresses
+from .profiler import Profiler
+from .coverage import Coverage
+from .cache import Cache
+from .trace import TraceRecorder, exportJSONLines, exportChromeTrace
 
 
 class BCInterpreter:
@@ -33,15 +41,52 @@ class BCInterpreter:
                 self.line2addr[line] = addr
         self.lineBreakpoints = []
         self.sim = Simulator(bytecode, self.assertInfo, self.addr2line, pcInitAddr)
+        # Interrupt source set by setInterrupt
+        self.interruptSource = None
+        # Profiler set by setProfiling
+        self.profiler = None
+        # Coverage set by setCoverage
+        self.coverage = None
+        # Trace recorder set by startTrace
+        self.tracer = None
         self.reset()
         self.errorsPending = None
         self.snippetMode = snippetMode
 
-    def reset(self):
+    def reset(self, resetMemory=False):
         """
         Reset the state of the simulator (as an ARM reset exception). Memory content is preserved.
-        """
-        self.sim.reset()
+
+        :param resetMemory: if True, the memory is also restored to its content when the program
+                            was loaded, so the program can be run again without reassembling it.
+        """
+        self.sim.reset(resetMemory)
+
+    def clone(self):
+        """
+        Return an independent interpreter in the same state, without assembling and decoding the program
+        again (see Simulator.clone). Useful to run the same program with different inputs, e.g. by
+        changing some registers or memory values in each copy.
+        """
+        interpreter = copy.copy(self)
+        interpreter.sim = self.sim.clone()
+        interpreter.lineBreakpoints = list(self.lineBreakpoints)
+        interpreter.errorsPending = None
+        if self.interruptSource is not None:
+            # The interrupt sources are copied in the same order
+            sources = [event for event in self.sim.scheduler.events if isinstance(event, InterruptSource)]
+            sourcesCopy = [event for event in interpreter.sim.scheduler.events if isinstance(event, InterruptSource)]
+            interpreter.interruptSource = sourcesCopy[sources.index(self.interruptSource)]
+        if self.profiler is not None:
+            interpreter.profiler = self.profiler.clone(interpreter.sim)
+        if self.coverage is not None:
+            interpreter.coverage = self.coverage.clone(interpreter.sim)
+        if self.tracer is not None:
+            # The trace is not copied
+            for hook in self.tracer.hooks:
+                interpreter.sim.removeHook(hook)
+            interpreter.tracer = None
+        return interpreter
 
     def getBreakpointInstr(self, diff=False):
         """
@@ -79,6 +124,23 @@ class BCInterpreter:
                     nextLine += 1
                 if nextLine-1 not in self.lineBreakpoints:
                     self.lineBreakpoints.append(nextLine-1)
+        self._removeStaleConditions()
+
+    def setBreakpointInstrCondition(self, lineno, condition):
+        """
+        Set a conditional breakpoint on a line: the execution only stops there if the condition
+        holds (e.g. "R3 > 100"). The breakpoint is added if the line does not have one yet.
+
+        :param lineno: line number of the instruction
+        :param condition: text of the condition (see BreakpointCondition), or None to remove the
+                          condition (the breakpoint itself is kept)
+        """
+        if lineno not in self.line2addr:
+            raise ValueError("Aucune instruction à la ligne {}".format(lineno))
+        addr = self.line2addr[lineno]
+        self.sim.setBreakpointCondition("memory", addr, condition)
+        if not self.sim.mem.breakpoints.get(addr, 0) & 1:
+            self.setBreakpointInstr(self.lineBreakpoints + [lineno])
 
     def getBreakpointsMem(self):
         """
@@ -93,16 +155,19 @@ class BCInterpreter:
             'e': [k for k,v in self.sim.mem.breakpoints.items() if bool(v & 1)],
         }
 
-    def setBreakpointMem(self, addr, mode):
+    def setBreakpointMem(self, addr, mode, condition=None):
         """
         Add a memory breakpoint.
 
         :param addr: Address to set the breakpoint
         :param mode: breakpoint type. Either one of 'r' | 'w' | 'rw' | 'e' or an empty string. The empty string
         removes any breakpoint at this address
+        :param condition: if not None, the execution only stops if this condition holds (e.g. "value == 0",
+        where value is the value read or written)
         """
         # Mode = 'r' | 'w' | 'rw' | 'e' | '' (passing an empty string removes the breakpoint)
         modeOctal = 4*('r' in mode) + 2*('w' in mode) + 1*('e' in mode)
+        self.sim.setBreakpointCondition("memory", addr, condition if modeOctal else None)
         self.sim.mem.setBreakpoint(addr, modeOctal)
 
 
@@ -127,21 +192,48 @@ class BCInterpreter:
                     except ValueError:
                         # Not sure how we can reach this, but just in case, it is not a huge problem so we do not want to crash
                         pass
+        self._removeStaleConditions()
 
 
-    def setBreakpointRegister(self, bank, reg, mode):
+    def setBreakpointRegister(self, bank, reg, mode, condition=None):
         """
         Set a breakpoint on register access
 
         :param bank: bank of the register (can be either "user", "FIQ", "IRQ" or "SVC")
         :param reg: register on which to set the breakpoint, should be an integer between 0 and 15
         :param mode: breakpoint mode ('r', 'w', 'rw'). Passing an empty string removes the breakpoint.
+        :param condition: if not None, the execution only stops if this condition holds (e.g. "value > 100",
+        where value is the value read or written)
         """
         # Mode = 'r' | 'w' | 'rw' | '' (passing an empty string removes the breakpoint)
         modeOctal = 4*('r' in mode) + 2*('w' in mode)
         bank = "User" if bank == "user" else bank.upper()
+        self.sim.setBreakpointCondition("register", (bank, reg), condition if modeOctal else None)
         self.sim.regs.setBreakpointOnRegister(bank, reg, modeOctal)
 
+    def _removeStaleConditions(self):
+        # The conditions of the memory breakpoints which were removed
+        for cmp, info in list(self.sim.bkptConditions):
+            if cmp == "memory" and not self.sim.mem.breakpoints.get(info, 0):
+                self.sim.setBreakpointCondition(cmp, info, None)
+
+    def getBreakpointHits(self):
+        """
+        Return the number of times the execution stopped on each breakpoint, as a list of dictionaries
+        with the keys "type" ("memory", "register" or "flags"), "target" (address, (bank, register) or
+        flag), "line" (line of the instruction for an execution breakpoint, None otherwise), "condition"
+        (text of the condition, or None) and "hits".
+        """
+        ret = []
+        for (cmp, info), hits in sorted(self.sim.bkptHits.items(), key=str):
+            condition = self.sim.bkptConditions.get((cmp, info))
+            line = None
+            if cmp == "memory" and info < self.bc['__MEMINFOEND']['CODE'] and len(self.addr2line.get(info, ())) > 0:
+                line = self.addr2line[info][-1]
+            ret.append({"type": cmp, "target": info, "line": line,
+                        "condition": None if condition is None else condition.text, "hits": hits})
+        return ret
+
     def setBreakpointFlag(self, flag, mode):
         """
         Set a breakpoint on flag access
@@ -166,14 +258,84 @@ class BCInterpreter:
                                 If it is > 0, then it will be at t = ncyclesbefore + begincountat
                                 If < 0, then the begin cycle is set at the current cycle
         """
-        self.sim.interruptActive = not clearinterrupt
-        self.sim.interruptParams['b'] = ncyclesbefore
-        self.sim.interruptParams['a'] = ncyclesperiod
-        self.sim.interruptParams['t0'] = begincountat if begincountat >= 0 else self.sim.sysHandle.countCycles
-        self.sim.interruptParams['type'] = type.upper()
-        self.sim.lastInterruptCycle = -1
+        if self.interruptSource is not None:
+            self.sim.removeEvent(self.interruptSource)
+            self.interruptSource = None
+        if not clearinterrupt:
+            t0 = begincountat if begincountat >= 0 else self.sim.history.cyclesCount
+            self.interruptSource = self.sim.addInterruptSource(type.upper(), t0 + ncyclesbefore + 1, ncyclesperiod)
+
+    def addInterruptSource(self, type, firstCycle, period=0):
+        """
+        Add an interrupt source, in addition to the one set by setInterrupt. Several sources
+        can be active at the same time; when a FIQ and an IRQ happen at the same cycle, the
+        FIQ is handled first.
+
+        :param type: either "FIQ" or "IRQ"
+        :param firstCycle: cycle at which the first interrupt happens
+        :param period: number of cycles between two interrupts (0 means only one interrupt)
+        :return: an object identifying the source, to pass to removeInterruptSource
+        """
+        return self.sim.addInterruptSource(type.upper(), firstCycle, period)
+
+    def removeInterruptSource(self, source):
+        """
+        Remove an interrupt source added by addInterruptSource.
+        """
+        self.sim.removeEvent(source)
+
+    def addDevice(self, type, baseAddr=None):
+        """
+        Add a memory-mapped device to the simulator.
+
+        :param type: either "timer", "uart" or "gpio" (see devices.py)
+        :param baseAddr: address of the first register of the device (must be a multiple of 4096).
+                        If None, a default address is used (see devices.defaultAddresses).
+        :return: the device object
+        """
+        if baseAddr is None:
+            baseAddr = defaultAddresses[type]
+        device = deviceTypes[type](baseAddr)
+        self.sim.addDevice(type, device)
+        return device
+
+    def getDevice(self, type):
+        """
+        Return the device of the given type added with addDevice, or None.
+        """
+        return self.sim.devices.get(type)
+
+    def getNextEventCycle(self):
+        """
+        Return the cycle at which the next interrupt (or any other event depending on the
+        cycle count) happens, or None if there is no such event.
+        """
+        cycle = self.sim.nextEventCycle
+        return None if cycle == float("inf") else cycle
 
 
+    def setTranslation(self, enabled):
+        """
+        Enable or disable the translation of the hot loops into Python code. Once translated,
+        a loop runs several times faster, but its iterations are stepped back together, and
+        the instructions it executes are not reported by the execution statistics.
+        This only applies to the "run" mode.
+
+        :param enabled: boolean
+        """
+        self.sim.setTranslation(enabled)
+
+    def setChangesFromSnapshots(self, enabled):
+        """
+        Choose how getChangesFormatted computes the changes since the last checkpoint. If enabled,
+        the registers and the memory are compared with a snapshot taken at the checkpoint instead
+        of logging each write, which is faster for long runs. Only the values which actually
+        changed are then reported.
+
+        :param enabled: boolean
+        """
+        self.sim.history.useSnapshots(enabled)
+
     @property
     def shouldStop(self):
         """
@@ -261,6 +423,41 @@ class BCInterpreter:
             # We reach end of the history
             self.errorsPending = MultipleErrors(runErr.__class__(), runErr.args)
 
+    def findLastRegisterWrite(self, reg, bank=None):
+        """
+        Find the last instruction which modified a register, among the instructions kept in the history.
+
+        :param reg: the register number (0-15)
+        :param bank: the register bank ("User", "FIQ", "IRQ" or "SVC"), the current one by default
+        :return: None if the register was not modified, else a dictionary with the keys "stepsback" (number
+                 of steps back needed to return just before this instruction, see `stepBack`), "cycle" and
+                 "line" (the line of the instruction, or None if it is unknown)
+        """
+        return self._findLastWrite(self.sim.regs, (bank or self.sim.regs.mode, reg))
+
+    def findLastMemoryWrite(self, addr):
+        """
+        Find the last instruction which modified a memory byte, among the instructions kept in the history.
+
+        :param addr: the address of the byte
+        :return: see `findLastRegisterWrite`
+        """
+        return self._findLastWrite(self.sim.mem, addr)
+
+    def _findLastWrite(self, component, location):
+        history = self.sim.history
+        result = history.findLastChange(component, location)
+        if result is None:
+            return None
+        count, cycle = result
+        # The value of PC before this history entry gives the address of the instruction
+        pcChange = history.history[-count][self.sim.regs.__class__].get(("User", 15))
+        line = None
+        if pcChange is not None:
+            lines = self.addr2line.get(pcChange[0] - self.sim.pcoffset)
+            line = lines[-1] if lines else None
+        return {"stepsback": count, "cycle": cycle, "line": line}
+
     def getMemory(self, addr, returnHexaStr=True):
         """
         Get the value of an address in memory.
@@ -301,7 +498,7 @@ class BCInterpreter:
         """
         # if addr is not initialized, then do nothing
         # val is a bytearray of one element (1 byte)
-        if self.sim.mem._getRelativeAddr(addr, 1) is None:
+        if not self.sim.mem.isMapped(addr, 1):
             return
         self.sim.mem.set(addr, val[0], 1)
         # In case we modified the current instruction
@@ -394,10 +591,197 @@ class BCInterpreter:
 
     def getCycleCount(self):
         """
-        Return the current number of cycles (the number of instructions executed since the beginning of the simulation)
+        Return the current number of cycles (the number of instructions executed since the beginning of the simulation,
+        or the number of ARM7TDMI cycles if the timing model is enabled, see setCycleTiming)
         """
         return self.sim.history.cyclesCount
 
+    def getInstructionCount(self):
+        """
+        Return the number of instructions executed since the beginning of the simulation (the cycle count
+        without the additional cycles of the timing model and the caches)
+        """
+        return self.sim.history.instructionsCount
+
+    def setCycleTiming(self, enabled, sCycle=1, nCycle=1, iCycle=1):
+        """
+        Enable or disable the timing model: each instruction then counts for its number of cycles on an ARM7TDMI
+        (e.g. 3 for LDR, 2 + n for LDM with n registers), which also changes the timing of the interrupts.
+
+        :param sCycle, nCycle, iCycle: duration of a sequential, non-sequential and internal cycle
+        """
+        self.sim.setCycleTiming(enabled, sCycle, nCycle, iCycle)
+
+    def setProfiling(self, enabled, clear=False):
+        """
+        Enable or disable the profiling of the program (see getProfile). The profiling does not
+        slow down the simulation while it is disabled.
+
+        :param clear: if True, the counters are reset to 0
+        """
+        if self.profiler is None:
+            if not enabled:
+                return
+            self.profiler = Profiler(self.sim)
+        if clear:
+            self.profiler.clear()
+        if enabled:
+            self.profiler.attach()
+        else:
+            self.profiler.detach()
+
+    def getProfile(self, byLine=True):
+        """
+        Return the profiling counters, as a dictionary associating each source line (or each address if
+        `byLine` is False) to a dictionary with 4 keys: 'executions', 'conditionfailed' (number of times
+        the condition of the instruction was not met), 'memread' and 'memwrite' (number of bytes read
+        and written by the instruction). Only the instructions executed at least once are included.
+        """
+        if self.profiler is None:
+            return {}
+        counters = self.profiler.getLineCounters(self.addr2line) if byLine else self.profiler.getCounters()
+        return {k: dict(zip(("executions", "conditionfailed", "memread", "memwrite"), v)) for k, v in counters.items()}
+
+    def setCoverage(self, enabled, clear=False):
+        """
+        Enable or disable the recording of the coverage of the program (see getCoverage). Like the
+        profiling, it does not slow down the simulation while it is disabled.
+
+        :param clear: if True, the coverage recorded so far is discarded
+        """
+        if self.coverage is None:
+            if not enabled:
+                return
+            self.coverage = Coverage(self.sim)
+        if clear:
+            self.coverage.clear()
+        if enabled:
+            self.coverage.attach()
+        else:
+            self.coverage.detach()
+
+    def getCoverage(self):
+        """
+        Return the coverage of the program by source line, as a dictionary with the keys:
+        - 'executed': sorted list of the lines whose instruction was executed at least once
+        - 'notexecuted': sorted list of the lines whose instruction was never executed
+        - 'branches': dictionary associating the line of each conditional branch executed to a dictionary
+          {'taken': bool, 'nottaken': bool} telling which directions were followed
+        A line producing several instructions is executed if any of them was.
+        """
+        executed, notExecuted, branches = set(), set(), {}
+        if self.coverage is not None:
+            coverage, isSet = self.coverage, self.coverage.isSet
+            for addr in sorted(self.addr2line):
+                if len(self.addr2line[addr]) == 0 or addr >= 4 * coverage.size:
+                    continue
+                line = self.addr2line[addr][-1]
+                if not isSet(coverage.executed, addr):
+                    notExecuted.add(line)
+                    continue
+                executed.add(line)
+                if coverage.isConditionalBranch(addr):
+                    branches[line] = {"taken": isSet(coverage.taken, addr),
+                                      "nottaken": isSet(coverage.notTaken, addr)}
+        return {"executed": sorted(executed),
+                "notexecuted": sorted(notExecuted - executed),
+                "branches": branches}
+
+    def startTrace(self, capacity=1 << 16, path=None):
+        """
+        Start recording the instructions executed, with their register and memory writes, in a ring buffer
+        keeping the last `capacity` records (see trace.py). The previous trace is discarded.
+
+        :param path: if not None, the trace is written in this file (which can be read with trace.readTrace)
+        """
+        if self.tracer is not None:
+            self.tracer.close()
+        self.tracer = TraceRecorder(self.sim, capacity, path)
+        self.tracer.attach()
+
+    def stopTrace(self):
+        """
+        Stop recording the trace. It can still be exported with `exportTrace`.
+        """
+        if self.tracer is not None:
+            self.tracer.detach()
+
+    def exportTrace(self, out, format="jsonl"):
+        """
+        Write the trace in the text stream `out`, either as JSON lines (one object per instruction, format="jsonl")
+        or in the Chrome trace event format (format="chrome").
+        """
+        records = self.tracer.records() if self.tracer is not None else ()
+        if format == "chrome":
+            exportChromeTrace(records, out, self.addr2line)
+        else:
+            exportJSONLines(records, out)
+
+    def setCacheSimulation(self, icache=None, dcache=None, missPenalty=10):
+        """
+        Simulate an instruction cache and/or a data cache. Each cache is described by a dictionary with the
+        keys 'size' and 'linesize' (in bytes), 'ways' (1 for a direct-mapped cache), 'replacement' ("LRU" or
+        "FIFO") and 'writeback' (False for a write-through cache); the missing keys take the default values
+        of the Cache class. Passing None for both caches disables the simulation.
+        Raise a ValueError if the configuration is invalid.
+
+        :param missPenalty: number of cycles added to the cycle count for each transfer with the memory
+        """
+        def build(config):
+            if config is None:
+                return None
+            names = {'size': 'size', 'linesize': 'lineSize', 'ways': 'ways', 'replacement': 'replacement', 'writeback': 'writeBack'}
+            return Cache(**{names[k]: v for k, v in config.items() if k in names})
+        self.sim.setCaches(build(icache), build(dcache), missPenalty)
+
+    def getCacheStats(self):
+        """
+        Return the statistics of the simulated caches, as a dictionary associating "icache" and/or "dcache"
+        to a dictionary with the keys 'hits', 'misses', 'evictions', 'writebacks' and 'lines'. The latter
+        associates each source line which accessed the cache to a (hits, misses, evictions) tuple.
+        """
+        if self.sim.caches is None:
+            return {}
+        stats = {}
+        for name, cache in self.sim.caches.caches.items():
+            stats[name] = cache.getStats()
+            lines = {}
+            for addr, counters in self.sim.caches.getCounters(name).items():
+                if len(self.addr2line.get(addr, ())) > 0:
+                    line = self.addr2line[addr][-1]
+                    lines[line] = tuple(a + b for a, b in zip(lines.get(line, (0, 0, 0)), counters))
+            stats[name]['lines'] = lines
+        return stats
+
+    def getMemoryEstimate(self):
+        """
+        Return a rough estimate of the memory used by this interpreter, in bytes: the memory pages it
+        wrote (the others are shared with the program image), the history and the buffers of the
+        profiler, the coverage and the trace. The decoded instructions, shared by all the interpreters,
+        are not included.
+        """
+        mem = self.sim.mem
+        size = sum(len(page.buf) for page in mem.pages.values() if page.private)
+        # Each change recorded in the history costs a dictionary entry and a tuple of values
+        size += 200 * sum(len(changes) for entry in self.sim.history.history for changes in entry.values())
+        if self.profiler is not None:
+            size += sum(counters.itemsize * len(counters) for counters in
+                        (self.profiler.executions, self.profiler.conditionFalse, self.profiler.memRead, self.profiler.memWrite))
+        if self.coverage is not None:
+            size += len(self.coverage.executed) * 3
+        if self.tracer is not None and self.tracer.file is None:
+            size += len(self.tracer.buffer)
+        return size
+
+    @staticmethod
+    def getDecodeCacheStats():
+        """
+        Return the statistics of the decoded instructions cache, which is shared by all the
+        interpreters of the process. This is a dictionary with 4 keys: 'hits', 'misses',
+        'size' (current number of entries) and 'maxsize'.
+        """
+        return decodedInstrCache.getStats()
+
     def getErrors(self): # TODO: This is temporary until the new interpreter
         """
         Return all errors from the last step.
@@ -452,8 +836,12 @@ class BCInterpreter:
 
         memory_changes = changes.get(self.sim.mem.__class__)
         if memory_changes:
-            start_addr = self.sim.mem.startAddr
-            result.append(["mempartial", [[start_addr[k[0]]+k[1], "{:02x}".format(v[1]).upper()] for k, v in memory_changes.items()]])
+            # The changes are recorded by range (see Memory.set), several ranges may overlap
+            changedBytes = {}
+            for addr, size in memory_changes:
+                for of, val in enumerate(self.sim.mem.readRange(addr, size)):
+                    changedBytes[addr+of] = val
+            result.append(["mempartial", [[k, "{:02x}".format(v).upper()] for k, v in changedBytes.items()]])
 
         result.extend(self.getErrorsFormatted())
 
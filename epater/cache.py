@@ -0,0 +1,184 @@
+"""
+Simulation of an instruction cache and a data cache.
+
+The caches only keep the tags of the lines (the content is always read from Memory), in flat
+arrays of `sets * ways` entries: the ways of the set `s` are at the indices [s*ways, (s+1)*ways).
+"""
+
+import copy
+from array import array
+
+
+class Cache:
+    """
+    A set-associative cache (direct-mapped if `ways` is 1, fully associative if `ways` is the
+    number of lines).
+
+    :param size: total size of the cache, in bytes
+    :param lineSize: size of a line, in bytes
+    :param ways: number of lines of each set
+    :param replacement: "LRU" (least recently used) or "FIFO" (first in, first out)
+    :param writeBack: if True, a write only modifies the line (which is written back to memory when it is
+                      evicted) and a write miss loads the line. Otherwise, the writes are sent to memory
+                      (write-through) and a write miss does not load the line.
+    """
+    def __init__(self, size=4096, lineSize=32, ways=1, replacement="LRU", writeBack=True):
+        for name, val in (("la taille du cache", size), ("la taille de ligne", lineSize), ("l'associativité", ways)):
+            if val <= 0 or val & (val - 1):
+                raise ValueError("Configuration du cache invalide : {} doit être une puissance de 2 (et non {})".format(name, val))
+        if size < lineSize * ways:
+            raise ValueError("Configuration du cache invalide : le cache doit contenir au moins {} lignes".format(ways))
+        if replacement not in ("LRU", "FIFO"):
+            raise ValueError("Configuration du cache invalide : politique de remplacement {} inconnue".format(replacement))
+        self.size, self.lineSize, self.ways = size, lineSize, ways
+        self.replacement, self.writeBack = replacement, writeBack
+        self.lineShift = lineSize.bit_length() - 1
+        self.sets = size // (lineSize * ways)
+        self.clear()
+
+    def clear(self):
+        """
+        Invalidate all the lines and reset the statistics.
+        """
+        count = self.sets * self.ways
+        # Line number (address >> lineShift) held by each entry, -1 if it is invalid
+        self.tags = array('q', [-1]) * count
+        # Time of the last access (LRU) or of the load (FIFO) of each entry
+        self.stamps = array('Q', [0]) * count
+        self.dirty = bytearray(count)
+        self.clock = 0
+        self.hits = self.misses = self.evictions = self.writebacks = 0
+
+    def access(self, addr, write=False):
+        """
+        Simulate an access to `addr`, and return the number of transfers with the memory it required:
+        0 for a hit, 1 for a miss, 2 for a miss which evicted a modified line.
+        """
+        line = addr >> self.lineShift
+        ways, tags = self.ways, self.tags
+        base = (line % self.sets) * ways
+        self.clock += 1
+        for entry in range(base, base + ways):
+            if tags[entry] == line:
+                self.hits += 1
+                if self.replacement == "LRU":
+                    self.stamps[entry] = self.clock
+                if write and self.writeBack:
+                    self.dirty[entry] = 1
+                return 0
+
+        self.misses += 1
+        if write and not self.writeBack:
+            # No allocation on a write miss, the data is only written in memory
+            return 1
+        stamps = self.stamps
+        victim = base
+        if ways > 1:
+            victim = min(range(base, base + ways), key=stamps.__getitem__)
+        transfers = 1
+        if tags[victim] >= 0:
+            self.evictions += 1
+            if self.dirty[victim]:
+                self.writebacks += 1
+                transfers = 2
+        tags[victim] = line
+        stamps[victim] = self.clock
+        self.dirty[victim] = write and self.writeBack
+        return transfers
+
+    def copy(self):
+        """
+        Return a copy of the cache, including its content.
+        """
+        cache = copy.copy(self)
+        cache.tags, cache.stamps, cache.dirty = array('q', self.tags), array('Q', self.stamps), bytearray(self.dirty)
+        return cache
+
+    def getStats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "writebacks": self.writebacks}
+
+
+class CacheHierarchy:
+    """
+    Instruction and data caches attached to a simulator with instrumentation hooks (see
+    Simulator.addHook). Each instruction executed is fetched through the instruction cache, and
+    each memory access done by an instruction goes through the data cache. Each transfer with the
+    memory adds `missPenalty` cycles to the cycle count.
+
+    The statistics are also kept for each instruction, in arrays indexed by `addr // 4`. The caches
+    are not restored when stepping back.
+    """
+    def __init__(self, sim, icache=None, dcache=None, missPenalty=10):
+        self.sim = sim
+        self.caches = {name: cache for name, cache in (("icache", icache), ("dcache", dcache)) if cache is not None}
+        self.missPenalty = missPenalty
+        self.size = sim.mem.getInstructionsEnd() // 4
+        # For each cache, the number of hits, misses and evictions caused by each instruction
+        self.counters = {name: tuple(array('L', [0]) * self.size for i in range(3)) for name in self.caches}
+        self.hooks = []
+
+    def clear(self):
+        for name, cache in self.caches.items():
+            cache.clear()
+            for counters in self.counters[name]:
+                counters[:] = array('L', [0]) * self.size
+
+    def attach(self):
+        if self.hooks or not self.caches:
+            return
+        sim, penalty, size = self.sim, self.missPenalty, self.size
+        pcReg, pcoffset, history = sim.regs.banks['User'][15], sim.pcoffset, sim.history
+
+        def makeAccess(cache, counters, write, fetch=False):
+            access = cache.access
+            hits, misses, evictions = counters
+            def onAccess(addr, accessSize, value):
+                evicted = cache.evictions
+                transfers = access(addr, write)
+                # During the execution of an instruction, PC contains its address plus the prefetch offset
+                idx = (addr if fetch else pcReg.val - pcoffset) >> 2
+                if idx < size:
+                    if transfers == 0:
+                        hits[idx] += 1
+                    else:
+                        misses[idx] += 1
+                        evictions[idx] += cache.evictions - evicted
+                if transfers:
+                    history.addCycles(transfers * penalty)
+            return onAccess
+
+        if "icache" in self.caches:
+            fetch = makeAccess(self.caches["icache"], self.counters["icache"], False, fetch=True)
+            self.hooks.append(sim.addHook("exec", lambda addr, instr, executed: fetch(addr, 4, None)))
+        if "dcache" in self.caches:
+            self.hooks.append(sim.addHook("memread", makeAccess(self.caches["dcache"], self.counters["dcache"], False)))
+            self.hooks.append(sim.addHook("memwrite", makeAccess(self.caches["dcache"], self.counters["dcache"], True)))
+
+    def detach(self):
+        for hook in self.hooks:
+            self.sim.removeHook(hook)
+        self.hooks = []
+
+    def clone(self, sim):
+        """
+        Return a copy of the caches (including their content) for `sim`, a copy of the simulator
+        they are attached to (the copy of the simulator has copies of our hooks, which we replace).
+        """
+        caches = CacheHierarchy(sim, missPenalty=self.missPenalty)
+        for name, cache in self.caches.items():
+            caches.caches[name] = cache.copy()
+            caches.counters[name] = tuple(array('L', counters) for counters in self.counters[name])
+        if self.hooks:
+            for hook in self.hooks:
+                sim.removeHook(hook)
+            caches.attach()
+        return caches
+
+    def getCounters(self, name):
+        """
+        Return a dictionary associating the address of each instruction which accessed the cache `name`
+        ("icache" or "dcache") to a (hits, misses, evictions) tuple.
+        """
+        hits, misses, evictions = self.counters[name]
+        return {4*idx: (hits[idx], misses[idx], evictions[idx])
+                for idx in range(self.size) if hits[idx] or misses[idx]}
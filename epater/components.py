@@ -1,5 +1,6 @@
 import operator
 import struct
+from bisect import bisect_left
 from enum import Enum
 from collections import defaultdict, namedtuple, deque
 
@@ -24,12 +25,15 @@ class Breakpoint(Exception):
         breakpoint has occurred.
         In the case of register, it is the register index.
         In the case of a flag, it is the flag letter (C, V, Z, or N)
+    * `value` is the value read or written by the access (the instruction
+        itself for an execution breakpoint), or None if it is unknown.
     """
 
-    def __init__(self, component, mode, info=None):
+    def __init__(self, component, mode, info=None, value=None):
         self.cmp = component
         self.mode = mode
         self.info = info
+        self.value = value
 
 
 class ComponentException(ExecutionException):
@@ -55,6 +59,15 @@ class Component:
 
     def __init__(self, history):
         self.history = history
+        # Conditions attached to some breakpoints, as functions taking the value of the access
+        # and returning True if the execution must stop (see Simulator.setBreakpointCondition)
+        self.bkptConditions = {}
+
+    def _breakpointHit(self, cmp, mode, info, value=None):
+        # Raise the breakpoint, unless a condition is attached to it and does not hold
+        condition = self.bkptConditions.get(info)
+        if condition is None or condition(value):
+            raise Breakpoint(cmp, mode, info, value)
 
     def stepBack(self, state):
         raise NotImplementedError
@@ -62,6 +75,19 @@ class Component:
     def getContext(self):
         raise NotImplementedError
 
+    def getLocations(self, key):
+        """
+        Return the locations (e.g. registers or memory addresses) modified by the change `key`
+        of the history.
+        """
+        return (key,)
+
+    def getSnapshot(self):
+        raise NotImplementedError
+
+    def diffSnapshot(self, snapshot):
+        raise NotImplementedError
+
 
 class _Register:
 
@@ -176,6 +202,42 @@ class Registers(Component):
 
         # Keep the breakpoints on the flags
         self.bkptFlags = {k:0 for k in self.flag2index.keys()}
+        # Incremented each time a breakpoint is changed, so that other parts of the
+        # simulator can cache information about the breakpoints
+        self.bkptGeneration = 0
+
+    def clone(self, history):
+        """
+        Return a copy of the registers (including their breakpoints), which logs its changes in `history`.
+        """
+        regs = Registers(history)
+        for mode, bank in self.banks.items():
+            for reg, regCopy in zip(bank, regs.banks[mode]):
+                regCopy.val = reg.val
+                regCopy.breakpoint = reg.breakpoint
+        regs.regCPSR = self.regCPSR
+        regs.currentMode = self.currentMode
+        regs.bkptFlags = dict(self.bkptFlags)
+        regs.bkptActive = self.bkptActive
+        return regs
+
+    def getSnapshot(self):
+        """
+        Return the values of all the registers, to be compared later by `diffSnapshot`.
+        """
+        snapshot = {(bank, "SPSR" if reg.id == 16 else reg.id): reg.val for bank, regs in self.banks.items() for reg in regs}
+        snapshot["CPSR"] = self.regCPSR
+        return snapshot
+
+    def diffSnapshot(self, snapshot):
+        """
+        Return the registers which changed since `snapshot` was taken, in the same format as the history.
+        """
+        current = self.getSnapshot()
+        changes = {k: (v, current[k]) for k, v in snapshot.items() if current[k] != v and k != "CPSR"}
+        if current["CPSR"] != snapshot["CPSR"]:
+            changes[(self.currentMode, "CPSR")] = (snapshot["CPSR"], current["CPSR"])
+        return changes
 
     def getContext(self):
         c = {'CPSR': self.regCPSR}
@@ -287,7 +349,7 @@ class Registers(Component):
         regHandle = self.banks[currentBank][idx]
         # Register
         if self.bkptActive and regHandle.breakpoint & 4:
-            raise Breakpoint("register", 4, (currentBank, idx))
+            self._breakpointHit("register", 4, (currentBank, idx), regHandle.val)
         return regHandle.val
 
     def getAllRegisters(self):
@@ -298,7 +360,7 @@ class Registers(Component):
     def getRegister(self, bank, reg):
         # Get a register with a specific bank
         if self.bkptActive and self.banks[bank][reg].breakpoint & 4:
-            raise Breakpoint("register", 4, (bank, reg))
+            self._breakpointHit("register", 4, (bank, reg), self.banks[bank][reg].val)
         return self.banks[bank][reg].val
 
     def __setitem__(self, idx, val):
@@ -312,7 +374,7 @@ class Registers(Component):
         # in the history of the register (just set logToHistory to False).
         regHandle = self.banks[bank][reg]
         if self.bkptActive and regHandle.breakpoint & 2:
-            raise Breakpoint("register", 2, (bank, reg))
+            self._breakpointHit("register", 2, (bank, reg), val & 0xFFFFFFFF)
         oldValue, newValue = self.banks[bank][reg].val, val & 0xFFFFFFFF
 
         if logToHistory:
@@ -339,7 +401,7 @@ class Registers(Component):
             raise ComponentException("flags")
 
         if self.bkptActive and mayTriggerBkpt and bkptFlag & 2:
-            raise Breakpoint("flags", 2, flag)
+            self._breakpointHit("flags", 2, flag, int(bool(value)))
 
         oldCPSR = self.regCPSR
         if value:   # We set the flag
@@ -355,7 +417,7 @@ class Registers(Component):
         for flag, value in flagsDict.items():
 
             if self.bkptActive and mayTriggerBkpt and self.bkptFlags[flag] & 2:
-                raise Breakpoint("flags", 2, flag)
+                self._breakpointHit("flags", 2, flag, int(bool(value)))
 
             if value:   # We set the flag
                 self.regCPSR |= 1 << self.flag2index[flag]
@@ -376,16 +438,26 @@ class Registers(Component):
     def toggleBreakpointOnRegister(self, bank, regidx, modeOctal):
         # Toggle the value
         self.banks[bank][regidx].breakpoint ^= modeOctal
+        self.bkptGeneration += 1
 
     def toggleBreakpointOnFlag(self, flag, modeOctal):
         # Toggle the value
         self.bkptFlags[flag] ^= modeOctal
+        self.bkptGeneration += 1
 
     def setBreakpointOnRegister(self, bank, regidx, breakpointType):
         self.banks[bank][regidx].breakpoint = breakpointType
+        self.bkptGeneration += 1
 
     def setBreakpointOnFlag(self, flag, breakpointType):
         self.bkptFlags[flag] = breakpointType
+        self.bkptGeneration += 1
+
+    def hasBreakpoints(self):
+        """
+        Return True if at least one breakpoint is set on a register or a flag.
+        """
+        return any(reg.breakpoint for bank in self.banks.values() for reg in bank) or any(self.bkptFlags.values())
 
     def stepBack(self, state):
         # TODO what happens if we change mode at the same time we change a register?
@@ -400,9 +472,38 @@ class Registers(Component):
                 self.banks[bank][reg].val = val[0]
 
 
+class _Page:
+    """
+    A page of memory, created the first time it is accessed.
+    `base` holds the content of the page when the program was loaded and is never modified, `buf`
+    is the current content of the page : `base` itself until the page is written, then a private copy.
+    [lo, hi) is the range of valid offsets in the page, or (0, 0) if the page contains several
+    ranges (e.g. the end of a section and the start of the next one), all listed in `ranges`.
+    `perm` uses the same encoding as the breakpoints (4: read, 2: write, 1: exec).
+    `buf` can only be modified if `private` is set, otherwise it may be shared with a clone of the memory.
+    """
+    __slots__ = ("number", "base", "buf", "lo", "hi", "ranges", "perm", "dirty", "private", "code")
+
+    def __init__(self, number, base, ranges, code):
+        self.number = number
+        self.base = self.buf = base
+        self.ranges = ranges
+        self.lo, self.hi = ranges[0] if len(ranges) == 1 else (0, 0)
+        self.perm = 7
+        self.dirty = False
+        self.private = False
+        self.code = code
+
+    def contains(self, offset, size=1):
+        return any(lo <= offset <= hi - size for lo, hi in self.ranges)
+
+
 class Memory(Component):
     packformat = {1: "<B", 2: "<H", 4: "<I"}
     maskformat = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+    pageShift = 12              # Pages of 4 KB
+    pageSize = 1 << pageShift
+    pageMask = pageSize - 1
 
     def __init__(self, history, memcontent, initval=0):
         super().__init__(history)
@@ -412,11 +513,19 @@ class Memory(Component):
         self.initval = initval
         self.startAddr = memcontent['__MEMINFOSTART']
         self.endAddr = memcontent['__MEMINFOEND']
-        self.maxAddr = max(self.endAddr.values())
         assert len(self.startAddr) == len(self.endAddr)
 
-        self.data = {k:bytearray(memcontent[k]) for k in self.startAddr.keys()}
-        self.initdata = self.data.copy()
+        # Content of each section, as produced by the assembler. It is never modified: the pages
+        # are built from it the first time they are accessed, and a page gets its own copy when written
+        self.image = {k:memcontent[k] for k in self.startAddr.keys()}
+        # Maps a page number to its _Page. Pages which were never accessed are not allocated, so
+        # large declarations only cost the memory actually used by the program
+        self.pages = {}
+        # Numbers of the pages known not to be used by any section, so that the sections are only
+        # searched once for each page accessed (e.g. by a device or an invalid access)
+        self.emptyPages = set()
+        # Numbers of the pages written since the program was loaded (or since the last `reset`)
+        self.dirtyPages = set()
         self.bkptActive = True
 
         # Maps address to an integer 'n'. The integer n allows to determine if the breakpoint should be
@@ -425,65 +534,415 @@ class Memory(Component):
         # If n & 2, then it is active for each write operation
         # If n & 1, then it is active for each exec operation (namely, an instruction load)
         self.breakpoints = defaultdict(int)
+        self.bkptGeneration = 0
+        # Sorted addresses of the breakpoints, rebuilt when bkptGeneration changes (see _findBreakpoint)
+        self._bkptIndex = []
+        self._bkptIndexGeneration = -1
+
+        # Functions called with (addr, size) each time an instruction section (INTVEC or CODE)
+        # is modified, so that anything derived from the bytecode can be invalidated
+        self.codeWatchers = []
+
+        # Maps a page number to the memory-mapped device using it (see devices.py). Devices are
+        # looked up when an address is not in an allocated page, so RAM accesses are not slowed down
+        self.devicePages = {}
+        # Set while a translated region runs: device accesses then interrupt it, since devices
+        # may depend on the exact cycle count
+        self.inTranslatedRegion = False
+
+    def _getPage(self, number):
+        """
+        Return the page `number`, creating it if needed, or None if no section uses it.
+        """
+        page = self.pages.get(number)
+        if page is None and number not in self.emptyPages:
+            page = self._buildPage(number)
+            if page is None:
+                self.emptyPages.add(number)
+            else:
+                self.pages[number] = page
+        return page
 
-    def getContext(self):
-        return self.data
+    def _buildPage(self, number):
+        """
+        Return a new _Page holding the content of the page `number` when the program was loaded,
+        or None if no section uses it.
+        """
+        pageAddr = number << self.pageShift
+        base, ranges, code = None, [], False
+        for sec, start in self.startAddr.items():
+            lo, hi = max(start, pageAddr), min(self.endAddr[sec], pageAddr + self.pageSize)
+            if lo >= hi:
+                continue
+            if base is None:
+                base = bytearray([self.initval]) * self.pageSize
+            base[lo-pageAddr:hi-pageAddr] = self.image[sec][lo-start:hi-start]
+            ranges.append([lo-pageAddr, hi-pageAddr])
+            code = code or sec in ("INTVEC", "CODE")
+        if base is None:
+            return None
+        # Merge the contiguous sections (e.g. INTVEC and CODE)
+        ranges.sort()
+        merged = [ranges[0]]
+        for lo, hi in ranges[1:]:
+            if lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return _Page(number, bytes(base), tuple(tuple(r) for r in merged), code)
 
-    def _getRelativeAddr(self, addr, size):
+    def _locate(self, addr, size):
+        """
+        Return a list of (page, offset) tuples, one for each byte of [addr, addr+size), or None
+        if one of these bytes is not part of a section.
+        """
+        locations = []
+        for a in range(addr, addr + size):
+            page = self._getPage(a >> self.pageShift) if a >= 0 else None
+            if page is None or not page.contains(a & self.pageMask):
+                return None
+            locations.append((page, a & self.pageMask))
+        return locations
+
+    def _makePrivate(self, page):
+        # Give its own copy to a page about to be written
+        page.buf = bytearray(page.buf)
+        page.private = True
+        page.dirty = True
+        self.dirtyPages.add(page.number)
+        return page.buf
+
+    def reset(self):
+        """
+        Restore the content of the memory as it was when the program was loaded. Only the pages
+        written since then have to be restored, since the others still use their base content.
+        """
+        for number in self.dirtyPages:
+            page = self.pages[number]
+            page.buf = page.base
+            page.dirty = page.private = False
+            if page.code and self.codeWatchers:
+                self._signalCodeChange(number << self.pageShift, self.pageSize)
+        self.dirtyPages = set()
+
+    def clone(self, history):
+        """
+        Return a copy of the memory, which logs its changes in `history`. The pages are shared
+        until one of the copies writes them (the breakpoints are copied, but not the devices).
+        """
+        memcontent = {'__MEMINFOSTART': self.startAddr, '__MEMINFOEND': self.endAddr}
+        memcontent.update(self.image)
+        mem = Memory(history, memcontent, self.initval)
+        for number, page in self.pages.items():
+            if page.private:
+                # Both copies will have to copy this page before writing it
+                page.buf = bytes(page.buf)
+                page.private = False
+            pageCopy = _Page(number, page.base, page.ranges, page.code)
+            pageCopy.buf, pageCopy.perm, pageCopy.dirty = page.buf, page.perm, page.dirty
+            mem.pages[number] = pageCopy
+        mem.dirtyPages = set(self.dirtyPages)
+        mem.emptyPages = set(self.emptyPages)
+        mem.breakpoints = self.breakpoints.copy()
+        mem.bkptActive = self.bkptActive
+        return mem
+
+    def getInstructionsEnd(self):
+        """
+        Return the end address of the sections holding instructions: INTVEC and CODE, or the single
+        section of a program written in snippet mode (0 if there is none). These sections start at 0.
+        """
+        return max((self.endAddr[sec] for sec in ("INTVEC", "CODE", "SNIPPET_DUMMY_SECTION") if sec in self.endAddr),
+                   default=0)
+
+    def isMapped(self, addr, size=1, perm=0):
+        """
+        Return True if [addr, addr+size) is part of a section and allows the accesses in `perm`
+        (same encoding as the breakpoints, 0 to ignore the permissions).
+        """
+        locations = self._locate(addr, size)
+        return locations is not None and all(page.perm & perm == perm for page, _ in locations)
+
+    def setPermissions(self, addr, size, perm):
+        """
+        Set the permissions (4: read, 2: write, 1: exec) of all the pages overlapping [addr, addr+size).
+        By default, all the accesses are allowed.
+        """
+        for number in range(addr >> self.pageShift, ((addr + size - 1) >> self.pageShift) + 1):
+            page = self._getPage(number)
+            if page is not None:
+                page.perm = perm & 7
+                if page.code and self.codeWatchers:
+                    # The instructions decoded in advance have to check the new permissions
+                    self._signalCodeChange(number << self.pageShift, self.pageSize)
+
+    def getPermissions(self, addr):
+        page = self._getPage(addr >> self.pageShift) if addr >= 0 else None
+        return None if page is None else page.perm
+
+    def readRange(self, addr, size):
         """
-        Determine if *addr* is a valid address, and return a tuple containing the section
-        and offset of this address.
-        :param addr: The address we want to check
-        :return: None if the address is invalid. Else, a tuple of two elements, the first being the
-        section used and the second the offset relative from the start of this section.
+        Return the content of [addr, addr+size), which must be part of the sections, without
+        checking the permissions or triggering the breakpoints. The pages which were not accessed
+        yet are read from the image, without allocating them.
         """
-        if addr < 0 or addr > self.maxAddr - (size-1):
+        chunks = []
+        while size > 0:
+            number, offset = addr >> self.pageShift, addr & self.pageMask
+            page = self.pages.get(number) or self._buildPage(number)
+            length = min(size, self.pageSize - offset)
+            chunks.append(page.buf[offset:offset+length])
+            addr += length
+            size -= length
+        return b"".join(chunks)
+
+    def mapDevice(self, device):
+        """
+        Map a device (see devices.py) at its base address. The device uses whole pages, which
+        cannot be shared with a section or another device.
+        """
+        firstPage = device.baseAddr >> self.pageShift
+        lastPage = (device.baseAddr + max(device.size, 1) - 1) >> self.pageShift
+        for page in range(firstPage, lastPage + 1):
+            pageAddr = page << self.pageShift
+            if page in self.devicePages or any(start < pageAddr + (1 << self.pageShift) and pageAddr < self.endAddr[sec]
+                                               for sec, start in self.startAddr.items()):
+                raise ComponentException("memory", "Impossible de placer un périphérique à l'adresse {} : cette zone mémoire est déjà utilisée".format(hex(device.baseAddr)))
+        for page in range(firstPage, lastPage + 1):
+            self.devicePages[page] = device
+
+    def _getDevice(self, addr, size):
+        if not self.devicePages:
             return None
-        for sec in self.startAddr.keys():       # TODO : optimize this loop out
-            if self.startAddr[sec] <= addr < self.endAddr[sec] - (size-1):
-                return sec, addr - self.startAddr[sec]
-        return None
+        device = self.devicePages.get(addr >> self.pageShift)
+        if device is None or not device.baseAddr <= addr <= device.baseAddr + device.size - size:
+            return None
+        if self.inTranslatedRegion:
+            raise ComponentException("memory", "Accès à un périphérique depuis une région traduite")
+        return device
+
+    def _deviceGet(self, device, addr, size, mayTriggerBkpt):
+        for offset in range(size):
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+offset] & 4:
+                self._breakpointHit("memory", 4, addr + offset, device.read(addr - device.baseAddr, size, peek=True))
+        # Reads which cannot trigger a breakpoint come from the interface, they must not change the device state
+        return struct.pack(self.packformat[size], device.read(addr - device.baseAddr, size, peek=not mayTriggerBkpt))
+
+    def _deviceSet(self, device, addr, val, size, mayTriggerBkpt):
+        for offset in range(size):
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+offset] & 2:
+                self._breakpointHit("memory", 2, addr + offset, val & self.maskformat[size])
+        device.write(addr - device.baseAddr, val & self.maskformat[size], size)
+
+    def getContext(self):
+        return {sec: self.readRange(start, self.endAddr[sec] - start) for sec, start in self.startAddr.items()}
+
+    def getLocations(self, key):
+        # The changes are recorded by (addr, size) range, the locations are the bytes
+        addr, size = key
+        return range(addr, addr + size)
+
+    def getSnapshot(self):
+        """
+        Return the content of the pages written since the program was loaded, to be compared later
+        by `diffSnapshot`. As for `clone`, the pages are shared with the snapshot until they are
+        written again, so only the pages written since the previous snapshot are copied.
+        """
+        snapshot = {}
+        for number in self.dirtyPages:
+            page = self.pages[number]
+            if page.private:
+                page.buf = bytes(page.buf)
+                page.private = False
+            snapshot[number] = page.buf
+        return snapshot
+
+    def diffSnapshot(self, snapshot, lineSize=64):
+        """
+        Return the bytes which changed since `snapshot` was taken, as (addr, size) -> (old bytes, new bytes)
+        records (the same format as the history). Only the pages written since the snapshot are compared,
+        by lines of `lineSize` bytes.
+        """
+        changes = {}
+        for number in sorted(self.dirtyPages | snapshot.keys()):
+            page = self.pages[number]
+            old, new = snapshot.get(number, page.base), page.buf
+            if old is new:
+                # Not written since the snapshot
+                continue
+            pageAddr = number << self.pageShift
+            for lineStart in range(0, self.pageSize, lineSize):
+                if old[lineStart:lineStart+lineSize] == new[lineStart:lineStart+lineSize]:
+                    continue
+                start = None
+                for offset in range(lineStart, lineStart + lineSize + 1):
+                    differs = offset < lineStart + lineSize and old[offset] != new[offset]
+                    if differs and start is None:
+                        start = offset
+                    elif not differs and start is not None:
+                        changes[(pageAddr + start, offset - start)] = (bytes(old[start:offset]), bytes(new[start:offset]))
+                        start = None
+        return changes
 
     def get(self, addr, size=4, execMode=False, mayTriggerBkpt=True):
-        resolvedAddr = self._getRelativeAddr(addr, size)
-        if resolvedAddr is None:
+        page = self.pages.get(addr >> self.pageShift)
+        offset = addr & self.pageMask
+        if page is None or not page.lo <= offset <= page.hi - size or not page.perm & (1 if execMode else 4):
+            # Page not allocated yet, access overlapping several pages or ranges, device or invalid access
+            return self._getSlow(addr, size, execMode, mayTriggerBkpt)
+
+        for of in range(size):
+            if self.bkptActive and execMode and self.breakpoints[addr+of] & 1:
+                self._breakpointHit("memory", 1, addr + of, int.from_bytes(page.buf[offset:offset+size], "little"))
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+of] & 4:
+                self._breakpointHit("memory", 4, addr + of, int.from_bytes(page.buf[offset:offset+size], "little"))
+
+        return page.buf[offset:offset+size]
+
+    def _getSlow(self, addr, size, execMode, mayTriggerBkpt):
+        # The pages of the devices are never used by a section
+        device = None if execMode else self._getDevice(addr, size)
+        if device is not None:
+            return self._deviceGet(device, addr, size, mayTriggerBkpt)
+        locations = self._locate(addr, size)
+        if locations is None:
             if execMode:
                 desc = "Tentative de lecture d'une instruction a une adresse non initialisée : {}".format(hex(addr))
             else:
                 desc = "Accès mémoire en lecture fautif a l'adresse {}".format(hex(addr))
             raise ComponentException("memory", desc)
+        if not all(page.perm & (1 if execMode else 4) for page, _ in locations):
+            raise ComponentException("memory", "Accès mémoire en {} interdit à l'adresse {}".format("exécution" if execMode else "lecture", hex(addr)))
 
-        for offset in range(size):
-            if self.bkptActive and execMode and self.breakpoints[addr+offset] & 1:
-                raise Breakpoint("memory", 1, addr + offset)
-            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+offset] & 4:
-                raise Breakpoint("memory", 4, addr + offset)
+        content = bytes(page.buf[offset] for page, offset in locations)
+        for of in range(size):
+            if self.bkptActive and execMode and self.breakpoints[addr+of] & 1:
+                self._breakpointHit("memory", 1, addr + of, int.from_bytes(content, "little"))
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+of] & 4:
+                self._breakpointHit("memory", 4, addr + of, int.from_bytes(content, "little"))
 
-        sec, offset = resolvedAddr
-        return self.data[sec][offset:offset+size]
+        return content
 
     def set(self, addr, val, size=4, mayTriggerBkpt=True):
-        resolvedAddr = self._getRelativeAddr(addr, size)
-        if resolvedAddr is None:
-            raise ComponentException("memory", "Accès invalide pour une écriture de taille {} à l'adresse {}".format(size, hex(addr)))
+        page = self.pages.get(addr >> self.pageShift)
+        offset = addr & self.pageMask
+        if page is None or not page.lo <= offset <= page.hi - size or not page.perm & 2:
+            return self._setSlow(addr, val, size, mayTriggerBkpt)
 
-        for offset in range(size):
-            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+offset] & 2:
-                raise Breakpoint("memory", 2, addr + offset)
+        for of in range(size):
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+of] & 2:
+                self._breakpointHit("memory", 2, addr + of, val & self.maskformat[size])
 
-        sec, offset = resolvedAddr
         val &= self.maskformat[size]
         valBytes = struct.pack(self.packformat[size], val)
 
-        dictChanges = {}
+        buf = page.buf if page.private else self._makePrivate(page)
+        self.history.signalChange(self, {(addr, size): (bytes(buf[offset:offset+size]), valBytes)})
+
+        buf[offset:offset+size] = valBytes
+        if page.code and self.codeWatchers:
+            self._signalCodeChange(addr, size)
+
+    def _setSlow(self, addr, val, size, mayTriggerBkpt):
+        device = self._getDevice(addr, size)
+        if device is not None:
+            return self._deviceSet(device, addr, val, size, mayTriggerBkpt)
+        locations = self._locate(addr, size)
+        if locations is None:
+            raise ComponentException("memory", "Accès invalide pour une écriture de taille {} à l'adresse {}".format(size, hex(addr)))
+        if not all(page.perm & 2 for page, _ in locations):
+            raise ComponentException("memory", "Accès mémoire en écriture interdit à l'adresse {}".format(hex(addr)))
+
         for of in range(size):
-            dictChanges[(sec, offset+of)] = (self.data[sec][offset+of], valBytes[of])
-        self.history.signalChange(self, dictChanges)
+            if self.bkptActive and mayTriggerBkpt and self.breakpoints[addr+of] & 2:
+                self._breakpointHit("memory", 2, addr + of, val & self.maskformat[size])
+
+        val &= self.maskformat[size]
+        valBytes = struct.pack(self.packformat[size], val)
+
+        oldBytes = bytes(page.buf[offset] for page, offset in locations)
+        self.history.signalChange(self, {(addr, size): (oldBytes, valBytes)})
 
-        self.data[sec][offset:offset+size] = valBytes
+        for of, (page, offset) in enumerate(locations):
+            buf = page.buf if page.private else self._makePrivate(page)
+            buf[offset] = valBytes[of]
+        if self.codeWatchers and any(page.code for page, _ in locations):
+            self._signalCodeChange(addr, size)
+
+    def _findBreakpoint(self, addr, size, mode):
+        """
+        Return the first address of [addr, addr+size) having a breakpoint for `mode`, or None.
+        """
+        if self._bkptIndexGeneration != self.bkptGeneration:
+            self._bkptIndex = sorted(a for a, v in self.breakpoints.items() if v)
+            self._bkptIndexGeneration = self.bkptGeneration
+        index = self._bkptIndex
+        i = bisect_left(index, addr)
+        while i < len(index) and index[i] < addr + size:
+            if self.breakpoints[index[i]] & mode:
+                return index[i]
+            i += 1
+        return None
+
+    def readWords(self, addr, count, mayTriggerBkpt=True):
+        """
+        Read `count` consecutive words starting at `addr` and return them as a tuple of integers.
+        The whole range is checked at once, which is faster than `count` calls to `get` (used by LDM).
+        """
+        size = 4 * count
+        page = self._getPage(addr >> self.pageShift) if addr >= 0 else None
+        offset = addr & self.pageMask
+        if page is None or not page.lo <= offset <= page.hi - size or not page.perm & 4:
+            # Range overlapping several pages, device or invalid access. The method of the class is
+            # called, since the instrumentation hooks of the simulator already report the whole range
+            return tuple(struct.unpack("<I", Memory.get(self, addr + 4*i, 4, mayTriggerBkpt=mayTriggerBkpt))[0]
+                         for i in range(count))
+
+        values = struct.unpack_from("<{}I".format(count), page.buf, offset)
+        if self.bkptActive and mayTriggerBkpt:
+            bkptAddr = self._findBreakpoint(addr, size, 4)
+            while bkptAddr is not None:
+                self._breakpointHit("memory", 4, bkptAddr, values[(bkptAddr - addr) // 4])
+                # The condition of this breakpoint does not hold, we look for the next one
+                bkptAddr = self._findBreakpoint(bkptAddr + 1, addr + size - bkptAddr - 1, 4)
+
+        return values
+
+    def writeWords(self, addr, values, mayTriggerBkpt=True):
+        """
+        Write the words in `values` at consecutive addresses, starting at `addr`. The whole range is
+        checked at once, which is faster than a call to `set` for each word (used by STM).
+        """
+        count = len(values)
+        size = 4 * count
+        page = self._getPage(addr >> self.pageShift) if addr >= 0 else None
+        offset = addr & self.pageMask
+        if page is None or not page.lo <= offset <= page.hi - size or not page.perm & 2:
+            # As in readWords, the hooks must not report these writes a second time
+            for i, val in enumerate(values):
+                Memory.set(self, addr + 4*i, val, 4, mayTriggerBkpt)
+            return
+
+        if self.bkptActive and mayTriggerBkpt:
+            bkptAddr = self._findBreakpoint(addr, size, 2)
+            while bkptAddr is not None:
+                self._breakpointHit("memory", 2, bkptAddr, values[(bkptAddr - addr) // 4] & 0xFFFFFFFF)
+                bkptAddr = self._findBreakpoint(bkptAddr + 1, addr + size - bkptAddr - 1, 2)
+
+        buf = page.buf if page.private else self._makePrivate(page)
+        oldBytes = bytes(buf[offset:offset+size])
+        struct.pack_into("<{}I".format(count), buf, offset, *[val & 0xFFFFFFFF for val in values])
+        self.history.signalChange(self, {(addr, size): (oldBytes, bytes(buf[offset:offset+size]))})
+        if page.code and self.codeWatchers:
+            self._signalCodeChange(addr, size)
+
+    def _signalCodeChange(self, addr, size):
+        for watcher in self.codeWatchers:
+            watcher(addr, size)
 
     def setBreakpoint(self, addr, modeOctal):
         self.breakpoints[addr] = modeOctal
+        self.bkptGeneration += 1
 
     def toggleBreakpoint(self, addr, modeOctal):
         if not addr in self.breakpoints:
@@ -491,6 +950,7 @@ class Memory(Component):
         else:
             # Toggle the value
             self.breakpoints[addr] ^= modeOctal
+            self.bkptGeneration += 1
         return self.breakpoints[addr]
 
     def deactivateBreakpoints(self):
@@ -504,6 +964,7 @@ class Memory(Component):
 
     def removeBreakpoint(self, addr):
         self.breakpoints[addr] = 0
+        self.bkptGeneration += 1
 
     def removeExecuteBreakpoints(self, removeList=()):
         # Remove all execution breakpoints that are in removeList
@@ -511,8 +972,14 @@ class Memory(Component):
             self.removeBreakpoint(addr)
 
     def stepBack(self, state):
-        for k, val in state.items():
-            sec, offset = k
-            self.data[sec][offset] = val[0]
-
-
+        # The changes are (addr, size) -> (old bytes, new bytes) records. They may overlap, so they
+        # are reverted in the reverse order
+        for (addr, size), (oldBytes, newBytes) in reversed(tuple(state.items())):
+            while size > 0:
+                page, offset = self._getPage(addr >> self.pageShift), addr & self.pageMask
+                length = min(size, self.pageSize - offset)
+                buf = page.buf if page.private else self._makePrivate(page)
+                buf[offset:offset+length] = oldBytes[:length]
+                if page.code and self.codeWatchers:
+                    self._signalCodeChange(addr, length)
+                addr, size, oldBytes = addr + length, size - length, oldBytes[length:]
@@ -0,0 +1,105 @@
+import ast
+import re
+
+
+class ConditionSyntaxError(Exception):
+    """
+    Raised when the condition of a breakpoint cannot be interpreted.
+    """
+    def __init__(self, text):
+        super().__init__(text)
+        self.text = text
+
+
+regAliases = {'SP': 13, 'LR': 14, 'PC': 15}
+flagShifts = {'N': 31, 'Z': 30, 'C': 29, 'V': 28}
+
+_allowedNodes = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.Invert,
+                 ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.BitAnd, ast.BitOr,
+                 ast.BitXor, ast.LShift, ast.RShift, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+                 ast.Gt, ast.GtE, ast.Name, ast.Load, ast.Constant)
+
+
+class _Wrapper(ast.NodeTransformer):
+    """
+    Keep the results of the arithmetic on 32 bits, like the registers, so that a condition cannot
+    build huge integers: the results of the binary operators and of - and ~ are masked, the constant
+    shift amounts must be at most 31 and the other ones are taken modulo 32.
+    """
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, (ast.LShift, ast.RShift)):
+            if isinstance(node.right, ast.Constant):
+                if not 0 <= node.right.value <= 31:
+                    raise ConditionSyntaxError("Condition invalide : décalage de {} bits".format(node.right.value))
+            else:
+                node.right = ast.BinOp(left=node.right, op=ast.BitAnd(), right=ast.Constant(value=31))
+        return ast.copy_location(ast.BinOp(left=node, op=ast.BitAnd(), right=ast.Constant(value=0xFFFFFFFF)), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, (ast.USub, ast.Invert)):
+            return node
+        return ast.copy_location(ast.BinOp(left=node, op=ast.BitAnd(), right=ast.Constant(value=0xFFFFFFFF)), node)
+
+
+class _NameRewriter(ast.NodeTransformer):
+    """
+    Replace the names of the registers, of the flags and `value` by the expressions reading them.
+    The registers are read directly from their bank, so that no breakpoint is triggered.
+    """
+    def visit_Name(self, node):
+        name = node.id.upper()
+        if name == "VALUE":
+            expr = "value"
+        elif name in flagShifts:
+            expr = "(regs.regCPSR >> {}) & 1".format(flagShifts[name])
+        else:
+            if name in regAliases:
+                idx = regAliases[name]
+            elif re.fullmatch(r"R\d{1,2}", name) and int(name[1:]) < 16:
+                idx = int(name[1:])
+            else:
+                raise ConditionSyntaxError("Condition invalide : nom inconnu {}".format(node.id))
+            expr = "regs.banks[regs.currentMode][{}].val".format(idx)
+        return ast.copy_location(ast.parse(expr, mode="eval").body, node)
+
+
+class BreakpointCondition:
+    """
+    A condition attached to a breakpoint, compiled into a Python function. The condition is only
+    evaluated when the breakpoint is reached, so it does not slow down the rest of the execution.
+
+    The condition is an expression using the registers (R0 to R15, SP, LR, PC), the flags (N, Z, C, V),
+    integer constants, the usual arithmetic and bitwise operators (computed on 32 bits), comparisons and
+    `and`, `or`, `not`.
+    `value` is the value read or written by the access which reached the breakpoint (for an execution
+    breakpoint, the instruction itself). A single `=` is accepted as a comparison.
+    """
+    __slots__ = ("text", "predicate")
+
+    def __init__(self, text):
+        self.text = text
+        # "R0 = 5" is more natural than "R0 == 5" for people used to the assertions
+        source = re.sub(r"(?<![<>=!])=(?!=)", "==", text.strip())
+        try:
+            tree = ast.parse(source, mode="eval")
+        except SyntaxError:
+            raise ConditionSyntaxError("Condition invalide : {}".format(text))
+        for node in ast.walk(tree):
+            if not isinstance(node, _allowedNodes) or (isinstance(node, ast.Constant) and type(node.value) is not int):
+                raise ConditionSyntaxError("Condition invalide : {}".format(text))
+        tree.body = ast.Lambda(args=ast.arguments(posonlyargs=[], args=[ast.arg("regs"), ast.arg("value")],
+                                                  kwonlyargs=[], kw_defaults=[], defaults=[]),
+                               body=_NameRewriter().visit(_Wrapper().visit(tree.body)))
+        self.predicate = eval(compile(ast.fix_missing_locations(tree), "<condition>", "eval"), {"__builtins__": {}})
+
+    def check(self, regs, value):
+        """
+        Return True if the condition holds. A condition which cannot be evaluated (e.g. a comparison
+        of `value` on an access without value) holds, so that the execution stops.
+        """
+        try:
+            return bool(self.predicate(regs, value))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return True
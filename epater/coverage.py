@@ -0,0 +1,79 @@
+"""
+Execution coverage: which instructions were executed, and which way their branches went.
+
+The coverage is kept in bitmaps over the instruction sections (INTVEC and CODE, or the section of a
+snippet), one bit per instruction: bit `i` is the bit `i % 8` of the byte `i // 8`, for the
+instruction at `4*i`.
+"""
+
+import struct
+
+
+class Coverage:
+    """
+    Record the coverage of the program executed by a simulator, with an instrumentation hook (see
+    Simulator.addHook). Three bitmaps are kept:
+    - `executed`: the instruction was reached (its condition may not have been met)
+    - `taken`: the instruction modified PC (e.g. a branch was taken)
+    - `notTaken`: the condition of the instruction was not met (e.g. a branch was not taken)
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.size = sim.mem.getInstructionsEnd() // 4
+        nbytes = (self.size + 7) // 8
+        self.executed = bytearray(nbytes)
+        self.taken = bytearray(nbytes)
+        self.notTaken = bytearray(nbytes)
+        self.hooks = []
+
+    def clear(self):
+        for bitmap in (self.executed, self.taken, self.notTaken):
+            bitmap[:] = bytes(len(bitmap))
+
+    def attach(self):
+        if self.hooks:
+            return
+        executed, taken, notTaken = self.executed, self.taken, self.notTaken
+
+        def onExec(addr, instr, conditionMet):
+            byte, bit = addr >> 5, 1 << ((addr >> 2) & 7)
+            executed[byte] |= bit
+            if not conditionMet:
+                notTaken[byte] |= bit
+            elif instr.pcmodified:
+                taken[byte] |= bit
+
+        self.hooks = [self.sim.addHook("exec", onExec, 0, 4 * self.size)]
+
+    def detach(self):
+        for hook in self.hooks:
+            self.sim.removeHook(hook)
+        self.hooks = []
+
+    def clone(self, sim):
+        """
+        Return a copy of this coverage for `sim`, a copy of the simulator it is attached to
+        (the copy of the simulator has copies of our hooks, which we replace).
+        """
+        coverage = Coverage(sim)
+        coverage.executed[:], coverage.taken[:], coverage.notTaken[:] = self.executed, self.taken, self.notTaken
+        if self.hooks:
+            for hook in self.hooks:
+                sim.removeHook(hook)
+            coverage.attach()
+        return coverage
+
+    @staticmethod
+    def isSet(bitmap, addr):
+        return bool(bitmap[addr >> 5] & (1 << ((addr >> 2) & 7)))
+
+    def isConditionalBranch(self, addr):
+        """
+        Return True if the instruction at `addr` is a conditional B, BL or BX, or another conditional
+        instruction which modified PC at least once (e.g. MOVNE PC, LR).
+        """
+        word = struct.unpack("<I", self.sim.mem.get(addr, mayTriggerBkpt=False))[0]
+        if word >> 28 >= 0xE:
+            return False
+        isBranch = (word >> 25) & 0x7 == 0b101 or word & 0x0FFFFFF0 == 0x012FFF10
+        return isBranch or self.isSet(self.taken, addr)
@@ -0,0 +1,182 @@
+"""
+Memory-mapped peripherals.
+
+A device occupies one or more memory pages (see Memory.mapDevice). Its registers are 32 bits
+words; byte and half-word accesses read or modify a part of the register.
+
+Devices are not part of the history: stepping back does not restore their state (for
+instance, a character written to the UART stays written).
+"""
+
+from .scheduler import PeriodicEvent
+
+
+class Device:
+    """
+    Base class of the memory-mapped devices. Children classes define `registerNames`
+    (the name of each 32 bits register, in address order) and override `readRegister`
+    and `writeRegister`. When `peek` is True, the register is read by the interface or
+    the simulator itself (disassembly, assertions), so the read must not have side effects.
+    """
+    registerNames = ()
+
+    def __init__(self, baseAddr):
+        self.baseAddr = baseAddr
+        self.size = 4 * len(self.registerNames)
+        self.sim = None
+
+    def attach(self, simulator):
+        """
+        Called when the device is added to a simulator.
+        """
+        self.sim = simulator
+
+    def readRegister(self, idx, peek=False):
+        return 0
+
+    def writeRegister(self, idx, val):
+        pass
+
+    def read(self, offset, size, peek=False):
+        shift = 8 * (offset % 4)
+        return (self.readRegister(offset // 4, peek) >> shift) & ((1 << 8*size) - 1)
+
+    def write(self, offset, val, size):
+        idx, shift = offset // 4, 8 * (offset % 4)
+        if size != 4:
+            mask = ((1 << 8*size) - 1) << shift
+            val = (self.readRegister(idx, peek=True) & ~mask) | ((val << shift) & mask)
+        self.writeRegister(idx, val & 0xFFFFFFFF)
+
+
+class Timer(Device):
+    """
+    Cycle counter raising an interrupt each time it expires.
+
+    Registers:
+    - CTRL (+0x0): bit 0 enables the timer, bit 1 raises an IRQ each time it expires
+    - LOAD (+0x4): period of the timer, in cycles
+    - VALUE (+0x8, read-only): number of cycles before the next expiration
+    - STATUS (+0xC): bit 0 is set when the timer expires, writing 1 clears it
+    """
+    registerNames = ("CTRL", "LOAD", "VALUE", "STATUS")
+
+    def __init__(self, baseAddr):
+        super().__init__(baseAddr)
+        self.ctrl = 0
+        self.load = 0
+        self.status = 0
+        self.event = None
+
+    def _expire(self):
+        self.status = 1
+        if self.ctrl & 2:
+            self.sim.interruptRequests.add("IRQ")
+
+    def _restart(self):
+        if self.event is not None:
+            self.sim.removeEvent(self.event)
+            self.event = None
+        if self.ctrl & 1 and self.load > 0:
+            now = self.sim.history.cyclesCount
+            self.event = self.sim.addEvent(PeriodicEvent(now + self.load, self.load, self._expire))
+
+    def readRegister(self, idx, peek=False):
+        if idx == 0:
+            return self.ctrl
+        elif idx == 1:
+            return self.load
+        elif idx == 2:
+            if self.event is None:
+                return 0
+            return self.event.nextCycle(self.sim.history.cyclesCount) - self.sim.history.cyclesCount
+        return self.status
+
+    def writeRegister(self, idx, val):
+        if idx == 0:
+            restart = (val & 1) != (self.ctrl & 1)
+            self.ctrl = val & 3
+            if restart:
+                self._restart()
+        elif idx == 1:
+            self.load = val
+            self._restart()
+        elif idx == 3:
+            self.status &= ~val
+
+
+class UART(Device):
+    """
+    Serial console. Characters written by the program are appended to `output`, and the
+    characters given with `sendInput` can be read by the program.
+
+    Registers:
+    - DATA (+0x0): writing sends a character, reading receives one (0 if there is none)
+    - STATUS (+0x4, read-only): bit 0 is always set (ready to send), bit 1 is set if a
+      character can be read
+    """
+    registerNames = ("DATA", "STATUS")
+
+    def __init__(self, baseAddr):
+        super().__init__(baseAddr)
+        self.output = []
+        self.input = []
+
+    def sendInput(self, text):
+        self.input.extend(text)
+
+    def getOutput(self, clear=True):
+        """
+        Return the characters written by the program since the last call (or since the
+        beginning, if `clear` is False).
+        """
+        text = "".join(self.output)
+        if clear:
+            self.output = []
+        return text
+
+    def readRegister(self, idx, peek=False):
+        if idx == 0:
+            if not self.input:
+                return 0
+            return ord(self.input[0] if peek else self.input.pop(0)) & 0xFF
+        return 1 | (2 if self.input else 0)
+
+    def writeRegister(self, idx, val):
+        if idx == 0:
+            self.output.append(chr(val & 0xFF))
+
+
+class GPIO(Device):
+    """
+    General purpose inputs and outputs (e.g. a bank of 32 LEDs and 32 switches).
+
+    Registers:
+    - OUT (+0x0): state of the outputs
+    - IN (+0x4, read-only): state of the inputs, set by the interface with `setInputs`
+    """
+    registerNames = ("OUT", "IN")
+
+    def __init__(self, baseAddr):
+        super().__init__(baseAddr)
+        self.outputs = 0
+        self.inputs = 0
+
+    def setInputs(self, val):
+        self.inputs = val & 0xFFFFFFFF
+
+    def readRegister(self, idx, peek=False):
+        return self.outputs if idx == 0 else self.inputs
+
+    def writeRegister(self, idx, val):
+        if idx == 0:
+            self.outputs = val
+
+
+# Default location of each device type
+defaultAddresses = {"timer": 0x10000000,
+                    "uart": 0x10001000,
+                    "gpio": 0x10002000}
+deviceTypes = {"timer": Timer,
+               "uart": UART,
+               "gpio": GPIO}
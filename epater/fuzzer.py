@@ -0,0 +1,326 @@
+"""
+Random testing of the simulator semantics.
+
+Each test case is a random (but valid) program, produced from a seed: a preamble setting the
+flags and R0-R11 to random values, a sequence of random instructions (data processing, multiply,
+single and multiple transfers, swap, PSR transfers, forward branches and loops) and random initial
+data. The memory accesses are relative to R12, which always points to the data. The loops repeat a
+few instructions at most `maxIterations` times, counting the iterations in SP, and the other
+branches only go forward, so a case always ends on its last instruction ("fin B fin").
+
+A case is checked by running it with the translation of the hot loops (see translator.py), then:
+- the simulator must not crash (any exception other than an execution error) or report an error
+- a candidate must reach the same state, see lockstep.py: by default the interpreter without the
+  translation, or e.g. unicorn
+- stepping back to the beginning must restore the initial state
+
+A failing case is shrunk (its instructions are removed as long as it fails the same way) and can be
+saved as an assembly file, which is enough to reproduce it.
+"""
+
+import glob
+import os
+import random
+import traceback
+
+from .assembler import parse as ASMparser
+from .bytecodeinterpreter import BCInterpreter
+from .lockstep import LockstepChecker, UnicornBackend
+
+dataWords = 64
+destRegs = ["R{}".format(i) for i in range(12)]
+# R12 holds the address of the data, so it is only read
+srcRegs = destRegs + ["R12"]
+conditions = ["EQ", "NE", "CS", "CC", "MI", "PL", "VS", "VC", "HI", "LS", "GE", "LT", "GT", "LE"]
+shifts = {"LSL": (0, 31), "LSR": (1, 32), "ASR": (1, 32), "ROR": (1, 31)}
+# Maximum number of iterations of a loop, above the threshold of the translation of the hot loops
+maxIterations = 40
+
+
+class FuzzCase:
+    """
+    A test case: the random seeds and the instructions of the program (lines of assembly, labels
+    included). `source()` gives the whole program.
+    """
+    def __init__(self, flags, registers, data, body, seed=None):
+        self.flags, self.registers, self.data, self.body, self.seed = flags, registers, data, body, seed
+
+    @classmethod
+    def fromSeed(cls, seed, length=40):
+        rng = random.Random(seed)
+        flags = rng.getrandbits(4) << 28
+        registers = [_randomValue(rng) for i in range(len(destRegs))]
+        data = [_randomValue(rng) for i in range(dataWords)]
+        return cls(flags, registers, data, generateInstructions(rng, length), seed)
+
+    def withBody(self, body):
+        return FuzzCase(self.flags, self.registers, self.data, body, self.seed)
+
+    def source(self):
+        lines = ["SECTION INTVEC", "B main", "SECTION CODE", "main",
+                 "    LDR R0, =0x{:08X}".format(self.flags), "    MSR CPSR_flg, R0"]
+        lines.extend("    LDR {}, =0x{:08X}".format(reg, val) for reg, val in zip(destRegs, self.registers))
+        lines.append("    LDR R12, =donnees")
+        lines.extend(self.body)
+        lines.extend(("fin B fin", "SECTION DATA",
+                      "donnees ASSIGN32 " + ", ".join("0x{:08X}".format(val) for val in self.data)))
+        return lines
+
+
+def _randomValue(rng):
+    # Values close to the limits find more bugs in the flags than uniform ones
+    kind = rng.randrange(4)
+    if kind == 0:
+        return rng.choice((0, 1, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF, 0x80000001, 0xFFFFFFFE))
+    if kind == 1:
+        return rng.randrange(256)
+    return rng.getrandbits(32)
+
+
+def _cond(rng):
+    return rng.choice(conditions) if rng.random() < 0.3 else ""
+
+
+def _immediate(rng):
+    # An 8 bits value rotated by an even number of bits, so that it can be encoded
+    val, rot = rng.randrange(256), 2 * rng.randrange(16)
+    return "#0x{:X}".format(((val >> rot) | (val << (32 - rot))) & 0xFFFFFFFF if rot else val)
+
+
+def _operand2(rng):
+    kind = rng.randrange(5)
+    if kind == 0:
+        return _immediate(rng)
+    reg = rng.choice(srcRegs)
+    if kind == 1:
+        return reg
+    if kind == 2:
+        if rng.random() < 0.15:
+            return reg + ", RRX"
+        shift = rng.choice(tuple(shifts))
+        return "{}, {} #{}".format(reg, shift, rng.randint(*shifts[shift]))
+    return "{}, {} {}".format(reg, rng.choice(tuple(shifts)), rng.choice(srcRegs))
+
+
+def _dataOp(rng):
+    op = rng.choice(("AND", "EOR", "SUB", "RSB", "ADD", "ADC", "SBC", "RSC", "ORR", "BIC",
+                     "MOV", "MVN", "TST", "TEQ", "CMP", "CMN"))
+    if op in ("TST", "TEQ", "CMP", "CMN"):
+        return "{}{} {}, {}".format(op, _cond(rng), rng.choice(srcRegs), _operand2(rng))
+    s = "S" if rng.random() < 0.4 else ""
+    if op in ("MOV", "MVN"):
+        return "{}{}{} {}, {}".format(op, _cond(rng), s, rng.choice(destRegs), _operand2(rng))
+    return "{}{}{} {}, {}, {}".format(op, _cond(rng), s, rng.choice(destRegs), rng.choice(srcRegs), _operand2(rng))
+
+
+def _mulOp(rng):
+    s = "S" if rng.random() < 0.4 else ""
+    if rng.random() < 0.5:
+        # Rd and Rm must be different
+        rd, rm = rng.sample(destRegs, 2)
+        if rng.random() < 0.5:
+            return "MUL{}{} {}, {}, {}".format(_cond(rng), s, rd, rm, rng.choice(srcRegs))
+        return "MLA{}{} {}, {}, {}, {}".format(_cond(rng), s, rd, rm, rng.choice(srcRegs), rng.choice(srcRegs))
+    # RdLo, RdHi and Rm must be different
+    rdLo, rdHi, rm = rng.sample(destRegs, 3)
+    op = rng.choice(("UMULL", "UMLAL", "SMULL", "SMLAL"))
+    return "{}{}{} {}, {}, {}, {}".format(op, _cond(rng), s, rdLo, rdHi, rm, rng.choice(srcRegs))
+
+
+def _memOp(rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        op, size = rng.choice((("LDR", 4), ("STR", 4), ("LDR{}B", 1), ("STR{}B", 1)))
+        offset = rng.randrange(0, 4 * dataWords, size)
+    else:
+        op, size = rng.choice((("LDR{}H", 2), ("STR{}H", 2), ("LDR{}SH", 2), ("LDR{}SB", 1)))
+        # The offset of the halfword and signed transfers is limited to 8 bits
+        offset = rng.randrange(0, 256, size)
+    cond = _cond(rng)
+    # The assembler reads LDRHI as LDRH followed by I
+    while cond == "HI":
+        cond = _cond(rng)
+    op = op.format(cond) if "{}" in op else op + cond
+    reg = rng.choice(srcRegs) if op.startswith("STR") else rng.choice(destRegs)
+    return "{} {}, [R12, #{}]".format(op, reg, offset)
+
+
+def _multipleMemOp(rng):
+    regs = sorted(rng.sample(range(12), rng.randint(1, 6)))
+    # Only the increasing modes, the data being after R12
+    op = rng.choice(("LDM", "STM")) + rng.choice(("IA", "IB")) + _cond(rng)
+    return "{} R12, {{{}}}".format(op, ", ".join("R{}".format(r) for r in regs))
+
+
+def _swapOp(rng):
+    rd, rm = rng.choice(destRegs), rng.choice(destRegs)
+    return "SWP{}{} {}, {}, [R12]".format(_cond(rng), rng.choice(("", "B")), rd, rm)
+
+
+def _psrOp(rng):
+    return "MRS{} {}, CPSR".format(_cond(rng), rng.choice(destRegs))
+
+
+generators = ((_dataOp, 10), (_mulOp, 2), (_memOp, 4), (_multipleMemOp, 1), (_swapOp, 1), (_psrOp, 1))
+
+
+def generateInstructions(rng, length):
+    """
+    Return a list of `length` random instructions (with their labels). Some sequences of instructions
+    are loops, repeated between 2 and `maxIterations` times, and the other branches only go forward.
+    """
+    functions, weights = zip(*generators)
+    instructions = [rng.choices(functions, weights)[0](rng) for i in range(length)]
+    # Loops do not overlap: loopOf[i] is the first instruction of the loop containing the instruction i
+    loops, loopOf, i = {}, {}, 0
+    while i < length:
+        if rng.random() < 0.05:
+            end = min(length, i + rng.randint(1, 8))
+            loops[i] = (end, rng.randint(2, maxIterations))
+            loopOf.update((j, i) for j in range(i, end))
+            i = end
+        else:
+            i += 1
+    lines, labels = [], {}
+    for i in range(length):
+        if i in labels:
+            lines.append(labels[i])
+        if i in loops:
+            # The label of a branch to the loop is before the initialization of its counter
+            lines.extend(("    MOV SP, #{}".format(loops[i][1]), "boucle{}".format(i)))
+        if i < length - 1 and rng.random() < 0.08:
+            # Branch to a following instruction, which is not inside another loop (its counter would
+            # not be initialized)
+            targets = [t for t in range(i + 1, length) if loopOf.get(t, t) in (t, loopOf.get(i))]
+            target = rng.choice(targets)
+            labels.setdefault(target, "etiquette{}".format(target))
+            branch = rng.choice(("B", "BL"))
+            lines.append("    {}{} {}".format(branch, _cond(rng), labels[target]))
+        lines.append("    " + instructions[i])
+        if i in loopOf and loops[loopOf[i]][0] == i + 1:
+            lines.extend(("    SUBS SP, SP, #1", "    BNE boucle{}".format(loopOf[i])))
+    return lines
+
+
+def _state(interpreter):
+    sim = interpreter.sim
+    memory = {sec: sim.mem.readRange(start, sim.mem.endAddr[sec] - start) for sec, start in sim.mem.startAddr.items()}
+    return sim.regs.getAllRegisters(), sim.regs.regCPSR, memory
+
+
+def checkProgram(lines, candidate=None):
+    """
+    Run a program and return None if it passes the checks, or a (kind, description) tuple, the kind
+    being "assembler" (the program is not valid), "crash", "error", "stepback" or "divergence".
+
+    :param candidate: None (to compare with the interpreter without translation), or a function
+                      returning the backend to compare with the simulator (see lockstep.py) from a
+                      BCInterpreter in the initial state
+    """
+    bytecode, addr2line, line2addr, assertions, snippetMode, errors = ASMparser(lines)
+    if errors:
+        return ("assembler", str(errors))
+    try:
+        interpreter = BCInterpreter(bytecode, addr2line, assertions, snippetMode=snippetMode)
+        interpreter.setTranslation(True)
+        initial = _state(interpreter)
+        # Every instruction is executed at most maxIterations times, then the program loops on "fin B fin"
+        count = maxIterations * len(addr2line) + 1
+        # The history must keep all the instructions, to step back to the beginning
+        history = interpreter.sim.history
+        history.maxlen = count + 1
+        history.clear()
+        checker = LockstepChecker(interpreter, (candidate or interpreterCandidate)(interpreter.clone()), interval=count)
+        divergence = checker.run(count)
+        if divergence is not None:
+            return ("divergence", str(divergence))
+        if checker.reference.errors:
+            return ("error", str(checker.reference.errors))
+
+        # A translated region is a single entry of the history
+        interpreter.stepBack(len(history.history))
+        if interpreter.errorsPending is None and _state(interpreter) != initial:
+            return ("stepback", "Le retour en arrière ne restaure pas l'état initial")
+    except Exception as err:
+        return ("crash", "".join(traceback.format_exception_only(type(err), err)).strip())
+    return None
+
+
+def shrink(case, kind, candidate=None):
+    """
+    Remove as many instructions of a failing case as possible while it still fails with the same
+    kind of failure, and return the smallest case found.
+    """
+    body = list(case.body)
+    chunk = max(len(body) // 2, 1)
+    while True:
+        i, removed = 0, False
+        while i < len(body):
+            smaller = body[:i] + body[i+chunk:]
+            failure = checkProgram(case.withBody(smaller).source(), candidate)
+            if failure is not None and failure[0] == kind:
+                body, removed = smaller, True
+            else:
+                i += chunk
+        if chunk == 1 and not removed:
+            break
+        if not removed:
+            chunk = max(chunk // 2, 1)
+    return case.withBody(body)
+
+
+def saveCase(case, failure, directory):
+    """
+    Save a case in `directory` as an assembly file, with the failure as a comment. Return its path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "cas_{}_{}.asm".format(failure[0], case.seed))
+    with open(path, "w") as f:
+        f.write("; Graine {}, échec : {}\n".format(case.seed, failure[0]))
+        for line in failure[1].splitlines():
+            f.write("; {}\n".format(line))
+        f.write("\n".join(case.source()) + "\n")
+    return path
+
+
+def replayCorpus(directory, candidate=None):
+    """
+    Check again all the cases saved in `directory`, and return a dictionary associating the path of
+    each one still failing to its failure.
+    """
+    failures = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.asm"))):
+        with open(path) as f:
+            failure = checkProgram(f.read().splitlines(), candidate)
+        if failure is not None:
+            failures[path] = failure
+    return failures
+
+
+def fuzz(count, firstSeed=0, length=40, candidate=None, corpus=None):
+    """
+    Check `count` cases (the seeds firstSeed, firstSeed+1, ...), and return a list of (case, failure)
+    for the failing ones, shrunk (and saved in the directory `corpus` if it is given).
+    """
+    failures = []
+    for seed in range(firstSeed, firstSeed + count):
+        case = FuzzCase.fromSeed(seed, length)
+        failure = checkProgram(case.source(), candidate)
+        if failure is None:
+            continue
+        if failure[0] != "assembler":
+            case = shrink(case, failure[0], candidate)
+            failure = checkProgram(case.source(), candidate)
+        failures.append((case, failure))
+        if corpus is not None:
+            saveCase(case, failure, corpus)
+    return failures
+
+
+def interpreterCandidate(interpreter):
+    interpreter.setTranslation(False)
+    return interpreter
+
+
+def unicornCandidate(interpreter):
+    return UnicornBackend(interpreter)
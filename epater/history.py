@@ -1,4 +1,5 @@
-from collections import deque
+from bisect import bisect_left
+from collections import deque, defaultdict
 
 class History:
 
@@ -9,6 +10,10 @@ class History:
         """
         self.maxlen = historyMaxLength
         self.members = {}
+        # If False, the changes since the checkpoint are not aggregated at each change, but
+        # computed when requested by comparing the components with a snapshot (see `useSnapshots`)
+        self.trackCheckpoint = True
+        self.snapshot = {}
         self.clear()
 
     def clear(self):
@@ -16,11 +21,28 @@ class History:
         Reset the history (but do not unregister the components)
         """
         self.cyclesCount = 1 
+        # Number of instructions executed, which differs from the number of cycles when the timing
+        # model or the caches add cycles (see `addCycles`)
+        self.instructionsCount = 0
         self.ckpt = {}
         self.history = deque(maxlen=self.maxlen)
+        # Number of instructions aggregated in each history entry (usually 1, see `addCycles`)
+        self.weights = deque(maxlen=self.maxlen)
+        self.weights.append(1)
+        self.instrWeights = deque(maxlen=self.maxlen)
+        self.instrWeights.append(0)
+        # Serial number of each history entry, never reused (see `findLastChange`)
+        self.serials = deque(maxlen=self.maxlen)
+        self.serials.append(0)
+        self.nextSerial = 1
+        # Maps (component class, location) to the serial numbers of the entries which modified this
+        # location. It is updated lazily, when a query is made, and never includes the last entry
+        self.changeIndex = defaultdict(list)
+        self.indexedSerial = -1
+        self.prunedSerial = 0
         # We add a first pseudo-cycle in case of a modification before the first cycle
         self.history.append({k:{} for k in self.members})
-        self.ckpt = {k:{} for k in self.members}
+        self.setCheckpoint()
 
     def registerObject(self, obj):
         """
@@ -36,7 +58,30 @@ class History:
         Must be called at the _beginning_ of each step (before any changes).
         """
         self.history.append({k:{} for k in self.members})
+        self.weights.append(1)
+        self.instrWeights.append(1)
+        self.serials.append(self.nextSerial)
+        self.nextSerial += 1
         self.cyclesCount += 1
+        self.instructionsCount += 1
+
+    def addCycles(self, count):
+        """
+        Account for `count` additional cycles in the current step (e.g. taken by a slow
+        instruction), which are reverted by the call to `stepBack` reverting the step.
+        """
+        self.weights[-1] += count
+        self.cyclesCount += count
+
+    def addInstructions(self, count):
+        """
+        Account for `count` additional instructions, of one cycle each, in the current step.
+        Used when many instructions are executed at once (e.g. by a translated region), in
+        which case they are reverted together by a single call to `stepBack`.
+        """
+        self.addCycles(count)
+        self.instrWeights[-1] += count
+        self.instructionsCount += count
 
     def restartCycle(self):
         """
@@ -44,28 +89,30 @@ class History:
         Useful for breakpoints, where we actually want to resume the execution
         at the same instruction it was stopped.
         """
-        self.history.pop()
-        self.cyclesCount -= 1
+        self._unindex(self.history.pop(), self.serials.pop())
+        self.cyclesCount -= self.weights.pop()
+        self.instructionsCount -= self.instrWeights.pop()
 
     def signalChange(self, obj, change):
         """
         Called by a component to signal a change. The name identifier must be
         the same as the one used with `registerObject`.
         """
+        cycleChanges = self.history[-1][obj.__class__]
         for name, val in change.items():
-            previousVal = self.history[-1][obj.__class__].get(name)
+            previousVal = cycleChanges.get(name)
             if previousVal:
                 # If we already set a value for this key in the current cycle,
                 # we want to keep the original old value. In other terms, if
                 # the first change was (oldval, newval) and there is another change
                 # (newval, newnewval), we want to keep (oldval, newnewval) as the
                 # change, so that a step back will revert everything.
-                newVal = (previousVal[0], val[1])
-                self.history[-1][obj.__class__][name] = newVal
+                cycleChanges[name] = (previousVal[0], val[1])
             else:
-                self.history[-1][obj.__class__].update(change)
-            # We always want to update the checkpoint (so that the interface
-            # is always up to date)
+                cycleChanges[name] = val
+        # We always want to update the checkpoint (so that the interface
+        # is always up to date), unless it is computed from snapshots
+        if self.trackCheckpoint:
             self.ckpt[obj.__class__].update(change)
 
     def stepBack(self):
@@ -79,11 +126,13 @@ class History:
             # We reached the end of the history
             raise RuntimeError("Fin de l'historique atteinte, impossible de remonter plus haut!")
 
+        self._unindex(hist, self.serials.pop())
         for name,obj in self.members.items():
             obj.stepBack(hist[name])
         
-        self.cyclesCount -= 1
-        if self.cyclesCount == 0:
+        self.cyclesCount -= self.weights.pop()
+        self.instructionsCount -= self.instrWeights.pop()
+        if self.cyclesCount <= 0:
             # We ensure that we always have at least one history struct in our deque
             self.clear()
 
@@ -92,9 +141,81 @@ class History:
         Reset the checkpoint so that we aggregate the changes from this point.
         """
         self.ckpt = {k:{} for k in self.members}
-    
+        if not self.trackCheckpoint:
+            self.snapshot = {k: obj.getSnapshot() for k, obj in self.members.items()}
+
+    def useSnapshots(self, enabled):
+        """
+        Choose how the changes since the last checkpoint are computed. By default, they are
+        aggregated at each change. If `enabled` is True, the components are instead compared with
+        a snapshot taken at the checkpoint, which is faster when there are many changes between
+        two checkpoints (but only reports the values which actually changed).
+        """
+        self.trackCheckpoint = not enabled
+        self.setCheckpoint()
+
     def getDiffFromCheckpoint(self):
         """
         Return all the aggregated changes since the last checkpoint
         """
-        return self.ckpt
\ No newline at end of file
+        if not self.trackCheckpoint:
+            return {k: obj.diffSnapshot(self.snapshot[k]) for k, obj in self.members.items()}
+        return self.ckpt
+
+    def _unindex(self, entry, serial):
+        # Remove a history entry from the index, if it was indexed
+        if serial > self.indexedSerial:
+            return
+        for cls, changes in entry.items():
+            obj = self.members[cls]
+            for key in changes:
+                for location in obj.getLocations(key):
+                    serials = self.changeIndex.get((cls, location))
+                    if serials and serials[-1] == serial:
+                        serials.pop()
+        self.indexedSerial = serial - 1
+
+    def _updateIndex(self):
+        # Index the entries added since the last query (except the last one, which may still change)
+        first = len(self.serials) - 1
+        while first > 0 and self.serials[first - 1] > self.indexedSerial:
+            first -= 1
+        for idx in range(first, len(self.serials) - 1):
+            serial = self.serials[idx]
+            for cls, changes in self.history[idx].items():
+                obj = self.members[cls]
+                for key in changes:
+                    for location in obj.getLocations(key):
+                        serials = self.changeIndex[(cls, location)]
+                        if not serials or serials[-1] != serial:
+                            serials.append(serial)
+            self.indexedSerial = serial
+
+        # The entries removed from the history (because of its maximum length) are regularly
+        # removed from the index, so that it does not grow forever
+        oldest = self.serials[0]
+        if oldest - self.prunedSerial > self.maxlen:
+            for location in list(self.changeIndex):
+                serials = self.changeIndex[location]
+                del serials[:bisect_left(serials, oldest)]
+                if not serials:
+                    del self.changeIndex[location]
+            self.prunedSerial = oldest
+
+    def findLastChange(self, obj, location):
+        """
+        Find the last history entry which modified `location` (as given by the `getLocations` method
+        of the component `obj`). Return a (count, cycle) tuple, where `count` is the number of steps back
+        needed to revert this change and `cycle` the cycle at which it happened, or None if this location
+        was not modified in the history.
+        """
+        cls = obj.__class__
+        if any(location in obj.getLocations(key) for key in self.history[-1][cls]):
+            return 1, self.cyclesCount
+
+        self._updateIndex()
+        serials = self.changeIndex.get((cls, location))
+        if not serials or serials[-1] < self.serials[0]:
+            return None
+        count = len(self.serials) - bisect_left(self.serials, serials[-1])
+        return count, self.cyclesCount - sum(self.weights[-i] for i in range(1, count))
@@ -0,0 +1,269 @@
+"""
+Lockstep differential checking: run two execution paths side by side (e.g. the reference
+interpreter and the same program with the translation enabled, or with unicorn), compare their
+states at regular intervals and, when they differ, find the first instruction after which they
+diverge.
+
+An execution path is a backend with the following methods:
+- run(count): execute `count` instructions (less if an error stops the execution)
+- getRegisters(): dictionary with 'regs' (the 16 registers of the current mode, PC being the
+  address of the next instruction), 'cpsr', 'spsr' (None in User mode) and 'errors' (the
+  execution errors which stopped the last run, or None)
+- dirtyPages(): numbers of the memory pages which may differ from the program loaded
+- readMemory(addr, size): content of the memory, without triggering the breakpoints
+- clone(): an independent backend in the same state
+"""
+
+from .components import Memory
+
+try:
+    import unicorn
+    import unicorn.arm_const as ARM
+except ImportError:
+    unicorn = None
+
+
+class InterpreterBackend:
+    """
+    Backend running a BCInterpreter, with its own configuration (translation, predecoding, ...).
+    """
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.errors = None
+
+    def run(self, count):
+        interpreter = self.interpreter
+        sim = interpreter.sim
+        maxit, sim.maxit = sim.maxit, count
+        try:
+            interpreter.execute('run')
+        finally:
+            sim.maxit = maxit
+        self.errors = None
+        if interpreter.errorsPending is not None:
+            self.errors = list(interpreter.errorsPending)
+            interpreter.errorsPending = None
+
+    def getRegisters(self):
+        regs = self.interpreter.sim.regs
+        bank = regs.banks[regs.currentMode]
+        values = [bank[i].val for i in range(16)]
+        values[15] -= self.interpreter.sim.pcoffset
+        spsr = None if regs.currentMode == "User" else bank[16].val
+        return {"regs": values, "cpsr": regs.regCPSR, "spsr": spsr, "errors": self.errors}
+
+    def dirtyPages(self):
+        return self.interpreter.sim.mem.dirtyPages
+
+    def readMemory(self, addr, size):
+        return self.interpreter.sim.mem.readRange(addr, size)
+
+    def clone(self):
+        return InterpreterBackend(self.interpreter.clone())
+
+    def getLine(self, addr):
+        lines = self.interpreter.addr2line.get(addr, ())
+        return lines[-1] if len(lines) > 0 else None
+
+
+class UnicornBackend:
+    """
+    Backend running the unicorn emulator (only available if it is installed), starting from the
+    current state of `interpreter` (memory and registers of the current mode). The interrupt
+    sources and the devices of the interpreter are not simulated.
+    """
+    pageShift = Memory.pageShift
+    regIds = () if unicorn is None else tuple(getattr(ARM, "UC_ARM_REG_R{}".format(i)) for i in range(16))
+
+    def __init__(self, interpreter=None, uc=None, sections=None):
+        if unicorn is None:
+            raise RuntimeError("Le module unicorn n'est pas installé")
+        self.errors = None
+        if uc is not None:
+            self.uc, self.sections = uc, sections
+            return
+        sim = interpreter.sim
+        self.sections = [(start, sim.mem.endAddr[sec]) for sec, start in sim.mem.startAddr.items()
+                         if sim.mem.endAddr[sec] > start]
+        self.uc = self._map()
+        for start, end in self.sections:
+            self.uc.mem_write(start, sim.mem.readRange(start, end - start))
+        state = InterpreterBackend(interpreter).getRegisters()
+        # Writing CPSR first selects the bank of the current mode
+        self.uc.reg_write(ARM.UC_ARM_REG_CPSR, state["cpsr"])
+        for regId, val in zip(self.regIds, state["regs"]):
+            self.uc.reg_write(regId, val)
+        if state["spsr"] is not None:
+            self.uc.reg_write(ARM.UC_ARM_REG_SPSR, state["spsr"])
+
+    def _map(self):
+        uc = unicorn.Uc(unicorn.UC_ARCH_ARM, unicorn.UC_MODE_ARM)
+        pageSize = 1 << self.pageShift
+        for number in sorted(self._pages()):
+            uc.mem_map(number << self.pageShift, pageSize)
+        return uc
+
+    def _pages(self):
+        return {number for start, end in self.sections
+                for number in range(start >> self.pageShift, ((end - 1) >> self.pageShift) + 1)}
+
+    def run(self, count):
+        self.errors = None
+        try:
+            # The end address is never reached, the count stops the emulation
+            self.uc.emu_start(self.uc.reg_read(ARM.UC_ARM_REG_PC), 0xFFFFFFFF, count=count)
+        except unicorn.UcError as err:
+            self.errors = [("unicorn", str(err), None)]
+
+    def getRegisters(self):
+        cpsr = self.uc.reg_read(ARM.UC_ARM_REG_CPSR)
+        spsr = None if cpsr & 0x1F == 0x10 else self.uc.reg_read(ARM.UC_ARM_REG_SPSR)
+        return {"regs": [self.uc.reg_read(regId) for regId in self.regIds], "cpsr": cpsr, "spsr": spsr,
+                "errors": self.errors}
+
+    def dirtyPages(self):
+        # unicorn does not tell which pages were written
+        return self._pages()
+
+    def readMemory(self, addr, size):
+        return bytes(self.uc.mem_read(addr, size))
+
+    def clone(self):
+        uc = self._map()
+        for start, end in self.sections:
+            uc.mem_write(start, bytes(self.uc.mem_read(start, end - start)))
+        uc.context_restore(self.uc.context_save())
+        return UnicornBackend(uc=uc, sections=self.sections)
+
+
+class Divergence:
+    """
+    First instruction after which two execution paths differ.
+
+    :ivar index: number of instructions executed when the states started to differ (the diverging
+                 instruction is the index-th one since the beginning of the check)
+    :ivar addr: address of the diverging instruction (in the reference)
+    :ivar line: its source line, if known
+    :ivar differences: list of (location, reference value, candidate value) tuples, where location is
+                       a register name ("R0" to "R15", "CPSR", "SPSR"), "errors" or a memory address
+    """
+    def __init__(self, index, addr, line, differences):
+        self.index, self.addr, self.line, self.differences = index, addr, line, differences
+
+    def __str__(self):
+        where = "ligne {}".format(self.line + 1) if self.line is not None else "adresse 0x{:08x}".format(self.addr)
+        diffs = []
+        for location, ref, cand in self.differences:
+            if isinstance(location, int):
+                location = "0x{:08x}".format(location)
+            diffs.append("{} : {} / {}".format(location, ref, cand))
+        return "Divergence à l'instruction {} ({}) : {}".format(self.index, where, ", ".join(diffs))
+
+
+class LockstepChecker:
+    """
+    Run a candidate execution path next to a reference interpreter, comparing their registers,
+    CPSR, SPSR and written memory every `interval` instructions. The paths should not use devices,
+    since the interpreter copies (used for the bisection) do not copy them.
+
+    :param reference: the reference BCInterpreter
+    :param candidate: the BCInterpreter (or backend, e.g. UnicornBackend) to check
+    :param interval: number of instructions between two comparisons
+    """
+    def __init__(self, reference, candidate, interval=1000):
+        self.reference = InterpreterBackend(reference)
+        self.candidate = InterpreterBackend(candidate) if hasattr(candidate, "sim") else candidate
+        self.interval = interval
+        # Number of instructions executed by both paths since the beginning of the check
+        self.executed = 0
+
+    def compare(self, reference=None, candidate=None):
+        """
+        Return the list of the differences between the states of two backends (by default, the
+        reference and the candidate), as in Divergence.differences.
+        """
+        reference = reference or self.reference
+        candidate = candidate or self.candidate
+        differences = []
+        refRegs, candRegs = reference.getRegisters(), candidate.getRegisters()
+        for i, (a, b) in enumerate(zip(refRegs["regs"], candRegs["regs"])):
+            if a != b:
+                differences.append(("R{}".format(i), a, b))
+        for key, name in (("cpsr", "CPSR"), ("spsr", "SPSR"), ("errors", "errors")):
+            if refRegs[key] != candRegs[key]:
+                differences.append((name, refRegs[key], candRegs[key]))
+
+        for number in sorted(set(reference.dirtyPages()) | set(candidate.dirtyPages())):
+            for start, end in self._pageRanges(number):
+                refMem, candMem = reference.readMemory(start, end - start), candidate.readMemory(start, end - start)
+                if refMem != candMem:
+                    differences.extend((start + i, a, b) for i, (a, b) in enumerate(zip(refMem, candMem)) if a != b)
+        return differences
+
+    def _pageRanges(self, number):
+        # Parts of the page `number` which belong to the sections of the reference
+        mem = self.reference.interpreter.sim.mem
+        pageAddr, pageEnd = number << Memory.pageShift, (number + 1) << Memory.pageShift
+        for sec, start in mem.startAddr.items():
+            lo, hi = max(start, pageAddr), min(mem.endAddr[sec], pageEnd)
+            if lo < hi:
+                yield lo, hi
+
+    def run(self, count):
+        """
+        Execute `count` instructions on both paths, and return None if they agree, or the first
+        Divergence. After a divergence, the paths are left in the state where they were compared.
+        """
+        remaining = count
+        while remaining > 0:
+            step = min(self.interval, remaining)
+            checkpoint = (self.reference.clone(), self.candidate.clone())
+            self.reference.run(step)
+            self.candidate.run(step)
+            differences = self.compare()
+            if differences:
+                return self._bisect(checkpoint, step)
+            self.executed += step
+            remaining -= step
+            if self.reference.getRegisters()["errors"] is not None:
+                # Both paths stopped on the same error
+                break
+        return None
+
+    def _bisect(self, checkpoint, step):
+        """
+        Find the first diverging instruction among the `step` instructions following `checkpoint`
+        (the states of both paths when they last agreed). Each attempt runs both paths from the
+        checkpoint, as the check did: a translated block only runs when the instruction budget
+        allows the whole block, so when the fault is in such a block, the divergence is found at
+        the end of the block.
+        """
+        good, bad = 0, step
+        # States of both paths after `bad` instructions, where they differ
+        diverged = (self.reference, self.candidate)
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            states = self._replay(checkpoint, middle)
+            if self.compare(*states):
+                bad, diverged = middle, states
+            else:
+                good = middle
+
+        reference, candidate = self._replay(checkpoint, good)
+        addr = reference.getRegisters()["regs"][15]
+        reference.run(1)
+        candidate.run(1)
+        differences = self.compare(reference, candidate)
+        if not differences:
+            # The divergence does not happen one instruction at a time (e.g. translated block)
+            differences = self.compare(*diverged)
+        getLine = getattr(reference, "getLine", None)
+        return Divergence(self.executed + bad, addr, getLine(addr) if getLine else None, differences)
+
+    def _replay(self, checkpoint, count):
+        # Copies of both paths, `count` instructions after `checkpoint`
+        reference, candidate = checkpoint[0].clone(), checkpoint[1].clone()
+        if count > 0:
+            reference.run(count)
+            candidate.run(count)
+        return reference, candidate
@@ -0,0 +1,147 @@
+"""
+Minimal metrics (counters, gauges and histograms) exported in the Prometheus text format, so that
+the web server can be monitored without additional dependencies.
+"""
+
+import math
+import time
+
+
+def _formatLabels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def _formatValue(val):
+    if val == math.inf:
+        return "+Inf"
+    return repr(float(val)) if isinstance(val, float) else str(val)
+
+
+class Metric:
+    """
+    A metric, with a value for each combination of labels (keyword arguments of the methods updating it).
+    """
+    type = None
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.values = {}
+
+    def samples(self):
+        """
+        Iterate over the (name suffix, labels, value) of the samples of the metric.
+        """
+        for labels, val in sorted(self.values.items()):
+            yield "", labels, val
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, val in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _formatLabels(labels), _formatValue(val)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A gauge, either set explicitly or computed when the metrics are rendered by `function`, which
+    returns a value, or a dictionary associating a tuple of (label, value) pairs to each value.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def set(self, val, **labels):
+        self.values[tuple(sorted(labels.items()))] = val
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            self.values = values if isinstance(values, dict) else {(): values}
+        return super().samples()
+
+
+class Rate(Gauge):
+    """
+    A gauge giving the number of units per second by which `counter` increased (all labels together)
+    since the previous rendering, or since its creation. `clock` returns the current time in seconds.
+    """
+    def __init__(self, name, help, counter, clock=time.monotonic):
+        super().__init__(name, help, self._compute)
+        self.counter, self.clock = counter, clock
+        self.lastTime, self.lastTotal = clock(), sum(counter.values.values())
+
+    def _compute(self):
+        now, total = self.clock(), sum(self.counter.values.values())
+        rate = (total - self.lastTotal) / max(now - self.lastTime, 1e-9)
+        self.lastTime, self.lastTotal = now, total
+        return rate
+
+
+class Histogram(Metric):
+    type = "histogram"
+    defaultBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, buckets=defaultBuckets):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, val, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            # Count of each bucket (not cumulated), sum and count
+            self.values[key] = [[0] * len(self.buckets), 0, 0]
+        counts, total, count = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if val <= bound:
+                counts[i] += 1
+                break
+        self.values[key][1:] = total + val, count + 1
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulated = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulated += n
+                yield "_bucket", labels + (("le", _formatValue(bound)),), cumulated
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Registry:
+    """
+    A set of metrics, rendered together.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def rate(self, name, help, counter, clock=time.monotonic):
+        return self.add(Rate(name, help, counter, clock))
+
+    def histogram(self, name, help, buckets=Histogram.defaultBuckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
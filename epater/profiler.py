@@ -0,0 +1,93 @@
+from array import array
+
+
+class Profiler:
+    """
+    Count, for each instruction, the number of times it was executed, the number of times its
+    condition was not met and the number of bytes it read and wrote. The counters are arrays
+    indexed by `addr // 4`, updated by instrumentation hooks (see Simulator.addHook), so the
+    simulation is not slowed down while the profiler is detached.
+
+    The counters are not restored when stepping back.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        # Instructions are in the INTVEC and CODE sections (or the section of a snippet), from address 0
+        self.size = sim.mem.getInstructionsEnd() // 4
+        self.executions = array('L', [0]) * self.size
+        self.conditionFalse = array('L', [0]) * self.size
+        self.memRead = array('L', [0]) * self.size
+        self.memWrite = array('L', [0]) * self.size
+        self.hooks = []
+
+    def clear(self):
+        # The arrays are modified in place, since the hooks keep a reference on them
+        for counters in (self.executions, self.conditionFalse, self.memRead, self.memWrite):
+            counters[:] = array('L', [0]) * self.size
+
+    def attach(self):
+        if self.hooks:
+            return
+        sim = self.sim
+        pcReg, pcoffset, size = sim.regs.banks['User'][15], sim.pcoffset, self.size
+        executions, conditionFalse = self.executions, self.conditionFalse
+        memRead, memWrite = self.memRead, self.memWrite
+
+        def onExec(addr, instr, executed):
+            executions[addr >> 2] += 1
+            if not executed:
+                conditionFalse[addr >> 2] += 1
+
+        # During the execution of an instruction, PC contains its address plus the prefetch offset
+        def onRead(addr, accessSize, value):
+            idx = (pcReg.val - pcoffset) >> 2
+            if idx < size:
+                memRead[idx] += accessSize
+
+        def onWrite(addr, accessSize, value):
+            idx = (pcReg.val - pcoffset) >> 2
+            if idx < size:
+                memWrite[idx] += accessSize
+
+        self.hooks = [sim.addHook("exec", onExec, 0, 4 * size),
+                      sim.addHook("memread", onRead),
+                      sim.addHook("memwrite", onWrite)]
+
+    def detach(self):
+        for hook in self.hooks:
+            self.sim.removeHook(hook)
+        self.hooks = []
+
+    def clone(self, sim):
+        """
+        Return a copy of this profiler for `sim`, a copy of the simulator it is attached to
+        (the copy of the simulator has copies of our hooks, which we replace).
+        """
+        profiler = Profiler(sim)
+        for name in ("executions", "conditionFalse", "memRead", "memWrite"):
+            getattr(profiler, name)[:] = getattr(self, name)
+        if self.hooks:
+            for hook in self.hooks:
+                sim.removeHook(hook)
+            profiler.attach()
+        return profiler
+
+    def getCounters(self):
+        """
+        Return a dictionary associating the address of each instruction executed at least once to a
+        (executions, condition not met, bytes read, bytes written) tuple.
+        """
+        return {4*idx: (count, self.conditionFalse[idx], self.memRead[idx], self.memWrite[idx])
+                for idx, count in enumerate(self.executions) if count}
+
+    def getLineCounters(self, addr2line):
+        """
+        Same as getCounters, by source line (using the mapping produced by the assembler).
+        """
+        lines = {}
+        for addr, counters in self.getCounters().items():
+            if len(addr2line.get(addr, ())) == 0:
+                continue
+            line = addr2line[addr][-1]
+            lines[line] = tuple(a + b for a, b in zip(lines.get(line, (0, 0, 0, 0)), counters))
+        return lines
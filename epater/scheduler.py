@@ -0,0 +1,88 @@
+import heapq
+import itertools
+
+
+class PeriodicEvent:
+    """
+    An event happening for the first time at cycle `first`, then every `period` cycles.
+    If `period` is 0, the event only happens once.
+    Each time the event happens, `callback` is called without arguments.
+    """
+    def __init__(self, first, period, callback):
+        self.first = first
+        self.period = period
+        self.callback = callback
+
+    def nextCycle(self, cycle):
+        """
+        Return the first cycle strictly after `cycle` at which this event happens, or None if
+        it will not happen anymore.
+        """
+        if cycle < self.first:
+            return self.first
+        if self.period <= 0:
+            return None
+        return cycle + self.period - (cycle - self.first) % self.period
+
+
+class EventScheduler:
+    """
+    Keeps the events (interrupts, timers, etc.) in a priority queue ordered by the cycle at
+    which they will happen next. The simulator only has to compare the current cycle with
+    `nextCycle` to know if something has to be done.
+
+    The events are stateless with respect to time: when the simulator goes back in time (step
+    back, reset), `reschedule` recomputes the queue from the current cycle.
+    """
+    def __init__(self):
+        self.events = []
+        self.queue = []
+        self.nextCycle = float("inf")
+        self._counter = itertools.count()
+
+    def __bool__(self):
+        return len(self.events) > 0
+
+    def addEvent(self, event, currentCycle):
+        self.events.append(event)
+        cycle = event.nextCycle(currentCycle)
+        if cycle is not None:
+            heapq.heappush(self.queue, (cycle, next(self._counter), event))
+            self.nextCycle = self.queue[0][0]
+
+    def removeEvent(self, event, currentCycle):
+        self.events.remove(event)
+        self.reschedule(currentCycle)
+
+    def clear(self):
+        self.events = []
+        self.reschedule(0)
+
+    def reschedule(self, currentCycle):
+        """
+        Rebuild the queue, considering that all the events up to `currentCycle` (included)
+        already happened.
+        """
+        self.queue = []
+        for event in self.events:
+            cycle = event.nextCycle(currentCycle)
+            if cycle is not None:
+                self.queue.append((cycle, next(self._counter), event))
+        heapq.heapify(self.queue)
+        self.nextCycle = self.queue[0][0] if self.queue else float("inf")
+
+    def popDueEvents(self, currentCycle):
+        """
+        Return the list of the events happening at `currentCycle` (or before, if they were
+        missed), and schedule their next occurrence.
+        """
+        due = []
+        queue = self.queue
+        while queue and queue[0][0] <= currentCycle:
+            _, _, event = heapq.heappop(queue)
+            due.append(event)
+            cycle = event.nextCycle(currentCycle)
+            if cycle is not None:
+                heapq.heappush(queue, (cycle, next(self._counter), event))
+        self.nextCycle = queue[0][0] if queue else float("inf")
+        return due
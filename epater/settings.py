@@ -10,7 +10,16 @@ _settings = {"PCbehavior": "+8",            # Can be "+0", "+8"
              "runmaxit": 10000,             # Maximum number of non-stop iterations
              "maxhistorylength": 1000,      # Maximum history depth
              "fillValue": 0xFF,             # Value used to fill non-initialized (but declared) memory
-             "maxtotalmem": 0x10000,        # Maximum amount of memory per simulator
+             "maxtotalmem": 0x10000,        # Maximum amount of memory per simulator. The memory is only allocated
+                                            # when used, but the whole content is sent to the web interface
+             "maxallocsize": 8192,          # Maximum size of a single memory allocation (ALLOC declaration)
+             "decodecachesize": 16384,      # Maximum number of decoded instructions kept in memory (shared between
+                                            # all the simulators of the process)
+             "translatehotregions": False,  # True or False, whether the hot loops are translated to Python code
+                                            # in run mode (see translator.py)
+             "translationthreshold": 16,    # Number of iterations after which a loop is considered as hot
+             "cycletiming": False,          # True or False, whether the cycle count follows the timing of the
+                                            # ARM7TDMI (see timing.py) instead of counting one cycle per instruction
              }
 
 def getSetting(name):
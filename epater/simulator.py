@@ -1,13 +1,22 @@
+import copy
+import functools
 import operator
 import struct
 import time
 
 from enum import Enum
-from collections import defaultdict, namedtuple, deque
+from types import MappingProxyType
+from collections import defaultdict, namedtuple, deque, OrderedDict
 
 from .settings import getSetting
 from .components import Registers, Memory, Breakpoint, ComponentException
 from .history import History
+from .scheduler import EventScheduler, PeriodicEvent
+from .assertions import compileAssertionOrDefer, checkAssertion
+from .conditions import BreakpointCondition
+from .translator import RegionTranslator
+from .timing import CycleTiming
+from .cache import CacheHierarchy
 from .simulatorOps.utils import checkMask
 from .simulatorOps import *
 from .simulatorOps.abstractOp import ExecutionException
@@ -55,6 +64,80 @@ class MultipleErrors(Exception):
         self.content = []
 
 
+class DecodedInstrCache:
+    """
+    Bounded LRU cache of decoded instructions, shared by all the simulators of the process
+    (students working on the same exercise execute the same instructions).
+    The keys are (bytecode, PC offset, PC special behavior) and the values are read-only
+    decoder states, as returned by AbstractOp.saveState.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        state = self.data.get(key)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return state
+
+    def add(self, key, state):
+        state = MappingProxyType(state)
+        self.data[key] = state
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return state
+
+    def clear(self):
+        self.data.clear()
+        self.hits, self.misses = 0, 0
+
+    def getStats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.data),
+                "maxsize": self.maxsize}
+
+decodedInstrCache = DecodedInstrCache(getSetting("decodecachesize"))
+
+
+class InterruptSource(PeriodicEvent):
+    """
+    Event raising an interrupt request ("FIQ" or "IRQ") in `requests` (see Simulator.addInterruptSource).
+    """
+    def __init__(self, type, first, period, requests):
+        super().__init__(first, period, lambda: requests.add(type))
+        self.type = type
+
+
+# An instrumentation hook (see Simulator.addHook)
+Hook = namedtuple("Hook", "kind start end callback")
+hookKinds = ("exec", "branch", "interrupt", "memread", "memwrite", "regwrite", "psrwrite")
+
+
+def _rangeDispatcher(hooks):
+    """
+    Return a function calling the callbacks of `hooks` whose range contains its first argument.
+    """
+    hooks = tuple((hook.start, hook.end, hook.callback) for hook in hooks)
+    if len(hooks) == 1:
+        (start, end, callback), = hooks
+        def dispatch(where, *args):
+            if start <= where < end:
+                callback(where, *args)
+    else:
+        def dispatch(where, *args):
+            for start, end, callback in hooks:
+                if start <= where < end:
+                    callback(where, *args)
+    return dispatch
+
+
 class Simulator:
     """
     Main simulator class.
@@ -71,6 +154,10 @@ class Simulator:
         self.maxit = getSetting("runmaxit")
         self.bkptLastFetch = None
         self.deactivatedBkpts = []
+        # Conditions of the breakpoints, by (component, info) as in the Breakpoint exceptions
+        self.bkptConditions = {}
+        # Number of times the execution stopped on each breakpoint, with the same keys
+        self.bkptHits = defaultdict(int)
 
         # Initialize history
         self.history = History()
@@ -87,11 +174,17 @@ class Simulator:
                             'PSROp': PSROp(),
                             'MulOp': MulOp(), 'MulLongOp': MulLongOp(), 
                             'SoftInterruptOp': SoftInterruptOp(), 'NopOp': NopOp()}
-        self.decoderCache = {}
+        self.decodersByClass = {decoder.__class__: decoder for decoder in self.decoders.values()}
+        # Instructions of the INTVEC and CODE sections, predecoded (see fetchAndDecode)
+        self.predecoded = []
+        self.predecodeSections()
+        self.mem.codeWatchers.append(self.invalidatePredecoded)
 
         # Initialize assertion structures
+        # Assertions are compiled once, so that checking them only requires a few comparisons
         self.assertionCkpts = set(assertionTriggers.keys())
-        self.assertionData = assertionTriggers
+        self.assertionData = {addr: [compileAssertionOrDefer(*info) for info in assertionsList]
+                              for addr, assertionsList in assertionTriggers.items()}
         self.assertionWhenReturn = set()
         self.callStack = []
         self.addr2line = addr2line
@@ -100,10 +193,13 @@ class Simulator:
         self.errorsPending = MultipleErrors()
 
         # Initialize interrupt structures
-        self.interruptActive = False
-        # Interrupt trigged at each a*(t-t0) + b cycles
-        self.interruptParams = {'b': 0, 'a': 0, 't0': 0, 'type': "FIQ"}       
-        self.lastInterruptCycle = -1
+        # The scheduler holds all the interrupt sources (and any other event depending on the cycle count)
+        self.scheduler = EventScheduler()
+        # Interrupt lines ("FIQ" or "IRQ") raised by the events of the current cycle
+        self.interruptRequests = set()
+
+        # Memory-mapped devices, by name
+        self.devices = {}
 
         self.stepMode = None
         self.stepCondition = 0
@@ -111,12 +207,349 @@ class Simulator:
         self.runIteration = 0
         self.history.clear()
 
-    def reset(self):
+        # Instrumentation hooks, by kind (see addHook)
+        self.hooks = {kind: [] for kind in hookKinds}
+
+        # Timing model of the instructions (optional)
+        self.timing = None
+        self.setCycleTiming(getSetting("cycletiming"))
+        # Simulated caches (optional, see setCaches)
+        self.caches = None
+
+        # Translation of the hot regions into Python code (optional)
+        self.translator = None
+        self.setTranslation(getSetting("translatehotregions"))
+
+    def setTranslation(self, enabled):
+        """
+        Enable or disable the translation of hot loops into Python code in run mode
+        (see translator.py).
+        """
+        if enabled and self.translator is None:
+            self.translator = RegionTranslator(self)
+        elif not enabled and self.translator is not None:
+            self.mem.codeWatchers.remove(self.translator.invalidate)
+            self.translator = None
+
+    def addHook(self, kind, callback, start=0, end=float("inf")):
+        """
+        Register an instrumentation hook, and return it (to be passed to `removeHook`). The hooks are
+        compiled into the methods of the simulator and of its components: while no hook of a given kind
+        is registered, the simulation runs exactly as if the hooks did not exist.
+
+        The callback receives a different set of arguments for each kind:
+        - "exec": (addr, instr, executed) after the execution of the instruction at `addr` by the
+          decoder `instr`, `executed` being False if its condition was not met
+        - "branch": (addr, target) when the instruction at `addr` modified PC
+        - "interrupt": (addr, type) when an interrupt ("FIQ" or "IRQ") is entered, `addr` being the
+          address of the next instruction which would have been executed
+        - "memread": (addr, size, value) for each read done by an instruction
+        - "memwrite": (addr, size, value) for each write done by an instruction
+        - "regwrite": (reg, bank, value) for each register write (including PC)
+        - "psrwrite": (name, bank, value) for each write of the CPSR or an SPSR (`name`), including
+          the flags and the mode changes, `bank` being the current mode after the write
+
+        The callback is only called if the address (or the register index) is in [start, end). The
+        range is ignored for "psrwrite".
+        The hooks are not called from the translated regions, so the translation is not used while
+        hooks are registered.
+        """
+        assert kind in hookKinds
+        hook = Hook(kind, start, end, callback)
+        self.hooks[kind].append(hook)
+        self._compileHooks()
+        return hook
+
+    def removeHook(self, hook):
+        self.hooks[hook.kind].remove(hook)
+        self._compileHooks()
+
+    @property
+    def hasHooks(self):
+        return any(self.hooks.values())
+
+    def _compileHooks(self):
+        # The hooked methods are instance attributes shadowing the methods of the classes, so we
+        # start by removing them
+        for obj, names in ((self.mem, ("get", "set", "readWords", "writeWords")),
+                           (self.regs, ("setRegister",)),
+                           (self.history, ("signalChange",)),
+                           (self, ("enterInterrupt",))):
+            for name in names:
+                obj.__dict__.pop(name, None)
+        for decoder in self.decoders.values():
+            decoder.__dict__.pop("execute", None)
+
+        if self.hooks["exec"] or self.hooks["branch"]:
+            onExec = _rangeDispatcher(self.hooks["exec"]) if self.hooks["exec"] else None
+            onBranch = _rangeDispatcher(self.hooks["branch"]) if self.hooks["branch"] else None
+            pcReg, pcoffset = self.regs.banks['User'][15], self.pcoffset
+            for decoder in self.decoders.values():
+                def hookedExecute(sim, decoder=decoder, execute=type(decoder).execute):
+                    addr = pcReg.val - pcoffset
+                    conditionFalse = decoder.countExecConditionFalse
+                    execute(decoder, sim)
+                    if onExec is not None:
+                        onExec(addr, decoder, decoder.countExecConditionFalse == conditionFalse)
+                    if onBranch is not None and decoder.pcmodified:
+                        # PC already contains the target (the prefetch offset is added after)
+                        onBranch(addr, pcReg.val)
+                decoder.execute = hookedExecute
+
+        if self.hooks["interrupt"]:
+            onInterrupt = _rangeDispatcher(self.hooks["interrupt"])
+            enterInterrupt = self.enterInterrupt
+            def hookedEnterInterrupt(type):
+                addr = self.regs.banks['User'][15].val - self.pcoffset
+                enterInterrupt(type)
+                onInterrupt(addr, type)
+            self.enterInterrupt = hookedEnterInterrupt
+
+        mem = self.mem
+        if self.hooks["memread"]:
+            onRead = _rangeDispatcher(self.hooks["memread"])
+            memGet, readWords = mem.get, mem.readWords
+            def hookedGet(addr, size=4, execMode=False, mayTriggerBkpt=True):
+                data = memGet(addr, size, execMode, mayTriggerBkpt)
+                # The reads which cannot trigger a breakpoint come from the interface or the simulator itself
+                if mayTriggerBkpt and not execMode:
+                    onRead(addr, size, int.from_bytes(data, "little"))
+                return data
+            def hookedReadWords(addr, count, mayTriggerBkpt=True):
+                values = readWords(addr, count, mayTriggerBkpt)
+                if mayTriggerBkpt:
+                    for i, val in enumerate(values):
+                        onRead(addr + 4*i, 4, val)
+                return values
+            mem.get, mem.readWords = hookedGet, hookedReadWords
+
+        if self.hooks["memwrite"]:
+            onWrite = _rangeDispatcher(self.hooks["memwrite"])
+            memSet, writeWords = mem.set, mem.writeWords
+            def hookedSet(addr, val, size=4, mayTriggerBkpt=True):
+                memSet(addr, val, size, mayTriggerBkpt)
+                if mayTriggerBkpt:
+                    onWrite(addr, size, val & mem.maskformat[size])
+            def hookedWriteWords(addr, values, mayTriggerBkpt=True):
+                writeWords(addr, values, mayTriggerBkpt)
+                if mayTriggerBkpt:
+                    for i, val in enumerate(values):
+                        onWrite(addr + 4*i, 4, val & 0xFFFFFFFF)
+            mem.set, mem.writeWords = hookedSet, hookedWriteWords
+
+        if self.hooks["regwrite"]:
+            onRegWrite = _rangeDispatcher(self.hooks["regwrite"])
+            setRegister = self.regs.setRegister
+            def hookedSetRegister(bank, reg, val, logToHistory=True):
+                setRegister(bank, reg, val, logToHistory)
+                onRegWrite(reg, bank, val & 0xFFFFFFFF)
+            self.regs.setRegister = hookedSetRegister
+
+        if self.hooks["psrwrite"]:
+            # All the writes of the PSR are logged in the history, whatever the way they are done
+            callbacks = tuple(hook.callback for hook in self.hooks["psrwrite"])
+            regs, signalChange = self.regs, self.history.signalChange
+            def hookedSignalChange(obj, change):
+                signalChange(obj, change)
+                if obj is regs:
+                    for (bank, name), (old, new) in change.items():
+                        if name in ("CPSR", "SPSR"):
+                            for callback in callbacks:
+                                callback(name, bank, new & 0xFFFFFFFF)
+            self.history.signalChange = hookedSignalChange
+
+    def setCycleTiming(self, enabled, sCycle=1, nCycle=1, iCycle=1):
+        """
+        Enable or disable the ARM7TDMI timing model (see timing.py): when enabled, each instruction
+        adds its number of cycles to the cycle count, instead of 1. The interrupts and the events are then
+        expressed in cycles, the maximum number of iterations in run mode remains a number of instructions.
+
+        :param sCycle, nCycle, iCycle: duration of a sequential, non-sequential and internal cycle
+        """
+        if self.timing is not None:
+            self.timing.detach()
+            self.timing = None
+        if enabled:
+            self.timing = CycleTiming(self, sCycle, nCycle, iCycle)
+            self.timing.attach()
+
+    def setCaches(self, icache=None, dcache=None, missPenalty=10):
+        """
+        Simulate an instruction cache and a data cache (see cache.py), each transfer with the memory
+        adding `missPenalty` cycles to the cycle count. The previous caches are removed.
+
+        :param icache, dcache: Cache objects, or None to not simulate this cache
+        """
+        if self.caches is not None:
+            self.caches.detach()
+            self.caches = None
+        if icache is not None or dcache is not None:
+            self.caches = CacheHierarchy(self, icache, dcache, missPenalty)
+            self.caches.attach()
+
+    @property
+    def interruptActive(self):
+        return bool(self.scheduler)
+
+    @property
+    def nextEventCycle(self):
+        """
+        Cycle at which the next event (interrupt, timer, etc.) happens, or infinity if there
+        is no such event.
+        """
+        return self.scheduler.nextCycle
+
+    def addInterruptSource(self, type, firstCycle, period=0):
+        """
+        Add a source raising an interrupt at cycle `firstCycle`, then every `period` cycles
+        (only once if `period` is 0). Return the source, which can be passed to `removeEvent`.
+
+        :param type: either "FIQ" or "IRQ"
+        """
+        return self.addEvent(InterruptSource(type, firstCycle, period, self.interruptRequests))
+
+    def addEvent(self, event):
+        self.scheduler.addEvent(event, self.history.cyclesCount)
+        return event
+
+    def removeEvent(self, event):
+        self.scheduler.removeEvent(event, self.history.cyclesCount)
+
+    def addDevice(self, name, device):
+        """
+        Map a device (see devices.py) in memory, at its base address.
+
+        :param name: name used to retrieve the device in `self.devices`
+        """
+        self.mem.mapDevice(device)
+        device.attach(self)
+        self.devices[name] = device
+
+    def processEvents(self):
+        """
+        Handle the events happening at the current cycle, and enter the requested interrupt, if any.
+        The current instruction is always finished before the interrupt takes on.
+        """
+        for event in self.scheduler.popDueEvents(self.history.cyclesCount):
+            event.callback()
+        requests = self.interruptRequests
+        if not requests:
+            return
+        # FIQ has priority over IRQ
+        if "FIQ" in requests and not self.regs.FIQ:
+            self.enterInterrupt("FIQ")
+        elif "IRQ" in requests and not self.regs.IRQ and self.regs.mode != 'FIQ':        # Is the interrupt masked?
+            self.enterInterrupt("IRQ")
+        requests.clear()
+
+    def enterInterrupt(self, type):
+        # We enter it (the entry point is 0x18 for IRQ and 0x1C for FIQ)
+        savedCPSR = self.regs.CPSR                                  # Keep CPSR before changing processor mode
+        self.regs.mode = type                                       # Set the register bank and processor mode
+        self.regs.SPSR = savedCPSR                                  # Save the CPSR in the current SPSR
+        self.regs.IRQ = True                                        # IRQ are always disabled when we enter an interrupt
+        if type == "FIQ":                                           # If we enter a FIQ interrupt,
+            self.regs.FIQ = True                                    #   then we disable also FIQ interrupts
+        self.regs[14] = self.regs[15] - 4                           # Save PC in LR (on the FIQ or IRQ bank)
+        self.regs[15] = self.pcoffset + (0x18 if type == "IRQ" else 0x1C)      # Set PC to enter the interrupt
+
+    def reset(self, resetMemory=False):
         self.history.clear()
+        if resetMemory:
+            self.mem.reset()
+        self.scheduler.reschedule(0)
         self.regs.banks['User'][15].val = self.pcInitVal + self.pcoffset
         self.fetchAndDecode()
         self.explainInstruction()
 
+    def clone(self):
+        """
+        Return an independent simulator in the same state. The immutable parts (bytecode, decoded
+        instructions, address to line mapping) are shared, the registers, the assertions (an SVC
+        adds some when it is executed) and the breakpoint conditions are copied, and the memory
+        pages are shared until they are written.
+        The copy starts with an empty history. The interrupt sources are copied, but not the devices
+        and the other events.
+        """
+        sim = copy.copy(self)
+        sim.history = History()
+        sim.mem = self.mem.clone(sim.history)
+        sim.regs = self.regs.clone(sim.history)
+        sim.history.clear()
+        sim.history.cyclesCount = self.history.cyclesCount
+        sim.history.instructionsCount = self.history.instructionsCount
+        sim.runIteration = self.runIteration
+
+        # The decoders hold the state of the current instruction, so each simulator needs its own
+        sim.decoders = {name: decoder.__class__() for name, decoder in self.decoders.items()}
+        sim.decodersByClass = {decoder.__class__: decoder for decoder in sim.decoders.values()}
+        sim.predecoded = [(start, end, [None if entry is None else (sim.decodersByClass[entry[0].__class__],) + entry[1:]
+                                        for entry in entries])
+                          for start, end, entries in self.predecoded]
+        sim.mem.codeWatchers.append(sim.invalidatePredecoded)
+
+        sim.assertionData = {addr: list(assertions) for addr, assertions in self.assertionData.items()}
+        sim.assertionCkpts = set(self.assertionCkpts)
+        sim.assertionWhenReturn = set(self.assertionWhenReturn)
+        sim.callStack = list(self.callStack)
+        sim.deactivatedBkpts = list(self.deactivatedBkpts)
+        sim.bkptHits = defaultdict(int, self.bkptHits)
+        sim.bkptConditions = dict(self.bkptConditions)
+        sim._installBreakpointConditions()
+        sim.errorsPending = MultipleErrors()
+
+        sim.scheduler = EventScheduler()
+        sim.interruptRequests = set(self.interruptRequests)
+        for event in self.scheduler.events:
+            if isinstance(event, InterruptSource):
+                sim.addInterruptSource(event.type, event.first, event.period)
+        sim.devices = {}
+
+        sim.hooks = {kind: list(hooks) for kind, hooks in self.hooks.items()}
+        sim._compileHooks()
+        if self.timing is not None:
+            sim.timing = self.timing.clone(sim)
+        if self.caches is not None:
+            sim.caches = self.caches.clone(sim)
+
+        if self.translator is not None:
+            sim.translator = self.translator.clone(sim)
+        sim.fetchAndDecode()
+        return sim
+
+    def setBreakpointCondition(self, cmp, info, condition):
+        """
+        Attach a condition to the breakpoints of a memory address, a register or a flag: the
+        execution only stops on them if the condition holds (see BreakpointCondition). The condition
+        is compiled once, and only evaluated when one of these breakpoints is reached.
+        Raise a ConditionSyntaxError if the condition is invalid.
+
+        :param cmp: "memory", "register" or "flags"
+        :param info: the address, the (bank, register index) tuple or the flag letter
+        :param condition: text of the condition, or None to remove it
+        """
+        if condition is None:
+            self.bkptConditions.pop((cmp, info), None)
+        else:
+            self.bkptConditions[(cmp, info)] = BreakpointCondition(condition)
+        self._installBreakpointConditions()
+
+    def _installBreakpointConditions(self):
+        self.mem.bkptConditions = {}
+        self.regs.bkptConditions = {}
+        for (cmp, info), condition in self.bkptConditions.items():
+            check = functools.partial(condition.check, self.regs)
+            if cmp == "memory":
+                self.mem.bkptConditions[info] = check
+            elif cmp == "flags":
+                self.regs.bkptConditions[info] = check
+            else:
+                # A register shared by several banks raises its breakpoints with the current bank
+                bank, idx = info
+                for b, regs in self.regs.banks.items():
+                    if regs[idx] is self.regs.banks[bank][idx]:
+                        self.regs.bkptConditions[(b, idx)] = check
+
     def getContext(self):
         context = {"regs": self.regs.getContext(),
                     "mem": self.mem.getContext()}
@@ -126,10 +559,11 @@ class Simulator:
         assert stepMode in ("into", "out", "forward", "run")
         self.stepMode = stepMode
         self.stepCondition = 1
-        self.runIteration = self.history.cyclesCount
+        # Number of instructions executed when the step started (maxit is a number of instructions)
+        self.runIteration = self.history.instructionsCount
 
     def isStepDone(self):
-        maxCyclesReached = self.history.cyclesCount - self.runIteration >= self.maxit
+        maxCyclesReached = self.history.instructionsCount - self.runIteration >= self.maxit
         if self.stepMode == "forward":
             if self.stepCondition == 2:
                 # The instruction was a function call
@@ -157,13 +591,16 @@ class Simulator:
         for decoder in self.decoders.values():
             decoder.resetExecCounters()
         self.nextInstr()                # We always execute at least one instruction
+        translator = self.translator if self.stepMode == "run" and not self.hasHooks else None
         while not self.isStepDone():    # We repeat until the stopping criterion is met
-            self.nextInstr()
+            if translator is None or not translator.run():
+                self.nextInstr()
         self.explainInstruction()       # We only have to explain the last instruction executed before we stop
 
     def stepBack(self, count=1):
         for c in range(count):
             self.history.stepBack()
+        self.scheduler.reschedule(self.history.cyclesCount)
         self.fetchAndDecode(forceExplain=True)
         self.bkptLastFetch = None
 
@@ -200,9 +637,78 @@ class Simulator:
                 "psr": self.decoders['PSROp'].execCounters,
                 "nop": self.decoders['NopOp'].execCounters}
 
+    def predecodeSections(self):
+        """
+        Decode all the words of the instruction sections (INTVEC and CODE). The result is
+        stored in `self.predecoded`, a list of (section start, section end, entries) tuples
+        where entries[(addr - start) // 4] is either None (invalid instruction, or the word was
+        modified since) or a (decoder, state, bytecode) tuple.
+        """
+        self.predecoded = []
+        for sec in ("INTVEC", "CODE"):
+            if sec not in self.mem.startAddr:
+                continue
+            start, end = self.mem.startAddr[sec], self.mem.endAddr[sec]
+            entries = [self._predecodeWord(addr) for addr in range(start, end - 3, 4)]
+            self.predecoded.append((start, start + 4 * len(entries), entries))
+
+    def _predecodeWord(self, addr):
+        if not self.mem.isMapped(addr, 4, perm=1):
+            # The regular fetch will report the error
+            return None
+        instrInt = struct.unpack("<I", self.mem.readRange(addr, 4))[0]
+        try:
+            decoder = self.decodeInstr(instrInt)
+        except ExecutionException:
+            # The word may be data, we will report the error only if we try to execute it
+            return None
+        return decoder, decoder.saveState(), instrInt
+
+    def invalidatePredecoded(self, addr, size):
+        """
+        Invalidate the predecoded instructions overlapping [addr, addr+size). This is
+        called by the memory each time an instruction section is modified.
+        """
+        for start, end, entries in self.predecoded:
+            if addr < end and addr + size > start:
+                for idx in range(max(addr - start, 0) // 4, min((addr + size - 1 - start) // 4 + 1, len(entries))):
+                    entries[idx] = None
+
+    def _getPredecoded(self, pc):
+        # Return the predecoded entry for the instruction at address pc, decoding it if it
+        # was invalidated, or None if we have to go through the regular fetch
+        for start, end, entries in self.predecoded:
+            if start <= pc < end:
+                break
+        else:
+            return None
+        mem = self.mem
+        if mem.bkptActive:
+            bkpts = mem.breakpoints
+            if bkpts.get(pc) or bkpts.get(pc+1) or bkpts.get(pc+2) or bkpts.get(pc+3):
+                # Memory.get is needed to trigger the breakpoint
+                return None
+        idx = (pc - start) // 4
+        entry = entries[idx]
+        if entry is None:
+            entry = entries[idx] = self._predecodeWord(pc)
+        return entry
+
     def fetchAndDecode(self, forceExplain=False):
         # Check if PC is valid (multiple of 4)
-        if (self.regs[15] - self.pcoffset) % 4 != 0:
+        pc = self.regs[15] - self.pcoffset
+        entry = None if pc % 4 else self._getPredecoded(pc)
+        if entry is not None:
+            # Fast path, the instruction is already decoded
+            decoder, state, instrInt = entry
+            decoder.setBytecode(instrInt)
+            decoder.restoreState(state)
+            self.currentInstr = decoder
+            if forceExplain or self.isStepDone():
+                self.explainInstruction()
+            return
+
+        if pc % 4 != 0:
             self.fetchedInstr = None
             self.errorsPending.append('register', "Erreur : la valeur de PC ({}) est invalide (ce doit être un multiple de 4)!".format(hex(self.regs[15])))
         else:
@@ -298,55 +804,64 @@ class Simulator:
         # Assumes that the instruction to decode is in self.fetchedInstr
         instrInt = struct.unpack("<I", self.fetchedInstr)[0]
 
-        if instrInt in self.decoderCache:
-            self.currentInstr = self.decoderCache[instrInt][0]
-            self.currentInstr.setBytecode(instrInt)
-            self.currentInstr.restoreState(self.decoderCache[instrInt][1])
-            return
+        try:
+            self.currentInstr = self.decodeInstr(instrInt)
+        except ExecutionException as err:
+            # Invalid instruction
+            self.currentInstr = None
+            self.errorsPending.append('execution', err.text)
+
+    def decodeInstr(self, instrInt):
+        """
+        Return the decoder able to execute the instruction `instrInt` (a 32 bits integer),
+        with its state set to this instruction. See `bytecodeToInstr` for the decoding scheme.
+        Decoders are shared between all the instructions of the same class, so the returned
+        object is only valid until the next call to this method.
+
+        Raise an ExecutionException if the instruction is invalid.
+        """
+        cacheKey = (instrInt, self.pcoffset, self.PCSpecialBehavior)
+        state = decodedInstrCache.get(cacheKey)
+        if state is not None:
+            decoder = self.decodersByClass[state['__class__']]
+            decoder.setBytecode(instrInt)
+            decoder.restoreState(state)
+            return decoder
 
         if not (instrInt >> 26 & 3):
             if instrInt >> 4 & 9 == 9 and not (instrInt >> 25 & 1):
                 if instrInt >> 5 & 3:
-                    self.currentInstr = self.decoders['HalfSignedMemOp']
+                    decoder = self.decoders['HalfSignedMemOp']
                 elif instrInt >> 24 & 1:
-                    self.currentInstr = self.decoders['SwapOp']
+                    decoder = self.decoders['SwapOp']
                 elif instrInt >> 23 & 1:
-                    self.currentInstr = self.decoders['MulLongOp']
+                    decoder = self.decoders['MulLongOp']
                 else:
-                    self.currentInstr = self.decoders['MulOp']
+                    decoder = self.decoders['MulOp']
             elif instrInt >> 24 & 1 and not (instrInt >> 20 & 9):
                 if instrInt >> 18 & 9 == 9:
-                    self.currentInstr = self.decoders['BranchOp']
+                    decoder = self.decoders['BranchOp']
                 elif instrInt >> 19 & 1:
-                    self.currentInstr = self.decoders['PSROp']
+                    decoder = self.decoders['PSROp']
                 else:
-                    self.currentInstr = self.decoders['NopOp']
+                    decoder = self.decoders['NopOp']
             else:
-                self.currentInstr = self.decoders['DataOp']
+                decoder = self.decoders['DataOp']
         elif instrInt >> 26 & 1:
             if instrInt >> 27 & 1:
-                self.currentInstr = self.decoders['SoftInterruptOp']
+                decoder = self.decoders['SoftInterruptOp']
             else:   # Could also check for [4], which is an undefined space in the instruction set
-                self.currentInstr = self.decoders['MemOp']
+                decoder = self.decoders['MemOp']
         elif instrInt >> 25 & 1:
-            self.currentInstr = self.decoders['BranchOp']
+            decoder = self.decoders['BranchOp']
         else:
-            self.currentInstr = self.decoders['MultipleMemOp']
+            decoder = self.decoders['MultipleMemOp']
 
-        if self.currentInstr is not None:
-            self.currentInstr.setBytecode(instrInt)
-            try:
-                self.currentInstr.decode()
-                # Once decoded, we add the instruction to the cache
-                self.decoderCache[instrInt] = (self.currentInstr, self.currentInstr.saveState())
-                if len(self.decoderCache) > 2000:
-                    # Fail-safe, we should never get there with programs < 2000 lines, but just in case,
-                    # we do not want to bust the RAM with our cache
-                    self.decoderCache = {}
-            except ExecutionException as err:
-                # Invalid instruction
-                self.currentInstr = None
-                self.errorsPending.append('execution', err.text)
+        decoder.setBytecode(instrInt)
+        decoder.decode()
+        # Once decoded, we add the instruction to the cache
+        decodedInstrCache.add(cacheKey, decoder.saveState())
+        return decoder
 
     def explainInstruction(self):
         if not self.currentInstr:
@@ -371,89 +886,15 @@ class Simulator:
                                     ["disassembly", dis])
 
     def execAssert(self, assertionsList, mode):
-        for assertionInfo in assertionsList:
-            assertionType = assertionInfo[0]
-            if assertionType != mode:
+        for assertion in assertionsList:
+            if assertion.mode != mode:
                 continue
-            assertionLine = assertionInfo[1]
-            assertionInfo = assertionInfo[2].split(",")
-
-            strError = ""
             try:
-                for info in assertionInfo:
-                    info = info.strip()
-                    if "=" not in info:
-                        # Bad syntax, we skip
-                        continue
-                    target, value = info.upper().split("=")
-
-                    # The rest of the code assume that a register is encoded
-                    # as R**, so we convert the alternative names
-                    if value.strip() in ("SP", "LR", "PC"):
-                        value = {'SP': 'R13', 'LR': 'R14', 'PC': 'R15'}[value]
-                    if target.strip() in ("SP", "LR", "PC"):
-                        target = {'SP': 'R13', 'LR': 'R14', 'PC': 'R15'}[target]
-                        
-                    if value.strip()[0] == "R":
-                        # The target is another register
-                        regtarget = int(value[1:].strip())
-                        self.regs.deactivateBreakpoints()
-                        val = self.regs[regtarget]
-                        self.regs.reactivateBreakpoints()
-                    else:
-                        # The target is a constant
-                        regtarget = None
-                        try:
-                            val = int(value, base=0) & 0xFFFFFFFF
-                        except ValueError:
-                            # If this is a decimal with leading zeros, base=0 will crash
-                            val = int(value, base=10) & 0xFFFFFFFF
-                            
-                    if target[0] == "R":
-                        # Register
-                        reg = int(target[1:])
-
-                        self.regs.deactivateBreakpoints()
-                        valreg = self.regs[reg]
-                        self.regs.reactivateBreakpoints()
-                        if valreg != val:
-                            if regtarget:
-                                strError += "Erreur : {} devrait valoir {} (la valeur du registre R{}), mais il vaut {}\n".format(target, val, regtarget, valreg)
-                            else:
-                                strError += "Erreur : {} devrait valoir {}, mais il vaut {}\n".format(target, val, valreg)
-                    elif target[:2] == "0X":
-                        # Memory
-                        addr = int(target, base=16)
-
-                        formatStruct = "<B"
-                        if not 0 <= int(val) < 255:
-                            val &= 0xFFFFFFFF
-                            formatStruct = "<I"
-                        valmem = self.mem.get(addr, mayTriggerBkpt=False, size=4 if formatStruct == "<I" else 1)
-                        valmem = struct.unpack(formatStruct, valmem)[0]
-                        if valmem != val:
-                            if regtarget:
-                                strError += "Erreur : l'adresse mémoire {} devrait contenir {} (la valeur du registre R{}), mais elle contient {}\n"\
-                                    .format(target, val, regtarget, valmem)
-                            else:
-                                strError += "Erreur : l'adresse mémoire {} devrait contenir {}, mais elle contient {}\n"\
-                                    .format(target, val, valmem)
-                    elif len(target) == 1 and target in self.regs.flag2index:
-                        # Flag
-                        expectedVal = value != '0'
-                        actualVal = self.regs.__getattribute__(target)
-                        if actualVal != expectedVal:
-                            strError += "Erreur : le drapeau {} devrait signaler {}, mais il signale {}\n"\
-                                .format(target, expectedVal, actualVal)
-                    else:
-                        # Assert type unknown
-                        strError += "Assertion inconnue ou impossible à interpréter : ({}, {})!".format(target, value)
-
+                strError = checkAssertion(assertion, self.regs, self.mem)
                 if len(strError) > 0:
-                    self.errorsPending.append("assert", strError, assertionLine)
-
+                    self.errorsPending.append("assert", strError, assertion.line)
             except ComponentException as ex:
-                self.errorsPending.append(ex.cmp, ex.text, assertionLine)
+                self.errorsPending.append(ex.cmp, ex.text, assertion.line)
 
     def nextInstr(self, forceExplain=False):
         if self.currentInstr is None:
@@ -461,7 +902,7 @@ class Simulator:
             # We raise the last error to explain the illegal access
             raise self.errorsPending
 
-        isFirstInst = self.runIteration == self.history.cyclesCount
+        isFirstInst = self.runIteration == self.history.instructionsCount
         # One more cycle to do!
         self.history.newCycle()
         # Clear previous errors
@@ -477,6 +918,7 @@ class Simulator:
                 err = self.bkptLastFetch
                 self.bkptLastFetch = None
                 self.history.restartCycle()
+                self.bkptHits[(err.cmp, err.info)] += 1
                 raise err
             try:
                 self.currentInstr.execute(self)
@@ -486,6 +928,7 @@ class Simulator:
                 self.deactivatedBkpts.append(bp)
                 self._toggleBreakpoint(bp)
                 self.history.restartCycle()
+                self.bkptHits[(bp.cmp, bp.info)] += 1
                 raise bp
             except ComponentException as err:
                 self.errorsPending.append(err.cmp, err.text, self.getCurrentLine())
@@ -536,22 +979,9 @@ class Simulator:
             self.execAssert(self.assertionData[newpc], 'BEFORE')
 
         # We look for interrupts
-        # The current instruction is always finished before the interrupt takes on
         # TODO Handle special cases for LDM and STM
-        if self.interruptActive and self.history.cyclesCount >= (self.interruptParams['t0'] + self.interruptParams['b']) \
-            and (self.history.cyclesCount - 1 - self.interruptParams['t0'] - self.interruptParams['b']) % self.interruptParams['a'] == 0:
-            if (self.interruptParams['type'] == "FIQ" and not self.regs.FIQ or
-                    self.interruptParams['type'] == "IRQ" and not self.regs.IRQ and self.regs.mode != 'FIQ'):        # Is the interrupt masked?
-                # Interruption!
-                # We enter it (the entry point is 0x18 for IRQ and 0x1C for FIQ)
-                savedCPSR = self.regs.CPSR                                  # Keep CPSR before changing processor mode
-                self.regs.mode = self.interruptParams['type']               # Set the register bank and processor mode
-                self.regs.SPSR = savedCPSR                                  # Save the CPSR in the current SPSR
-                self.regs.IRQ = True                                        # IRQ are always disabled when we enter an interrupt
-                if self.interruptParams['type'] == "FIQ":                   # If we enter a FIQ interrupt,
-                    self.regs.FIQ = True                                    #   then we disable also FIQ interrupts
-                self.regs[14] = self.regs[15] - 4                           # Save PC in LR (on the FIQ or IRQ bank)
-                self.regs[15] = self.pcoffset + (0x18 if self.interruptParams['type'] == "IRQ" else 0x1C)      # Set PC to enter the interrupt
+        if self.history.cyclesCount >= self.scheduler.nextCycle:
+            self.processEvents()
 
         # We fetch and decode the next instruction
         self.fetchAndDecode(forceExplain)
@@ -121,6 +121,8 @@ class AbstractOp:
     def saveState(self):
         # Each children class must define a saveStateKeys attribute
         d = {k:v for k,v in self.__dict__.items() if k in self.saveStateKeys} 
+        # Set by _decodeCondition for every instruction
+        d['conditionValid'] = self.conditionValid
         d['__class__'] = self.__class__
         return d
 
@@ -179,29 +179,30 @@ class MultipleMemOp(AbstractOp):
         #  Base write-back should not be used when this mechanism is employed."
         transferToUserBank = currentbank != "User" and self.sbit and (self.mode == "STR" or 15 not in self.reglist)
 
+        # The registers are transferred in a single memory access, starting at the lowest address
+        count = len(self.reglist)
+        lowAddr = baseAddr if self.sign > 0 else baseAddr - 4 * (count - 1)
         if self.mode == 'LDR':
-            for reg in self.reglist[::self.sign]:
-                m = simulatorContext.mem.get(baseAddr, size=4)
-                if m is None:       # No such address in the mapped memory, we cannot continue
-                    return False
-                val = struct.unpack("<I", m)[0]
+            values = simulatorContext.mem.readWords(lowAddr, count)
+            for reg, val in tuple(zip(self.reglist, values))[::self.sign]:
                 if transferToUserBank:
                     simulatorContext.regs.setRegister("User", reg, val)
                 else:
                     simulatorContext.regs[reg] = val
-                baseAddr += self.sign * 4
             if simulatorContext.PC in self.reglist:
                 self.pcmodified = True
                 if self.sbit:
                     # "If the instruction is a LDM then SPSR_<mode> is transferred to CPSR at the same time as R15 is loaded."
                     simulatorContext.regs.CPSR = simulatorContext.regs.SPSR
         else:   # STR
-            for reg in self.reglist[::self.sign]:
+            values = []
+            for reg in self.reglist:
                 val = simulatorContext.regs.getRegister("User", reg) if transferToUserBank else simulatorContext.regs[reg]
                 if reg == simulatorContext.PC:
                     val += 4            # PC+12 when PC is in an STM instruction (see 4.11.1 of the ARM instruction set manual)
-                simulatorContext.mem.set(baseAddr, val, size=4)
-                baseAddr += self.sign * 4
+                values.append(val)
+            simulatorContext.mem.writeWords(lowAddr, values)
+        baseAddr += self.sign * 4 * count
         if self.pre:
             baseAddr -= self.sign * 4        # If we are in pre-increment mode, we remove the last increment
 
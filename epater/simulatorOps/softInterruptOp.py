@@ -59,18 +59,18 @@ class SoftInterruptOp(AbstractOp):
         self.pcmodified = True
 
         if keepPC - simulatorContext.pcoffset in simulatorContext.assertionCkpts and \
-            simulatorContext.assertionData[keepPC - simulatorContext.pcoffset][0][0] != "BEFORE":
+            simulatorContext.assertionData[keepPC - simulatorContext.pcoffset][0].mode != "BEFORE":
             # There is an assertion after the SVC call, user probably wanted this to be
             # executed when the interrupt returns
             # We use the same mechanism than with assertion with BL
             key = keepPC - simulatorContext.pcoffset + 4
             assertionInfo = []
             for ad in simulatorContext.assertionData[keepPC - simulatorContext.pcoffset]:
-                assertionInfo.append(("BEFORE", ad[1], ad[2]))
+                assertionInfo.append(ad._replace(mode="BEFORE"))
             if key in simulatorContext.assertionData:
                 for ad in simulatorContext.assertionData[key]:
                     # We don't want to insert it more than one time
-                    if ad[0] == "BEFORE":
+                    if ad.mode == "BEFORE":
                         break
                 else:
                     simulatorContext.assertionData[key].extend(assertionInfo)
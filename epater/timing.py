@@ -0,0 +1,122 @@
+"""
+Cycle timing of the ARM7TDMI.
+
+Each instruction takes a number of sequential (S), non-sequential (N) and internal (I) cycles,
+given by the section 6.20 of the ARM7TDMI data sheet. For instance, LDR takes 1S + 1N + 1I, and
+STM takes (n-1)S + 2N, n being the number of registers transferred. An instruction which writes
+PC also refills the pipeline (1S + 1N more), and an instruction whose condition is not met takes 1S.
+"""
+
+from .simulatorOps import BranchOp, DataOp, MemOp, MultipleMemOp, HalfSignedMemOp, SwapOp, PSROp, \
+                          MulOp, MulLongOp, SoftInterruptOp, NopOp
+
+
+def multiplierCycles(val, signed=True):
+    """
+    Return the number of cycles used by the multiplier array (1 to 4), which stops as soon as the
+    remaining bits of the multiplier operand are all 0 (or all 1, for a signed multiplication).
+    """
+    for m, shift in ((1, 8), (2, 16), (3, 24)):
+        top = val >> shift
+        if top == 0 or (signed and top == 0xFFFFFFFF >> shift):
+            return m
+    return 4
+
+
+class CycleTiming:
+    """
+    Count the cycles taken by each instruction executed, instead of one per instruction. The
+    additional cycles are added to the history (see History.addCycles), so that the cycle count
+    and the interrupts follow the timing model, and stepping back takes them back.
+
+    :param sCycle, nCycle, iCycle: duration of a sequential, non-sequential and internal cycle
+                                   (e.g. to simulate a memory with wait states)
+    """
+    def __init__(self, sim, sCycle=1, nCycle=1, iCycle=1):
+        self.sim = sim
+        self.hooks = []
+        self.durations = (sCycle, nCycle, iCycle)
+        S, N, I = sCycle, nCycle, iCycle
+        regs, history = sim.regs, sim.history
+
+        def dataCost(instr):
+            # A shift by a register needs an internal cycle to read it
+            return S + I if not instr.imm and not instr.shift.immediate else S
+
+        def memCost(instr):
+            return S + N + I if instr.mode == "LDR" else 2*N
+
+        def multipleMemCost(instr):
+            n = len(instr.reglist)
+            return n*S + N + I if instr.mode == "LDR" else (n-1)*S + 2*N
+
+        # The cost is computed after the execution: if the instruction wrote the multiplier operand
+        # (Rs is also a destination register), the value it used is the previous one, kept in the history
+        def multiplier(instr):
+            change = history.history[-1][regs.__class__].get((regs.currentMode, instr.rs))
+            return regs.banks[regs.currentMode][instr.rs].val if change is None else change[0]
+
+        def mulCost(instr):
+            m = multiplierCycles(multiplier(instr))
+            return S + (m + instr.accumulate) * I
+
+        def mulLongCost(instr):
+            m = multiplierCycles(multiplier(instr), instr.signed)
+            return S + (m + 1 + instr.accumulate) * I
+
+        # Cost of each type of instruction, before the pipeline refill
+        self.costs = {DataOp: dataCost,
+                      MemOp: memCost,
+                      HalfSignedMemOp: memCost,
+                      MultipleMemOp: multipleMemCost,
+                      MulOp: mulCost,
+                      MulLongOp: mulLongCost,
+                      SwapOp: lambda instr: S + 2*N + I,
+                      BranchOp: lambda instr: S,
+                      SoftInterruptOp: lambda instr: S,
+                      PSROp: lambda instr: S,
+                      NopOp: lambda instr: S}
+        self.refillCost = S + N
+        self.notExecutedCost = S
+        # Entering an interrupt is equivalent to a branch
+        self.interruptCost = 2*S + N
+
+    def attach(self):
+        if self.hooks:
+            return
+        costs, refillCost, notExecutedCost = self.costs, self.refillCost, self.notExecutedCost
+        interruptCost, history = self.interruptCost, self.sim.history
+
+        def onExec(addr, instr, executed):
+            if not executed:
+                cost = notExecutedCost
+            elif instr.pcmodified:
+                cost = costs[instr.__class__](instr) + refillCost
+            else:
+                cost = costs[instr.__class__](instr)
+            # The history already counted one cycle for this instruction
+            if cost != 1:
+                history.addCycles(cost - 1)
+
+        def onInterrupt(addr, type):
+            history.addCycles(interruptCost)
+
+        self.hooks = [self.sim.addHook("exec", onExec),
+                      self.sim.addHook("interrupt", onInterrupt)]
+
+    def detach(self):
+        for hook in self.hooks:
+            self.sim.removeHook(hook)
+        self.hooks = []
+
+    def clone(self, sim):
+        """
+        Return a copy of this timing model for `sim`, a copy of the simulator it is attached to
+        (the copy of the simulator has copies of our hooks, which we replace).
+        """
+        timing = CycleTiming(sim, *self.durations)
+        if self.hooks:
+            for hook in self.hooks:
+                sim.removeHook(hook)
+            timing.attach()
+        return timing
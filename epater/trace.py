@@ -0,0 +1,210 @@
+"""
+Binary execution trace.
+
+The trace is a sequence of fixed-width records (see `recordStruct`), stored in a ring buffer: when
+it is full, the oldest records are overwritten. The buffer is either in memory or in a file mapped
+in memory (mmap), preceded by a header giving the capacity of the buffer and the number of records
+written since the beginning (updated after each record).
+
+Each record holds a kind, two small fields (a, b) and three 32 bits words (x, y, z):
+- EXEC (instruction executed): a = 1 if its condition was met, x = address, y = opcode, z = cycle
+- REGWRITE: a = register index (PC excluded), b = bank index (see `banks`), x = value, z = cycle
+- MEMWRITE: a = size of the access, x = address, y = value, z = cycle
+- PSRWRITE: a = 0 for CPSR or 1 for SPSR, b = bank index, x = value, z = cycle
+- INTERRUPT (interrupt entered): a = index of its type (see `interrupts`), x = address of the
+  instruction which would have been executed, z = cycle
+The writes done by an instruction (or by the entry in an interrupt) are recorded before it.
+"""
+
+import json
+import mmap
+import struct
+
+recordStruct = struct.Struct("<BBHIII")
+headerStruct = struct.Struct("<4sHHIQ")
+traceMagic = b"EPTR"
+traceVersion = 2
+# Offset of the number of records in the header
+countStruct = struct.Struct("<Q")
+countOffset = headerStruct.size - countStruct.size
+
+EXEC, REGWRITE, MEMWRITE, PSRWRITE, INTERRUPT = 0, 1, 2, 3, 4
+banks = ("User", "FIQ", "IRQ", "SVC")
+psrNames = ("CPSR", "SPSR")
+interrupts = ("IRQ", "FIQ")
+
+
+class TraceRecorder:
+    """
+    Record the execution of a simulator with instrumentation hooks (see Simulator.addHook).
+
+    :param capacity: number of records of the ring buffer
+    :param path: if not None, the buffer is a file mapped in memory (created or overwritten), which can
+                 be read with `readTrace` while the simulation runs or after it ended
+    """
+    def __init__(self, sim, capacity=1 << 16, path=None):
+        self.sim = sim
+        self.capacity = capacity
+        self.count = 0
+        self.hooks = []
+        size = headerStruct.size + capacity * recordStruct.size
+        if path is None:
+            self.file = None
+            self.buffer = bytearray(size)
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+        self._writeHeader()
+
+    def _writeHeader(self):
+        headerStruct.pack_into(self.buffer, 0, traceMagic, traceVersion, recordStruct.size, self.capacity, self.count)
+
+    def attach(self):
+        if self.hooks:
+            return
+        buffer, capacity, history = self.buffer, self.capacity, self.sim.history
+        pack, recordSize, offset = recordStruct.pack_into, recordStruct.size, headerStruct.size
+        packCount = countStruct.pack_into
+        bankIndex = {bank: i for i, bank in enumerate(banks)}
+
+        def record(kind, a, b, x, y):
+            pack(buffer, offset + (self.count % capacity) * recordSize, kind, a, b, x, y, history.cyclesCount & 0xFFFFFFFF)
+            self.count += 1
+            # The record is complete before being counted, so that the trace can be read at any time
+            packCount(buffer, countOffset, self.count)
+
+        def onExec(addr, instr, executed):
+            record(EXEC, executed, 0, addr, instr.instrInt)
+
+        def onRegWrite(reg, bank, value):
+            record(REGWRITE, reg, bankIndex[bank], value, 0)
+
+        def onMemWrite(addr, size, value):
+            record(MEMWRITE, size, 0, addr & 0xFFFFFFFF, value)
+
+        def onPsrWrite(name, bank, value):
+            record(PSRWRITE, psrNames.index(name), bankIndex[bank], value, 0)
+
+        def onInterrupt(addr, type):
+            record(INTERRUPT, interrupts.index(type), 0, addr & 0xFFFFFFFF, 0)
+
+        # The writes to PC are given by the addresses of the instructions
+        self.hooks = [self.sim.addHook("regwrite", onRegWrite, 0, 15),
+                      self.sim.addHook("psrwrite", onPsrWrite),
+                      self.sim.addHook("memwrite", onMemWrite),
+                      self.sim.addHook("interrupt", onInterrupt),
+                      self.sim.addHook("exec", onExec)]
+
+    def detach(self):
+        for hook in self.hooks:
+            self.sim.removeHook(hook)
+        self.hooks = []
+        self.flush()
+
+    def flush(self):
+        """
+        Write the buffer to the trace file, if any.
+        """
+        self._writeHeader()
+        if self.file is not None:
+            self.buffer.flush()
+
+    def close(self):
+        self.detach()
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+    def records(self):
+        """
+        Iterate over the records currently in the buffer, from the oldest.
+        """
+        self.flush()
+        return readTrace(self.buffer)
+
+
+def readTrace(source):
+    """
+    Iterate over the records of a trace, from the oldest, as (kind, a, b, x, y, z) tuples.
+
+    :param source: a buffer (bytes, bytearray, mmap) or the path of a trace file
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from readTrace(buffer)
+        return
+    magic, version, recordSize, capacity, count = headerStruct.unpack_from(source, 0)
+    if magic != traceMagic or version != traceVersion or recordSize != recordStruct.size:
+        raise ValueError("Ce fichier n'est pas une trace d'exécution valide")
+    first = max(0, count - capacity)
+    for i in range(first, count):
+        yield recordStruct.unpack_from(source, headerStruct.size + (i % capacity) * recordSize)
+
+
+def _groupByInstruction(records):
+    # Gather the writes of each instruction (or interrupt entry) with it (they are recorded before it)
+    regs, mem = [], []
+    for kind, a, b, x, y, z in records:
+        if kind == REGWRITE:
+            regs.append((banks[b], a, x))
+        elif kind == PSRWRITE:
+            regs.append((banks[b], psrNames[a], x))
+        elif kind == MEMWRITE:
+            mem.append((x, a, y))
+        else:
+            if kind == INTERRUPT:
+                event = {"cycle": z, "addr": x, "interrupt": interrupts[a]}
+            else:
+                event = {"cycle": z, "addr": x, "opcode": y, "executed": bool(a)}
+            event["regs"] = [{"bank": bank, "reg": reg, "value": val} for bank, reg, val in regs]
+            event["mem"] = [{"addr": addr, "size": size, "value": val} for addr, size, val in mem]
+            yield event
+            regs, mem = [], []
+
+
+def exportJSONLines(records, out):
+    """
+    Write one JSON object per instruction in the text stream `out`, with its cycle, address, opcode,
+    whether its condition was met and its register (including CPSR and SPSR) and memory writes. The
+    entries in the interrupts are objects with the interrupt type instead of the opcode.
+    """
+    for instr in _groupByInstruction(records):
+        out.write(json.dumps(instr))
+        out.write("\n")
+
+
+def exportChromeTrace(records, out, addr2line=None):
+    """
+    Write the trace in the Chrome trace event format (JSON array format) in the text stream `out`,
+    to be displayed by a timeline viewer (e.g. chrome://tracing or Perfetto). Each instruction is
+    an event, which lasts until the next one; the cycles are used as timestamps.
+
+    :param addr2line: if given, the events are named after the source line of the instructions
+    """
+    out.write("[\n")
+    previous = None
+    for instr in _groupByInstruction(records):
+        if previous is not None:
+            out.write(_chromeEvent(previous, instr["cycle"] - previous["cycle"], addr2line))
+            out.write(",\n")
+        previous = instr
+    if previous is not None:
+        out.write(_chromeEvent(previous, 1, addr2line))
+        out.write("\n")
+    out.write("]\n")
+
+
+def _chromeEvent(instr, duration, addr2line):
+    if "interrupt" in instr:
+        return json.dumps({"name": "Interruption {}".format(instr["interrupt"]), "ph": "X", "ts": instr["cycle"],
+                           "dur": max(duration, 1), "pid": 0, "tid": 0, "args": {"regs": instr["regs"]}})
+    name = "0x{:08x}".format(instr["addr"])
+    if addr2line is not None and len(addr2line.get(instr["addr"], ())) > 0:
+        name = "Ligne {}".format(addr2line[instr["addr"]][-1] + 1)
+    args = {"opcode": "0x{:08x}".format(instr["opcode"]), "executed": instr["executed"],
+            "regs": instr["regs"], "mem": instr["mem"]}
+    return json.dumps({"name": name, "ph": "X", "ts": instr["cycle"], "dur": max(duration, 1),
+                       "pid": 0, "tid": 0, "args": args})
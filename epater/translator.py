@@ -0,0 +1,552 @@
+"""
+Ahead-of-time translation of hot code regions into Python functions.
+
+A region is a contiguous range of instructions of the CODE section (typically the body of
+a loop). Each instruction is translated into a few lines of Python, with the ARM registers
+held in local variables and the condition codes turned into `if` statements. The generated
+source is compiled once with `compile()` and then run in place of the interpreter.
+
+The translated code always returns to the interpreter (an "exit") when:
+- PC leaves the region;
+- it reaches an instruction it cannot translate (function calls and returns, PSR
+  transfers, multiple memory accesses, software interrupts, writes to PC or LR, etc.);
+- it reaches an assertion checkpoint;
+- a memory access fails, reaches a device or modifies the instructions of the region;
+- the instruction budget (maximum number of iterations, next interrupt) is exhausted.
+The faulting or untranslatable instruction is then executed by the interpreter, which
+keeps the exact same semantics as the operations defined in `simulatorOps`.
+
+Regions are never used when a breakpoint is set on a register, a flag, a memory read or
+write, or an instruction of the region. They always stop before the next scheduled event
+(interrupt), which is then handled by the interpreter.
+"""
+
+import copy
+import struct
+from collections import defaultdict
+
+from .settings import getSetting
+from .components import Breakpoint, ComponentException
+from .simulatorOps import BranchOp, DataOp, MemOp, MulOp, NopOp
+from .simulatorOps.abstractOp import ExecutionException
+
+
+MASK = 0xFFFFFFFF
+
+# Python expressions evaluating to True if the condition is met
+conditionExpr = {'EQ': "Z",
+                 'NE': "not Z",
+                 'CS': "C",
+                 'CC': "not C",
+                 'MI': "N",
+                 'PL': "not N",
+                 'VS': "V",
+                 'VC': "not V",
+                 'HI': "C and not Z",
+                 'LS': "not C or Z",
+                 'GE': "N == V",
+                 'LT': "N != V",
+                 'GT': "not Z and N == V",
+                 'LE': "Z or N != V",
+                 'AL': None}
+
+
+class TranslationError(Exception):
+    """
+    Raised when an instruction cannot be translated. The translator then ends the current
+    block with an exit to the interpreter.
+    """
+    pass
+
+
+class _InstrInfo:
+    """
+    Decoded fields of an instruction, copied from the decoder state (decoders are shared
+    between instructions, so we cannot keep a reference to them).
+    """
+    def __init__(self, decoder):
+        self.__dict__.update(decoder.saveState())
+        self.cls = decoder.__class__
+
+
+class TranslatedRegion:
+    """
+    A compiled region. `entries` is the set of addresses at which the region can be
+    entered; `function` has the signature function(pc, budget, regs, mem) and returns
+    a tuple (pc of the next instruction to execute, number of instructions executed).
+    """
+    def __init__(self, start, end, entries, source, function):
+        self.start = start
+        self.end = end
+        self.entries = entries
+        self.source = source
+        self.function = function
+        self.valid = True
+
+
+class RegionTranslator:
+    """
+    Detects the hot loops of the running program and translates them into Python functions.
+
+    A loop is detected when the same backward jump (a jump to an address lower than or equal
+    to the current one) is taken `hotThreshold` times. The region [target, source+4) is then
+    translated. Only the "run" mode uses the translated regions.
+    """
+
+    def __init__(self, simulator, hotThreshold=None):
+        self.sim = simulator
+        self.hotThreshold = getSetting("translationthreshold") if hotThreshold is None else hotThreshold
+        self.entries = {}
+        self.regions = []
+        self.hotCounters = defaultdict(int)
+        self.rejected = set()
+        self.lastPc = None
+        self._bkptCache = (None, None, None)
+        # Software interrupts may add assertion checkpoints at runtime
+        self._nbAssertionCkpts = len(simulator.assertionCkpts)
+        self.sim.mem.codeWatchers.append(self.invalidate)
+
+    def clone(self, simulator):
+        """
+        Return a translator for `simulator`, a copy of the simulator of this one, in the same state:
+        the copy has the same regions (the functions only depend on the code) and hot counters, so
+        that both translate and run the same regions at the same time.
+        """
+        translator = RegionTranslator(simulator, self.hotThreshold)
+        # Each copy invalidates its own regions
+        regions = {id(region): copy.copy(region) for region in self.regions}
+        translator.regions = list(regions.values())
+        translator.entries = {addr: regions[id(region)] for addr, region in self.entries.items()}
+        translator.hotCounters = defaultdict(int, self.hotCounters)
+        translator.rejected = set(self.rejected)
+        translator.lastPc = self.lastPc
+        translator._nbAssertionCkpts = self._nbAssertionCkpts
+        return translator
+
+    def invalidate(self, addr=None, size=4):
+        """
+        Invalidate all the regions containing the bytes [addr, addr+size). If addr is None,
+        then all the regions are invalidated.
+        """
+        for region in self.regions:
+            if addr is None or (addr < region.end and addr + size > region.start):
+                region.valid = False
+        self.regions = [region for region in self.regions if region.valid]
+        self.entries = {a: r for a, r in self.entries.items() if r.valid}
+        if addr is None:
+            self.rejected.clear()
+        else:
+            self.rejected = {(s, e) for s, e in self.rejected if not (addr < e and addr + size > s)}
+
+    def _breakpointsAllowRegion(self, region):
+        # Breakpoints rarely change, so we only recompute this information when needed
+        mem, regs = self.sim.mem, self.sim.regs
+        generation = (mem.bkptGeneration, regs.bkptGeneration)
+        if self._bkptCache[0] != generation:
+            dataBkpts = any(v & 6 for v in mem.breakpoints.values()) or regs.hasBreakpoints()
+            execBkpts = frozenset(a for a, v in mem.breakpoints.items() if v & 1)
+            self._bkptCache = (generation, dataBkpts, execBkpts)
+        _, dataBkpts, execBkpts = self._bkptCache
+        if dataBkpts:
+            return False
+        return not any(region.start - 3 <= a < region.end for a in execBkpts)
+
+    def run(self):
+        """
+        Execute a translated region at the current PC, if any. Return True if at least
+        one instruction was executed, or False if the interpreter should execute the next
+        instruction itself.
+        """
+        sim = self.sim
+        if len(sim.assertionCkpts) != self._nbAssertionCkpts:
+            self._nbAssertionCkpts = len(sim.assertionCkpts)
+            self.invalidate()
+        pc = sim.regs.banks['User'][15].val - sim.pcoffset
+        region = self.entries.get(pc)
+        if region is None:
+            lastPc, self.lastPc = self.lastPc, pc
+            if lastPc is None or pc > lastPc:
+                return False
+            # Backward jump, we may be in a loop
+            key = (pc, lastPc + 4)
+            if key in self.rejected:
+                return False
+            self.hotCounters[key] += 1
+            if self.hotCounters[key] < self.hotThreshold:
+                return False
+            del self.hotCounters[key]
+            region = self.translate(*key)
+            if region is None:
+                self.rejected.add(key)
+                return False
+
+        if sim.bkptLastFetch or not self._breakpointsAllowRegion(region):
+            return False
+
+        history = sim.history
+        # We stop at the next event (e.g. interrupt), so that it happens at the right cycle
+        budget = min(sim.maxit - (history.instructionsCount - sim.runIteration),
+                     sim.scheduler.nextCycle - history.cyclesCount)
+        history.newCycle()
+        sim.errorsPending.clear()
+        sim.mem.inTranslatedRegion = True
+        try:
+            pc, count = region.function(pc, budget, sim.regs, sim.mem)
+        finally:
+            sim.mem.inTranslatedRegion = False
+        self.lastPc = None
+        if count == 0:
+            # Nothing was executed (the first instruction is faulty or the budget is too small)
+            history.restartCycle()
+            return False
+        history.addInstructions(count - 1)
+
+        sim.regs[15] = pc + sim.pcoffset
+        if pc in sim.assertionCkpts:
+            # We check if we've hit an pre-assertion checkpoint (for the next instruction)
+            sim.execAssert(sim.assertionData[pc], 'BEFORE')
+        if history.cyclesCount >= sim.scheduler.nextCycle:
+            sim.processEvents()
+        sim.fetchAndDecode()
+        if sim.errorsPending:
+            raise sim.errorsPending
+        return True
+
+    def translate(self, start, end):
+        """
+        Translate the instructions in [start, end) into a Python function.
+        Return a TranslatedRegion, or None if the region cannot be translated (not in the CODE
+        section, or its first instruction cannot be translated).
+        """
+        sim = self.sim
+        mem = sim.mem
+        if "CODE" not in mem.startAddr or not (mem.startAddr["CODE"] <= start < end <= mem.endAddr["CODE"]):
+            return None
+
+        # Decoders are shared, so we have to restore the state of the current instruction afterwards
+        current = sim.currentInstr
+        if current is not None:
+            currentState = (current.instrInt, current.saveState())
+        try:
+            instrs = {}
+            for addr in range(start, end, 4):
+                try:
+                    word = struct.unpack("<I", mem.get(addr, mayTriggerBkpt=False))[0]
+                    instrs[addr] = _InstrInfo(sim.decodeInstr(word))
+                except ExecutionException:
+                    instrs[addr] = None
+        finally:
+            if current is not None:
+                current.setBytecode(currentState[0])
+                current.restoreState(currentState[1])
+
+        region = _RegionBuilder(sim, start, end, instrs).build()
+        if region is not None:
+            self.regions.append(region)
+            self.entries.update((addr, region) for addr in region.entries)
+        return region
+
+
+class _RegionBuilder:
+    """
+    Generates the source code of a region. The generated function has this structure:
+
+        def region(pc, budget, regs, mem):
+            R = regs.banks[regs.currentMode]
+            r0 = R[0].val                       # For each register used
+            ...
+            cpsr = regs.regCPSR
+            N, Z, C, V = ...
+            n = 0
+            try:
+                while True:
+                    if pc == 0x80:              # For each block
+                        if n + 5 > budget: break
+                        ...                     # Block body
+                        pc = 0x80; n += 5; continue
+                    ...
+                    break
+            except (ComponentException, ExecutionException, Breakpoint):
+                n += (f - pc) // 4              # f is the address of the faulty instruction
+                pc = f
+            if r0 != i0: regs[0] = r0           # For each register written
+            ...
+            return pc, n
+    """
+
+    def __init__(self, sim, start, end, instrs):
+        self.sim = sim
+        self.start, self.end = start, end
+        self.instrs = instrs
+        self.readRegs = set()
+        self.writeRegs = set()
+        self.writeFlags = False
+
+    def _reg(self, reg, addr):
+        # Reading PC gives a constant, since we know the address of the instruction
+        if reg == 15:
+            return hex((addr + self.sim.pcoffset) & MASK)
+        self.readRegs.add(reg)
+        return "r{}".format(reg)
+
+    def _setReg(self, reg):
+        if reg >= 14:
+            # Writing LR has side effects on the step mode and the call stack, and writing
+            # PC must be done by the interpreter
+            raise TranslationError()
+        self.writeRegs.add(reg)
+        return "r{}".format(reg)
+
+    def _findLeaders(self):
+        # The leaders are the first instructions of each basic block: the beginning of the
+        # region, the branch targets, and the instructions following a branch or an exit
+        leaders = {self.start}
+        for addr, info in self.instrs.items():
+            if info is None or addr in self.sim.assertionCkpts:
+                leaders.add(addr + 4)
+                continue
+            try:
+                self._translateInstr(info, addr, 0, ())
+            except TranslationError:
+                leaders.add(addr + 4)
+                continue
+            if info.cls is BranchOp:
+                leaders.add(addr + 4)
+                target = (addr + self.sim.pcoffset + info.offsetImm) & MASK
+                if self.start <= target < self.end:
+                    leaders.add(target)
+        # Reset what was collected by the translation attempts
+        self.readRegs, self.writeRegs, self.writeFlags = set(), set(), False
+        return {a for a in leaders if a < self.end}
+
+    def build(self):
+        leaders = self._findLeaders()
+        blocks = []
+        for leader in sorted(leaders):
+            block = self._buildBlock(leader, leaders)
+            if block is not None:
+                blocks.append((leader, block))
+        if not blocks or blocks[0][0] != self.start:
+            return None
+
+        lines = ["def region(pc, budget, regs, mem):",
+                 "    R = regs.banks[regs.currentMode]"]
+        for reg in sorted(self.readRegs | self.writeRegs):
+            lines.append("    r{0} = i{0} = R[{0}].val".format(reg))
+        lines += ["    cpsr = regs.regCPSR",
+                  "    N = cpsr & 0x80000000 != 0",
+                  "    Z = cpsr & 0x40000000 != 0",
+                  "    C = cpsr & 0x20000000 != 0",
+                  "    V = cpsr & 0x10000000 != 0",
+                  "    n = 0",
+                  "    f = pc",
+                  "    try:",
+                  "        while True:"]
+        for leader, block in blocks:
+            lines.append("            if pc == {}:".format(hex(leader)))
+            lines.extend("                " + line for line in block)
+        lines += ["            break",
+                  "    except (ComponentException, ExecutionException, Breakpoint):",
+                  "        # The interpreter will execute the faulty instruction again, and report the error",
+                  "        n += (f - pc) // 4",
+                  "        pc = f"]
+        for reg in sorted(self.writeRegs):
+            lines.append("    if r{0} != i{0}: regs[{0}] = r{0}".format(reg))
+        if self.writeFlags:
+            lines += ["    if (N, Z, C, V) != (cpsr & 0x80000000 != 0, cpsr & 0x40000000 != 0, cpsr & 0x20000000 != 0, cpsr & 0x10000000 != 0):",
+                      "        regs.setAllFlags({'N': N, 'Z': Z, 'C': C, 'V': V}, mayTriggerBkpt=False)"]
+        lines.append("    return pc, n")
+        source = "\n".join(lines) + "\n"
+
+        namespace = {'ComponentException': ComponentException,
+                     'ExecutionException': ExecutionException,
+                     'Breakpoint': Breakpoint,
+                     'unpackWord': struct.Struct("<I").unpack}
+        code = compile(source, "<region {}-{}>".format(hex(self.start), hex(self.end)), "exec")
+        exec(code, namespace)
+        return TranslatedRegion(self.start, self.end, frozenset(l for l, _ in blocks), source, namespace['region'])
+
+    def _exit(self, target, count, leaders):
+        # Leave the block, either to another block of the region or to the interpreter
+        if target in leaders:
+            return "pc = {}; n += {}; continue".format(hex(target), count)
+        return "pc = {}; n += {}; break".format(hex(target), count)
+
+    def _buildBlock(self, leader, leaders):
+        body = []
+        addr = leader
+        count = 0
+        while True:
+            info = self.instrs.get(addr)
+            if addr >= self.end or info is None or addr in self.sim.assertionCkpts or (addr in leaders and addr != leader):
+                body.append(self._exit(addr, count, leaders))
+                break
+            try:
+                code, terminal = self._translateInstr(info, addr, count, leaders)
+            except TranslationError:
+                body.append(self._exit(addr, count, leaders))
+                break
+            count += 1
+            body.append("# {}".format(hex(addr)))
+            body.extend(code)
+            addr += 4
+            if terminal:
+                break
+        if count == 0:
+            return None
+        return ["if n + {} > budget: break".format(count)] + body
+
+    def _translateInstr(self, info, addr, index, leaders):
+        if info.condition is None:
+            raise TranslationError()
+        cond = conditionExpr[info.condition]
+
+        if info.cls is BranchOp:
+            if not info.imm or info.link:
+                raise TranslationError()
+            target = (addr + self.sim.pcoffset + info.offsetImm) & MASK
+            jump = self._exit(target, index + 1, leaders)
+            if cond is None:
+                return [jump], True
+            return ["if {}: {}".format(cond, jump)], False
+
+        if info.cls is DataOp:
+            code = self._translateDataOp(info, addr)
+        elif info.cls is MemOp:
+            code = self._translateMemOp(info, addr, index, leaders)
+        elif info.cls is MulOp:
+            code = self._translateMulOp(info, addr)
+        elif info.cls is NopOp:
+            code = ["pass"]
+        else:
+            raise TranslationError()
+
+        if cond is not None:
+            code = ["if {}:".format(cond)] + ["    " + line for line in code]
+        return code, False
+
+    def _translateShift(self, src, shift):
+        # Returns the expressions of the shifted value and of the carry out, see utils.applyShift
+        t, v = shift.type, shift.value
+        if t == "LSL":
+            if v == 0:
+                return src, "C"
+            return "({} << {}) & 0xFFFFFFFF".format(src, v), "({} >> {}) & 1".format(src, 32 - v)
+        if t == "LSR":
+            if v == 0:
+                return "0", "{} >> 31".format(src)
+            return "{} >> {}".format(src, v), "({} >> {}) & 1".format(src, v - 1)
+        if t == "ASR":
+            if v == 0:
+                return "(0xFFFFFFFF if {} >> 31 else 0)".format(src), "{} >> 31".format(src)
+            return ("(({0} >> {1}) | {2} if {0} >> 31 else {0} >> {1})".format(src, v, hex(((1 << v) - 1) << (32 - v))),
+                    "({} >> {}) & 1".format(src, v - 1))
+        if t == "ROR":
+            if v == 0:
+                # RRX
+                return "({} >> 1) | (C << 31)".format(src), "{} & 1".format(src)
+            return "(({0} >> {1}) | ({0} << {2})) & 0xFFFFFFFF".format(src, v, 32 - v), "({} >> {}) & 1".format(src, v - 1)
+        raise TranslationError()
+
+    def _translateDataOp(self, info, addr):
+        code = []
+        opcode = info.opcode
+        a = self._reg(info.rn, addr) if opcode not in ("MOV", "MVN") else None
+        if info.imm:
+            b = hex(info.shiftedVal)
+            carry = str(bool(info.carryOutImmShift)) if info.shift.value != 0 else "C"
+        else:
+            if not info.shift.immediate:
+                # Shift by a register
+                raise TranslationError()
+            b, carry = self._translateShift(self._reg(info.op2reg, addr), info.shift)
+
+        arith = {"ADD": ("{a}", "{b}", "0"),
+                 "CMN": ("{a}", "{b}", "0"),
+                 "SUB": ("{a}", "~{b} & 0xFFFFFFFF", "1"),
+                 "CMP": ("{a}", "~{b} & 0xFFFFFFFF", "1"),
+                 "RSB": ("~{a} & 0xFFFFFFFF", "{b}", "1"),
+                 "ADC": ("{a}", "{b}", "C"),
+                 "SBC": ("{a}", "~{b} & 0xFFFFFFFF", "C"),
+                 "RSC": ("~{a} & 0xFFFFFFFF", "{b}", "C")}
+        logical = {"MOV": "{b}",
+                   "MVN": "~{b} & 0xFFFFFFFF",
+                   "AND": "{a} & {b}",
+                   "TST": "{a} & {b}",
+                   "EOR": "{a} ^ {b}",
+                   "TEQ": "{a} ^ {b}",
+                   "ORR": "{a} | {b}",
+                   "BIC": "{a} & ~{b} & 0xFFFFFFFF"}
+        setFlags = info.modifyFlags
+        if setFlags and info.rd == 15:
+            raise TranslationError()
+
+        if opcode in arith:
+            x, y, cin = arith[opcode]
+            code.append("x = " + x.format(a=a, b="({})".format(b)))
+            code.append("y = " + y.format(a=a, b="({})".format(b)))
+            code.append("res = x + y + {}".format(cin))
+            if setFlags:
+                code.append("C = res > 0xFFFFFFFF")
+            code.append("res &= 0xFFFFFFFF")
+            if setFlags:
+                code.append("V = ((x ^ res) & (y ^ res)) & 0x80000000 != 0")
+        elif opcode in logical:
+            if setFlags and carry != "C":
+                code.append("c = " + carry)
+            code.append("res = " + logical[opcode].format(a=a, b="({})".format(b)))
+            if setFlags and carry != "C":
+                code.append("C = c != 0")
+        else:
+            raise TranslationError()
+
+        if setFlags:
+            self.writeFlags = True
+            code.append("N = res > 0x7FFFFFFF")
+            code.append("Z = res == 0")
+        if opcode not in ("TST", "TEQ", "CMP", "CMN"):
+            code.append("{} = res".format(self._setReg(info.rd)))
+        return code
+
+    def _translateMulOp(self, info, addr):
+        if 15 in (info.rd, info.rm, info.rs) or (info.accumulate and info.rn == 15):
+            raise TranslationError()
+        code = ["res = {} * {}".format(self._reg(info.rm, addr), self._reg(info.rs, addr))]
+        if info.accumulate:
+            code[0] += " + {}".format(self._reg(info.rn, addr))
+        code.append("{} = res & 0xFFFFFFFF".format(self._setReg(info.rd)))
+        if info.modifyFlags:
+            self.writeFlags = True
+            code += ["N = res & 0x80000000 != 0",
+                     "Z = res == 0",
+                     "C = False"]
+        return code
+
+    def _translateMemOp(self, info, addr, index, leaders):
+        if info.rd == 15 or (info.basereg == 15 and info.writeback):
+            raise TranslationError()
+        base = self._reg(info.basereg, addr)
+        if info.imm:
+            offset = str(info.offsetImm)
+        else:
+            if info.offsetReg == 15 or info.offsetRegShift.type != "LSL":
+                raise TranslationError()
+            offset, _ = self._translateShift(self._reg(info.offsetReg, addr), info.offsetRegShift)
+        code = ["f = {}".format(hex(addr)),
+                "ea = {} {} {}".format(base, "+" if info.sign > 0 else "-", offset)]
+        realAddr = "ea" if info.pre else base
+        if info.mode == "LDR":
+            dest = self._setReg(info.rd)
+            if info.byte:
+                code.append("{} = mem.get({}, 1)[0]".format(dest, realAddr))
+            else:
+                code.append("{} = unpackWord(mem.get({}, 4))[0]".format(dest, realAddr))
+        else:
+            size = 1 if info.byte else 4
+            code.append("mem.set({}, {}, {})".format(realAddr, self._reg(info.rd, addr), size))
+            # Self-modifying code: the region was invalidated by the write, we have to leave
+            code.append("if {} <= {} < {}: {}".format(hex(self.start - size + 1), realAddr, hex(self.end),
+                                                     self._exit(addr + 4, index + 1, ())))
+        if info.writeback:
+            code.append("{} = ea & 0xFFFFFFFF".format(self._setReg(info.basereg)))
+        return code
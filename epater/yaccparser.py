@@ -897,10 +897,11 @@ def p_declarationsize(p):
         raise YaccError("Une allocation de variable ne peut qu'être suivie d'un nombre d'éléments. Utilisez ASSIGN si vous voulez assigner des valeurs précises.")
     dimNbr = p[2][0]
     dimBytes = dimNbr * p[1] // 8
-    if dimBytes > 8192:
-        raise YaccError("Demande d'allocation mémoire trop grande. Le maximum permis est de 8 Ko (8192 octets), mais la déclaration demande {} octets.".format(dimBytes))
-    assert dimBytes <= 8192, "Too large memory allocation requested! ({} bytes)".format(dimBytes)
-    p[0] = (struct.pack("<" + "B" * dimBytes, *[getSetting("fillValue")] * dimBytes), None)
+    maxSize = getSetting("maxallocsize")
+    if dimBytes > maxSize:
+        raise YaccError("Demande d'allocation mémoire trop grande. Le maximum permis est de {} Ko ({} octets), mais la déclaration demande {} octets.".format(maxSize // 1024, maxSize, dimBytes))
+    assert dimBytes <= maxSize, "Too large memory allocation requested! ({} bytes)".format(dimBytes)
+    p[0] = (bytes([getSetting("fillValue")]) * dimBytes, None)
 
 def p_declarationsize_error(p):
     """declarationsize : VARDECWITHOUTSIZE LISTINIT"""
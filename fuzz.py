@@ -0,0 +1,48 @@
+"""
+Random testing of the simulator (see epater/fuzzer.py).
+
+    python fuzz.py --count 1000 --corpus corpus/     # check 1000 random programs, save the failing ones
+    python fuzz.py --replay corpus/                  # check again the programs saved
+    python fuzz.py --unicorn                         # compare with unicorn instead of the interpreter without translation
+"""
+
+import argparse
+import sys
+import time
+
+from epater import fuzzer, lockstep
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EPATER, random testing of the simulator')
+    parser.add_argument('--count', type=int, default=1000, help="Nombre de programmes à tester")
+    parser.add_argument('--seed', type=int, default=0, help="Graine du premier programme")
+    parser.add_argument('--length', type=int, default=40, help="Nombre d'instructions de chaque programme")
+    parser.add_argument('--corpus', metavar='DOSSIER', help="Dossier où enregistrer les programmes en échec")
+    parser.add_argument('--replay', metavar='DOSSIER', help="Tester à nouveau les programmes de ce dossier")
+    parser.add_argument('--unicorn', action='store_true', help="Comparer l'exécution avec celle d'unicorn plutôt qu'avec l'interpréteur sans traduction")
+    args = parser.parse_args()
+
+    candidate = None
+    if args.unicorn:
+        if lockstep.unicorn is None:
+            parser.error("Le module unicorn n'est pas installé")
+        candidate = fuzzer.unicornCandidate
+
+    start = time.time()
+    if args.replay:
+        failures = fuzzer.replayCorpus(args.replay, candidate)
+        for path, failure in failures.items():
+            print("{}: {}".format(path, failure[0]))
+            print("    " + failure[1])
+        print("{} program(s) still failing".format(len(failures)))
+    else:
+        failures = fuzzer.fuzz(args.count, args.seed, args.length, candidate, args.corpus)
+        for case, failure in failures:
+            print("Seed {}: {}".format(case.seed, failure[0]))
+            print("    " + failure[1])
+            print("\n".join(case.body))
+        duration = time.time() - start
+        print("{} program(s) checked in {:.1f} s ({:.0f} programs/sec), {} failure(s)".format(
+              args.count, duration, args.count / duration, len(failures)))
+
+    sys.exit(1 if failures else 0)
@@ -15,6 +15,7 @@ var next_debugline = -1;
 var codeerrors = [];
 var debug_marker = null;
 var next_debug_marker = null;
+var heatmap_lines = [];
 
 ws.onerror = function (event) {
     displayErrorMsg("Erreur de connexion avec le simulateur.");
@@ -160,6 +161,18 @@ ws.onmessage = function (event) {
             } else {
                 $("#spsr_title").html("SPSR<br/>(" + obj[1] + ")");
             }
+        } else if (obj[0] == 'heatmap') {
+            clearHeatmap();
+            var maxcount = 0;
+            for (var line in obj[1]) {
+                maxcount = Math.max(maxcount, obj[1][line]);
+            }
+            for (var line in obj[1]) {
+                // 4 levels of heat, relative to the most executed line
+                var level = Math.max(1, Math.ceil(4 * obj[1][line] / maxcount));
+                editor.session.addGutterDecoration(parseInt(line), "heat" + level);
+                heatmap_lines.push([parseInt(line), "heat" + level]);
+            }
         } else if (obj[0] == 'error') {
             displayErrorMsg(obj[1]);
         } else {
@@ -173,6 +186,13 @@ function removeCodeErrors() {
     editor.session.clearAnnotations();
 }
 
+function clearHeatmap() {
+    for (var i = 0; i < heatmap_lines.length; i++) {
+        editor.session.removeGutterDecoration(heatmap_lines[i][0], heatmap_lines[i][1]);
+    }
+    heatmap_lines.length = 0;
+}
+
 function resetView() {
     // Remove code errors tooltips
     codeerrors.length = 0;
@@ -192,6 +212,7 @@ function resetView() {
     $(".statusVal").val("");
     if (debug_marker !== null) { editor.session.removeMarker(debug_marker); }
     if (next_debug_marker !== null) { editor.session.removeMarker(next_debug_marker); }
+    clearHeatmap();
 
     $(".reg_bkp_w").removeClass("reg_bkp_w");
     $(".reg_bkp_r").removeClass("reg_bkp_r");
@@ -244,6 +265,9 @@ function assemble(lang) {
         if ($("#interrupt_active").is(":checked")) {
             sendCmd(["interrupt", true, $("#interrupt_type").val(), parseInt($("#interrupt_cycles").val()), parseInt($("#interrupt_cycles_first").val())]);
         }
+        if ($("#profiling").is(":checked")) {
+            sendCmd(['profile', true]);
+        }
 
     } else {
         $("#assemble").text("Démarrer");
@@ -269,6 +293,24 @@ function sendBreakpointsInstr() {
     sendCmd(['breakpointsinstr', asm_breakpoints]);
 }
 
+function askBreakpointCondition(target, description, mode) {
+    // Conditional breakpoint on a line (target is its row), a register or a memory address
+    if (isSimulatorInEditMode()) {
+        displayErrorMsg("Les conditions des points d'arrêt se définissent pendant la simulation");
+        return false;
+    }
+    var condition = prompt("Condition du point d'arrêt " + description + " (par exemple R0 > 10 ou value == 0, vide pour un point d'arrêt sans condition) :", "");
+    if (condition === null) {
+        return false;
+    }
+    var cmd = ['breakpointcondition', target, condition];
+    if (mode !== undefined) {
+        cmd.push(mode);
+    }
+    sendCmd(cmd);
+    return true;
+}
+
 function sendMsg(msg) {
     sendData(JSON.stringify([msg]));
 }
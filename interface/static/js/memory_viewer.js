@@ -164,18 +164,33 @@ function resetMemoryViewer() {
   updateMemoryBreakpointsView();
 }
 
-function cellClick(e) {
+function cellAddress(e) {
+  // Address of the byte of the clicked cell, or null if it is not a byte
   var suffix = null;
   for (var i = 0; i < e.target.classList.length; i++) {
     if (e.target.classList[i].slice(0, 14) == 'editablegrid-c') { suffix = e.target.classList[i].slice(-2); }
   }
   if (suffix == null) {
-    return;
+    return null;
   }
   if (suffix[0] == 'c') { suffix = suffix.slice(-1); }
   suffix = parseInt(suffix).toString(16);
-  if(suffix != "NaN"){
-    var addr = $('td:first', $(e.target).closest('tr')).text().slice(0,9) + suffix;
+  if (suffix == "NaN") {
+    return null;
+  }
+  return $('td:first', $(e.target).closest('tr')).text().slice(0,9) + suffix;
+}
+
+function cellClick(e) {
+  var addr = cellAddress(e);
+  if(addr !== null){
+    if(e.altKey && e.shiftKey) {
+      // Step back to the last write of this byte
+      if (!isSimulatorInEditMode()) {
+        sendCmd(['lastwrite', addr]);
+      }
+      return;
+    }
     if(e.shiftKey) {
       sendCmd(['breakpointsmem', addr, 'r']);
     }
@@ -235,5 +250,14 @@ $(document).ready(function() {
   };
 
   $("#memoryview").click(cellClick);
+  $("#memoryview").contextmenu(function(e) {
+    // Conditional write breakpoint on a byte
+    var addr = cellAddress(e);
+    if (addr === null) {
+      return true;
+    }
+    askBreakpointCondition(addr, "en écriture à l'adresse " + addr, 'w');
+    return false;
+  });
   resetMemoryViewer();
 });
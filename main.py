@@ -1,13 +1,20 @@
 import argparse
+import sys
 import time
 import math
 
 from epater.assembler import parse as ASMparser
 from epater.bytecodeinterpreter import BCInterpreter
+from epater.lockstep import LockstepChecker, UnicornBackend
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='EPATER, ARM emulator')
     parser.add_argument('inputfile', help="Fichier assembleur")
+    parser.add_argument('--coverage', action='store_true', help="Afficher la couverture du code exécuté")
+    parser.add_argument('--lockstep', choices=('translation', 'unicorn'),
+                        help="Comparer l'exécution de référence avec la traduction ou avec unicorn, instruction par instruction")
+    parser.add_argument('--lockstep-count', type=int, default=100000, help="Nombre d'instructions à comparer")
+    parser.add_argument('--lockstep-interval', type=int, default=1000, help="Nombre d'instructions entre deux comparaisons")
     args = parser.parse_args()
 
     with open(args.inputfile) as f:
@@ -16,6 +23,21 @@ if __name__ == '__main__':
 
     a = time.time()
     interpreter = BCInterpreter(bytecode, bcinfos, assertions)
+    interpreter.setCoverage(args.coverage)
+    if args.lockstep:
+        reference = interpreter.clone()
+        reference.setTranslation(False)
+        if args.lockstep == "unicorn":
+            try:
+                candidate = UnicornBackend(interpreter)
+            except RuntimeError as err:
+                parser.error(str(err))
+        else:
+            candidate = interpreter.clone()
+            candidate.setTranslation(True)
+        divergence = LockstepChecker(reference, candidate, args.lockstep_interval).run(args.lockstep_count)
+        print(divergence if divergence is not None else "Aucune divergence sur {} instructions".format(args.lockstep_count))
+        sys.exit(1 if divergence is not None else 0)
     with open(args.inputfile) as f:
         lines = f.readlines()
         interpreter.step(stepMode="forward")
@@ -33,3 +55,17 @@ if __name__ == '__main__':
     cycles = interpreter.getCycleCount()
     cyclesPerSec = cycles / deltaTime
     print("Time execute {} instructions : {} ({:.0f} instr/sec)".format(cycles, deltaTime, cyclesPerSec))
+
+    if args.coverage:
+        coverage = interpreter.getCoverage()
+        executed, notExecuted = coverage["executed"], coverage["notexecuted"]
+        total = len(executed) + len(notExecuted)
+        print("Couverture : {}/{} lignes exécutées ({:.0f}%)".format(len(executed), total, 100 * len(executed) / max(total, 1)))
+        if notExecuted:
+            print("Lignes jamais exécutées :")
+            for line in notExecuted:
+                print("  {:4d} : {}".format(line + 1, lines[line].rstrip()))
+        for line, directions in sorted(coverage["branches"].items()):
+            if not directions["taken"] or not directions["nottaken"]:
+                direction = "pris" if not directions["taken"] else "non pris"
+                print("Branchement jamais {} (ligne {}) : {}".format(direction, line + 1, lines[line].strip()))
@@ -13,6 +13,8 @@ import io
 import binascii
 import signal
 import base64
+import hashlib
+import itertools
 from urllib.parse import quote, unquote
 from copy import copy
 from collections import OrderedDict, defaultdict
@@ -35,6 +37,8 @@ from epater import i18n
 from epater.bottle_i18n import I18NPlugin, I18NMiddleware, i18n_defaults, i18n_view, i18n_template
 from epater.assembler import parse as ASMparser
 from epater.bytecodeinterpreter import BCInterpreter
+from epater.conditions import ConditionSyntaxError
+from epater.metrics import Registry
 
 
 with open("emailpass.txt") as fhdl:
@@ -48,9 +52,99 @@ except FileNotFoundError:
 
 
 UPDATE_THROTTLE_SEC = 0.3
+# The metrics are only served locally, at http://127.0.0.1:METRICS_PORT/metrics
+METRICS_PORT = 31416
+EVENT_LOOP_LAG_INTERVAL_SEC = 0.5
+# Handling a message (or continuing an execution) for longer than this blocks all the other clients
+STALL_THRESHOLD_SEC = 0.25
 
 interpreters = {}
 connected = set()
+# Maps each client to its queues of messages waiting to be sent (see handler)
+send_queues = {}
+# Maps each client to the time spent handling its requests (see account)
+session_usage = {}
+session_ids = itertools.count(1)
+# CPU time of the thread running the event loop (the process time before Python 3.7)
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+MESSAGE_TYPES = {'assemble', 'stepback', 'lastwrite', 'stepinto', 'stepforward', 'stepout', 'run', 'stop', 'reset',
+                 'breakpointsinstr', 'breakpointsmem', 'profile', 'breakpointcondition', 'update', 'interrupt', 'memchange'}
+
+
+def message_type(message):
+    # Unknown types are gathered, so that clients cannot create an unbounded number of metrics
+    try:
+        msg_type = json.loads(message)[0]
+    except (ValueError, TypeError, IndexError, KeyError):
+        return "invalid"
+    return msg_type if msg_type in MESSAGE_TYPES else "other"
+
+
+def decode_cache_hit_ratio():
+    stats = BCInterpreter.getDecodeCacheStats()
+    return stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+
+
+def account(ws, command, wall_start, cpu_start):
+    """
+    Charge the time spent since wall_start (time.perf_counter) and cpu_start (thread_time) to the
+    client `ws` and the command `command`, and report it if it stalled the event loop.
+    """
+    wall, cpu = time.perf_counter() - wall_start, thread_time() - cpu_start
+    process_latency.observe(wall, type=command)
+    cpu_seconds.inc(cpu, type=command)
+    usage = session_usage.get(ws)
+    if usage is None:
+        return
+    usage['wall'] += wall
+    usage['cpu'] += cpu
+    usage['requests'] += 1
+    if wall > STALL_THRESHOLD_SEC:
+        usage['stalls'] += 1
+        event_loop_stalls.inc(type=command)
+        print("Event loop stalled for {:.3f} s (CPU {:.3f} s) by session {}, command {}, code {}".format(
+              wall, cpu, usage['id'], command, code_hash(ws)))
+
+
+def code_hash(ws):
+    # Identifies the program of a client in the logs and the metrics, without revealing it
+    return getattr(interpreters.get(ws), 'code_hash__', "-")
+
+
+def session_times(key):
+    return {(("code", code_hash(ws)), ("session", usage['id'])): usage[key] for ws, usage in list(session_usage.items())}
+
+
+def send_queue_depths():
+    depths = [sum(len(queue) for queue in queues) for queues in send_queues.values()] or [0]
+    return {(("stat", "total"),): sum(depths), (("stat", "max"),): max(depths)}
+
+
+def session_memory():
+    sizes = [interp.getMemoryEstimate() for interp in list(interpreters.values())] or [0]
+    return {(("stat", "total"),): sum(sizes), (("stat", "max"),): max(sizes)}
+
+
+metrics = Registry()
+metrics.gauge("epater_sessions", "Connected clients", lambda: len(connected))
+metrics.gauge("epater_interpreters", "Assembled programs being simulated", lambda: len(interpreters))
+process_latency = metrics.histogram("epater_process_seconds", "Time taken to handle a message and compute the UI update, by message "
+                                    "type (\"continue\" for the executions continued in the background)")
+cpu_seconds = metrics.counter("epater_cpu_seconds_total", "CPU time spent handling the messages, by message type")
+event_loop_stalls = metrics.counter("epater_event_loop_stalls_total", "Messages which blocked the event loop for more than "
+                                    "STALL_THRESHOLD_SEC, by message type")
+metrics.gauge("epater_session_cpu_seconds", "CPU time spent handling the messages of each client", lambda: session_times('cpu'))
+metrics.gauge("epater_session_wall_seconds", "Time spent handling the messages of each client", lambda: session_times('wall'))
+instructions_executed = metrics.counter("epater_instructions_total", "Instructions executed by all the simulators")
+metrics.rate("epater_instructions_per_second", "Instructions executed per second since the previous scrape", instructions_executed)
+metrics.gauge("epater_decode_cache_hit_ratio", "Hit ratio of the shared decoded instructions cache", decode_cache_hit_ratio)
+metrics.gauge("epater_decode_cache_entries", "Entries of the shared decoded instructions cache",
+              lambda: BCInterpreter.getDecodeCacheStats()['size'])
+event_loop_lag = metrics.histogram("epater_event_loop_lag_seconds", "Delay of the event loop when waking up a task",
+                                   (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+metrics.gauge("epater_send_queue_messages", "Messages waiting to be sent to the clients (total, and largest queue)", send_queue_depths)
+metrics.gauge("epater_session_memory_bytes", "Estimated memory used by the simulators (total, and largest one)", session_memory)
 
 
 DEBUG = 'DEBUG' in sys.argv
@@ -96,12 +190,38 @@ async def update_ui(ws, to_send):
         await asyncio.sleep(0.02)
 
 
+async def monitor_event_loop():
+    # A task waking up late means that the event loop was blocked (e.g. by a long simulation)
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SEC)
+        event_loop_lag.observe(max(time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL_SEC, 0))
+
+
+async def metrics_handler(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split()[1:2] == [b"/metrics"]:
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n".format(status, len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
 async def handler(websocket, path):
     print("User {} connected.".format(websocket))
     connected.add(websocket)
     to_send = []
     received = []
     ui_update_queue = []
+    send_queues[websocket] = (to_send, ui_update_queue)
+    session_usage[websocket] = {'id': next(session_ids), 'wall': 0., 'cpu': 0., 'requests': 0, 'stalls': 0}
     try:
         listener_task = asyncio.ensure_future(websocket.recv())
         producer_task = asyncio.ensure_future(producer(websocket, to_send))
@@ -129,7 +249,9 @@ async def handler(websocket, path):
                 if message:
                     received.append(message)
 
+                wall_start, cpu_start = time.perf_counter(), thread_time()
                 data = process(websocket, received)
+                account(websocket, message_type(message), wall_start, cpu_start)
                 if data:
                     to_send.extend(data)
 
@@ -146,8 +268,10 @@ async def handler(websocket, path):
 
             # Continue executions of "run", "step out" and "step forward"
             if to_run_task in done:
+                wall_start, cpu_start = time.perf_counter(), thread_time()
                 if interpreters[websocket].animate_speed__:
                     interpreters[websocket].step()
+                    instructions_executed.inc()
                     interpreters[websocket].last_step__ = time.time()
                     interpreters[websocket].num_exec__ += 1
                     if interpreters[websocket].shouldStop:
@@ -155,14 +279,17 @@ async def handler(websocket, path):
                     ui_update_queue.extend(updateDisplay(interpreters[websocket]))
 
                 else:
+                    instructions = interpreters[websocket].getInstructionCount()
                     interpreters[websocket].num_exec__ -= interpreters[websocket].getCycleCount()
                     interpreters[websocket].execute()
+                    instructions_executed.inc(max(interpreters[websocket].getInstructionCount() - instructions, 0))
                     interpreters[websocket].last_step__ = time.time()
                     interpreters[websocket].num_exec__ += interpreters[websocket].getCycleCount()
                     interpreters[websocket].num_exec__ = max(interpreters[websocket].num_exec__, 1)
                     interpreters[websocket].user_asked_stop__ = True
                     ui_update_queue.extend(updateDisplay(interpreters[websocket]))
 
+                account(websocket, "continue", wall_start, cpu_start)
                 to_run_task = asyncio.ensure_future(run_instance(websocket))
 
 
@@ -174,7 +301,8 @@ async def handler(websocket, path):
                 interpreters[websocket].next_report__ = time.time() + UPDATE_THROTTLE_SEC
 
                 to_send.extend(ui_update_queue)
-                ui_update_queue = []
+                # Emptied in place, since it is also referenced by send_queues
+                del ui_update_queue[:]
                 update_ui_task = asyncio.ensure_future(update_ui(websocket, to_send))
 
 
@@ -205,8 +333,13 @@ async def handler(websocket, path):
     finally:
         if websocket in interpreters:
             del interpreters[websocket]
+        send_queues.pop(websocket, None)
+        usage = session_usage.pop(websocket, None)
         connected.remove(websocket)
         print("User {} disconnected.".format(websocket))
+        if usage is not None:
+            print("Session {}: {} requests, {:.3f} s (CPU {:.3f} s), {} stalls".format(
+                  usage['id'], usage['requests'], usage['wall'], usage['cpu'], usage['stalls']))
 
 
 def sendEmail(msg):
@@ -301,6 +434,10 @@ def updateDisplay(interp, force_all=False):
 
     retval.append(["cycles_count", interp.getCycleCount()])
 
+    if interp.profiler is not None and interp.profiler.hooks:
+        # Number of executions of each line, to display a heat map
+        retval.append(["heatmap", {line: counters["executions"] for line, counters in interp.getProfile().items()}])
+
     return translate_retval(interp.lang, retval)
 
 
@@ -336,8 +473,11 @@ def process(ws, msg_in):
                     retval.append(["edit_mode"])
                 else:
                     interpreters[ws] = BCInterpreter(bytecode, bcinfos, assertions, snippetMode=snippetMode)
+                    # The UI is only updated every UPDATE_THROTTLE_SEC, the changes are computed at this time
+                    interpreters[ws].setChangesFromSnapshots(True)
                     force_update_all = True
                     interpreters[ws].code__ = copy(code)
+                    interpreters[ws].code_hash__ = hashlib.sha1(code.encode()).hexdigest()[:12]
                     interpreters[ws].last_step__ = time.time()
                     interpreters[ws].next_report__ = 0
                     interpreters[ws].animate_speed__ = 0.1
@@ -350,8 +490,27 @@ def process(ws, msg_in):
                 if data[0] == 'stepback':
                     interpreters[ws].stepBack()
                     force_update_all = True
+                elif data[0] == 'lastwrite':
+                    # Go back just before the instruction which last modified a register (e.g. "r3"
+                    # or "FIQ_r8") or a memory address
+                    reg_update = re.findall(r'^(?:([A-Z]{3})_)?r(\d{1,2})$', str(data[1]))
+                    try:
+                        if reg_update:
+                            bank, reg_id = reg_update[0]
+                            info = interpreters[ws].findLastRegisterWrite(int(reg_id), bank or None)
+                        else:
+                            info = interpreters[ws].findLastMemoryWrite(data[1] if isinstance(data[1], int) else int(data[1], 16))
+                    except (ValueError, TypeError):
+                        retval.append(["error", "Registre ou adresse invalide: {}".format(repr(data[1]))])
+                    else:
+                        if info is None:
+                            retval.append(["error", "Aucune modification de {} dans l'historique".format(data[1])])
+                        else:
+                            interpreters[ws].stepBack(info["stepsback"])
+                            force_update_all = True
                 elif data[0] == 'stepinto':
                     interpreters[ws].execute('into')
+                    instructions_executed.inc()
                 elif data[0] == 'stepforward':
                     interpreters[ws].setStepMode('forward')
                     interpreters[ws].user_asked_stop__ = False
@@ -401,6 +560,28 @@ def process(ws, msg_in):
                                        ["membp_w", ["0x{:08x}".format(x) for x in bpm['w']]],
                                        ["membp_rw", ["0x{:08x}".format(x) for x in bpm['rw']]],
                                        ["membp_e", ["0x{:08x}".format(x) for x in bpm['e']]]])
+                elif data[0] == 'profile':
+                    interpreters[ws].setProfiling(bool(data[1]), clear=len(data) > 2 and bool(data[2]))
+                    force_update_all = True
+                elif data[0] == 'breakpointcondition':
+                    # Condition of the breakpoint of a line (integer), a register (e.g. "r3" or "FIQ_r8") or
+                    # a memory address, with an optional mode for the last two. An empty condition removes it
+                    condition = str(data[2]).strip() or None
+                    mode = data[3] if len(data) > 3 else 'w'
+                    reg_update = re.findall(r'^(?:([A-Z]{3})_)?r(\d{1,2})$', str(data[1]))
+                    try:
+                        if isinstance(data[1], int):
+                            interpreters[ws].setBreakpointInstrCondition(data[1], condition)
+                        elif reg_update:
+                            bank, reg_id = reg_update[0]
+                            interpreters[ws].setBreakpointRegister((bank or 'user').lower(), int(reg_id), mode, condition)
+                        else:
+                            interpreters[ws].setBreakpointMem(int(data[1], 16), mode, condition)
+                    except ConditionSyntaxError as err:
+                        retval.append(["error", err.text])
+                    except (ValueError, TypeError):
+                        retval.append(["error", "Point d'arrêt invalide: {}".format(repr(data[1]))])
+                    force_update_all = True
                 elif data[0] == 'update':
                     reg_update = re.findall(r'^(?:([A-Z]{3})_)?r(\d{1,2})', data[1])
                     if reg_update:
@@ -775,6 +956,11 @@ def display_amount_users(signum, stack):
     print(connected)
     print("Number of interpreters:", len(interpreters))
     print(interpreters)
+    print("Decoded instructions cache:", BCInterpreter.getDecodeCacheStats())
+    print("Heaviest sessions:")
+    for ws, usage in sorted(session_usage.items(), key=lambda item: -item[1]['cpu'])[:10]:
+        print("  session {} ({}), code {}: {} requests, {:.3f} s (CPU {:.3f} s), {} stalls".format(
+              usage['id'], ws.remote_address, code_hash(ws), usage['requests'], usage['wall'], usage['cpu'], usage['stalls']))
     sys.stdout.flush()
 
 def translate_retval(lang, values):
@@ -804,6 +990,8 @@ if __name__ == '__main__':
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         print("Using uvloop")
     asyncio.get_event_loop().run_until_complete(start_server)
+    asyncio.get_event_loop().run_until_complete(asyncio.start_server(metrics_handler, '127.0.0.1', METRICS_PORT))
+    asyncio.ensure_future(monitor_event_loop())
     asyncio.get_event_loop().run_forever()
 
     if DEBUG:
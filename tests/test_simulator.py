@@ -0,0 +1,900 @@
+import io
+import json
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from epater.assembler import parse as ASMparser
+from epater.bytecodeinterpreter import BCInterpreter
+from epater.components import Memory
+from epater.conditions import BreakpointCondition, ConditionSyntaxError
+from epater.lockstep import LockstepChecker, InterpreterBackend
+from epater.metrics import Registry
+from epater import fuzzer, settings
+from epater.simulatorOps import SwapOp
+from epater.trace import readTrace
+from epater.translator import _RegionBuilder
+
+
+LOOP_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R4, =tab
+    MOV R0, #0
+    MOV R1, #0
+boucle
+    AND R2, R1, #15
+    LDR R3, [R4, R2, LSL #2]
+    ADD R3, R3, R1
+    STR R3, [R4, R2, LSL #2]
+    ADDS R0, R0, R3, LSR #1
+    ADC R5, R5, #0
+    MUL R6, R1, R1
+    EOR R7, R7, R6
+    ADD R1, R1, #1
+    CMP R1, #1024
+    BNE boucle
+    SUB R8, PC, #4
+    LDR R9, [R8]
+    STR R9, [R8, #8]
+    MOV R10, #1
+fin B fin
+SECTION DATA
+tab ALLOC32 16
+"""
+
+
+def buildInterpreter(code):
+    bytecode, addr2line, line2addr, assertions, snippetMode, errors = ASMparser(code.splitlines())
+    assert not errors, errors
+    return BCInterpreter(bytecode, addr2line, assertions, snippetMode=snippetMode)
+
+
+def getState(interpreter):
+    return (interpreter.getRegisters(), interpreter.sim.regs.CPSR, interpreter.getCycleCount(),
+            interpreter.getMemoryFormatted())
+
+
+def test_translation_same_state():
+    reference = buildInterpreter(LOOP_CODE)
+    reference.setTranslation(False)
+    translated = buildInterpreter(LOOP_CODE)
+    translated.setTranslation(True)
+    for i in range(3):
+        reference.execute('run')
+        translated.execute('run')
+        assert getState(reference) == getState(translated)
+    assert len(translated.sim.translator.regions) > 0
+
+
+def test_self_modifying_code():
+    # The STR overwrites "MOV R10, #1" with "LDR R9, [R8]"
+    interpreter = buildInterpreter(LOOP_CODE)
+    interpreter.sim.maxit = 20000
+    interpreter.execute('run')
+    registers = interpreter.getRegisters()['User']
+    assert registers[1] == 1024
+    assert registers[10] == 0
+
+
+def test_decode_cache_shared():
+    buildInterpreter(LOOP_CODE)
+    stats = BCInterpreter.getDecodeCacheStats()
+    buildInterpreter(LOOP_CODE)
+    newStats = BCInterpreter.getDecodeCacheStats()
+    # All the instructions of the second interpreter were decoded by the first one
+    assert newStats['misses'] == stats['misses']
+    assert newStats['hits'] > stats['hits']
+    assert newStats['size'] <= newStats['maxsize']
+
+
+ASSERT_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    MOV R0, #5
+    ASSERT R0=5, R1=R0, Z=0
+    LDR R1, =var
+    ASSERT 0x1000=7, SP=0
+fin B fin
+SECTION DATA
+var ASSIGN32 7
+"""
+
+
+def test_assertions():
+    interpreter = buildInterpreter(ASSERT_CODE)
+    interpreter.execute('into')     # B main
+    interpreter.execute('into')     # MOV R0, #5
+    errors = list(interpreter.errorsPending)
+    assert len(errors) == 1
+    assert errors[0][0] == "assert" and errors[0][2] == 5
+    assert "R1 devrait valoir 5" in errors[0][1]
+    interpreter.execute('into')     # LDR R1, =var
+    assert not interpreter.errorsPending
+
+
+def test_assertion_syntax_error():
+    bytecode, addr2line, line2addr, assertions, snippetMode, errors = ASMparser(ASSERT_CODE.replace("Z=0", "Z=2").splitlines())
+    assert errors and errors[0][:2] == ("codeerror", 5)
+
+
+INTERRUPT_CODE = """SECTION INTVEC
+B main
+B main
+B main
+B main
+B main
+B main
+B irq
+B fiq
+SECTION CODE
+main
+    ADD R0, R0, #1
+    B main
+irq
+    SUB LR, LR, #4
+    ADD R11, R11, #1
+    MOVS PC, LR
+fiq
+    SUB LR, LR, #4
+    ADD R12, R12, #1
+    MOVS PC, LR
+SECTION DATA
+"""
+
+
+def test_interrupt_sources():
+    interpreter = buildInterpreter(INTERRUPT_CODE)
+    interpreter.setInterrupt("IRQ", False, 10, 20)
+    fiq = interpreter.addInterruptSource("FIQ", 111, 100)
+    assert interpreter.getNextEventCycle() == 11
+    for i in range(11):
+        interpreter.execute('into')
+    assert interpreter.getProcessorMode() == "IRQ"
+    interpreter.execute('run')
+    registers = interpreter.getRegisters()
+    # 100 FIQ happened, the last one at cycle 10011 (its handler did not increment R12 yet).
+    # They always happen at the same cycle as an IRQ, which is then ignored
+    assert interpreter.getProcessorMode() == "FIQ"
+    assert registers['FIQ'][12] == 99
+    assert registers['User'][11] == 501 - 100
+    interpreter.removeInterruptSource(fiq)
+    interpreter.setInterrupt("IRQ", True)
+    assert interpreter.getNextEventCycle() is None
+
+
+DEVICES_CODE = """SECTION INTVEC
+B main
+B main
+B main
+B main
+B main
+B main
+B irq
+SECTION CODE
+main
+    LDR R0, =0x10001000
+    LDR R1, =message
+boucle
+    LDRB R2, [R1], #1
+    CMP R2, #0
+    STRNE R2, [R0]
+    BNE boucle
+    LDR R0, =0x10002000
+    LDR R3, [R0, #4]
+    STR R3, [R0]
+    LDR R0, =0x10000000
+    MOV R3, #100
+    STR R3, [R0, #4]
+    MOV R3, #3
+    STR R3, [R0]
+attente
+    ADD R5, R5, #1
+    CMP R4, #3
+    BNE attente
+    MOV R3, #0
+    STR R3, [R0]
+fin B fin
+irq
+    MOV R6, #1
+    STR R6, [R0, #12]
+    ADD R4, R4, #1
+    SUBS PC, LR, #4
+SECTION DATA
+message ASSIGN8 72, 105, 0
+"""
+
+
+def test_devices(monkeypatch):
+    # Count the searches of the sections using each page
+    searched, buildPage = Counter(), Memory._buildPage
+    monkeypatch.setattr(Memory, "_buildPage", lambda mem, number: searched.update([number]) or buildPage(mem, number))
+    states = []
+    for translation in (False, True):
+        interpreter = buildInterpreter(DEVICES_CODE)
+        interpreter.setTranslation(translation)
+        uart = interpreter.addDevice("uart")
+        gpio = interpreter.addDevice("gpio")
+        timer = interpreter.addDevice("timer")
+        gpio.setInputs(0x2A)
+        interpreter.execute('run')
+        assert uart.getOutput() == "Hi"
+        assert gpio.outputs == 0x2A
+        registers = interpreter.getRegisters()['User']
+        # The timer interrupted the loop 3 times, every 100 cycles
+        assert registers[4] == 3 and 90 < registers[5] < 100
+        assert timer.status == 0 and timer.event is None
+        states.append(getState(interpreter))
+    assert states[0] == states[1]
+    # The pages of the devices are never searched
+    assert not any(number >= 0x10000000 >> Memory.pageShift for number in searched)
+
+    # An invalid address is only searched once
+    mem = interpreter.sim.mem
+    for i in range(2):
+        assert not mem.isMapped(0x20000000)
+    assert searched[0x20000000 >> Memory.pageShift] == 1
+
+
+LARGE_MEMORY_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R0, =image
+    LDR R1, =0x300000
+    ADD R1, R1, R0
+    MOV R2, #7
+    STR R2, [R1, #-4]
+    STR R2, [R0]
+    LDR R3, [R1, #-4]
+fin B fin
+SECTION DATA
+image ALLOC8 0x300000
+"""
+
+
+def test_large_memory(monkeypatch):
+    # The default limits suit the web interface, which displays the whole memory
+    monkeypatch.setitem(settings._settings, "maxtotalmem", 0x1000000)
+    monkeypatch.setitem(settings._settings, "maxallocsize", 0x400000)
+    interpreter = buildInterpreter(LARGE_MEMORY_CODE)
+    mem = interpreter.sim.mem
+    for i in range(5):
+        interpreter.execute('into')
+    # The first page of the image becomes read-only
+    mem.setPermissions(mem.startAddr["DATA"], 4, 4)
+    interpreter.execute('into')     # STR R2, [R1, #-4]
+    assert not interpreter.errorsPending
+    interpreter.execute('into')     # STR R2, [R0]
+    errors = list(interpreter.errorsPending)
+    assert errors and "interdit" in errors[0][1]
+    interpreter.execute('into')     # LDR R3, [R1, #-4]
+    assert interpreter.getRegisters()['User'][3] == 7
+    # Only the pages holding the code, the start and the end of the image were allocated
+    lastPage = (mem.endAddr["DATA"] - 4) >> mem.pageShift
+    assert len(mem.pages) == 3 and mem.dirtyPages == {lastPage}
+    assert mem.readRange(mem.endAddr["DATA"] - 5, 5) == b"\xff\x07\x00\x00\x00"
+    # Reading the whole memory does not allocate the other pages
+    assert len(mem.getContext()["DATA"]) == mem.endAddr["DATA"] - mem.startAddr["DATA"]
+    assert len(mem.pages) == 3
+
+
+def test_reset_memory():
+    interpreter = buildInterpreter(LOOP_CODE)
+    initialMemory = interpreter.getMemoryFormatted()
+    interpreter.sim.maxit = 20000
+    interpreter.execute('run')
+    finalMemory = interpreter.getMemoryFormatted()
+    assert finalMemory != initialMemory
+
+    interpreter.reset(resetMemory=True)
+    assert interpreter.getMemoryFormatted() == initialMemory
+    assert not interpreter.sim.mem.dirtyPages
+    interpreter.execute('run')
+    assert interpreter.getMemoryFormatted() == finalMemory
+
+
+def test_clone():
+    interpreter = buildInterpreter(INTERRUPT_CODE)
+    interpreter.setInterrupt("IRQ", False, 10, 20)
+    for i in range(5):
+        interpreter.execute('into')
+    clone = interpreter.clone()
+    assert getState(clone) == getState(interpreter)
+
+    clone.sim.regs[0] = 1000
+    clone.setMemory(clone.sim.mem.startAddr["CODE"], bytearray([0]))
+    assert interpreter.getRegisters()['User'][0] != 1000
+    assert getState(interpreter)[3] != getState(clone)[3]
+
+    # Both copies run the same program, with their own interrupt source
+    interpreter.setMemory(interpreter.sim.mem.startAddr["CODE"], bytearray([0]))
+    interpreter.sim.regs[0] = 1000
+    interpreter.execute('run')
+    clone.execute('run')
+    assert getState(interpreter) == getState(clone)
+    clone.setInterrupt("IRQ", True)
+    assert interpreter.getNextEventCycle() is not None
+
+
+SVC_CODE = """SECTION INTVEC
+B main
+B main
+B svc
+SECTION CODE
+main
+    MOV R0, #1
+    SVC #0
+    ASSERT R0=1
+fin B fin
+svc
+    MOV R0, #2
+    SUB LR, LR, #4
+    MOVS PC, LR
+SECTION DATA
+"""
+
+
+def test_clone_assertions():
+    interpreter = buildInterpreter(SVC_CODE)
+    interpreter.execute('into')     # B main
+    clone = interpreter.clone()
+    # The SVC adds an assertion on its return address, which must not leak to the original
+    for i in range(6):
+        clone.execute('into')
+    assert clone.errorsPending and list(clone.errorsPending)[0][0] == "assert"
+    clone.sim.setBreakpointCondition("register", ("User", 0), "R0 == 3")
+    assert not interpreter.sim.bkptConditions
+
+    errors = []
+    for i in range(6):
+        interpreter.execute('into')
+        if interpreter.errorsPending:
+            errors.extend(interpreter.errorsPending)
+            interpreter.errorsPending = None
+    assert [error[0] for error in errors] == ["assert"]
+
+
+STACK_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR SP, =pile
+    ADD SP, SP, #64
+    MOV R1, #1
+    MOV R2, #2
+    MOV R3, #3
+    PUSH {R1-R3, LR}
+    LDMIA SP, {R4-R7}
+    POP {R1-R3, LR}
+fin B fin
+SECTION DATA
+pile ALLOC32 16
+"""
+
+
+def test_multiple_transfer():
+    interpreter = buildInterpreter(STACK_CODE)
+    mem = interpreter.sim.mem
+    for i in range(7):
+        interpreter.execute('into')
+    sp = interpreter.getRegisters()['User'][13]
+    assert mem.readWords(sp, 4, mayTriggerBkpt=False) == (1, 2, 3, 0)
+    interpreter.execute('into')
+    registers = interpreter.getRegisters()['User']
+    assert [registers[i] for i in range(4, 8)] == [1, 2, 3, 0]
+    interpreter.execute('into')
+    assert interpreter.getRegisters()['User'][13] == sp + 16
+
+    # A single step back restores the 16 bytes written by PUSH
+    interpreter.stepBack(3)
+    assert mem.readWords(sp, 4, mayTriggerBkpt=False) == (0xFFFFFFFF,) * 4
+
+
+def test_memory_history_records():
+    interpreter = buildInterpreter(STACK_CODE)
+    mem, history = interpreter.sim.mem, interpreter.sim.history
+    addr = mem.startAddr["DATA"]
+    initial = mem.readRange(addr, 8)
+    interpreter.getChangesFormatted(setCheckpoint=True)
+    # Overlapping writes in the same cycle, as done by a translated region
+    history.newCycle()
+    mem.set(addr, 0x11223344)
+    mem.set(addr + 2, 0x55, 1)
+    mem.set(addr, 0x66778899)
+    mem.writeWords(addr + 4, [1])
+    assert len(history.history[-1][mem.__class__]) == 3
+    changes = dict(next(c[1] for c in interpreter.getChangesFormatted() if c[0] == "mempartial"))
+    assert [changes[addr+i] for i in range(5)] == ["99", "88", "77", "66", "01"]
+    history.stepBack()
+    assert mem.readRange(addr, 8) == initial
+
+
+def test_changes_from_snapshots():
+    reference = buildInterpreter(LOOP_CODE)
+    interpreter = buildInterpreter(LOOP_CODE)
+    interpreter.setChangesFromSnapshots(True)
+    reference.sim.maxit = interpreter.sim.maxit = 20000
+    for mode in ('into', 'into', 'run'):
+        reference.execute(mode)
+        interpreter.execute(mode)
+        # The snapshots only report the values which changed, the history all the values written
+        changes = interpreter.getChangesFormatted(setCheckpoint=True)
+        expectedChanges = reference.getChangesFormatted(setCheckpoint=True)
+        assert all(change in expectedChanges for change in changes if change[0] != "mempartial")
+    assert ["r1", "00000400"] in changes
+    memoryChanges = next(c[1] for c in changes if c[0] == "mempartial")
+    expectedMemoryChanges = next(c[1] for c in expectedChanges if c[0] == "mempartial")
+    assert memoryChanges and all(change in expectedMemoryChanges for change in memoryChanges)
+
+
+def test_find_last_write():
+    interpreter = buildInterpreter(STACK_CODE)
+    for i in range(10):
+        interpreter.execute('into')
+    sp = interpreter.getRegisters()['User'][13]
+    # LDMIA SP, {R4-R7} (the lines are numbered from 0)
+    assert interpreter.findLastRegisterWrite(4) == {"stepsback": 3, "cycle": 9, "line": 10}
+    assert interpreter.findLastRegisterWrite(9) is None
+    # PUSH {R1-R3, LR}
+    info = interpreter.findLastMemoryWrite(sp - 16)
+    assert info == {"stepsback": 4, "cycle": 8, "line": 9}
+    interpreter.stepBack(info["stepsback"])
+    assert interpreter.getCurrentLine() == 9
+    assert interpreter.findLastMemoryWrite(sp - 16) is None
+    interpreter.execute('into')
+    assert interpreter.findLastMemoryWrite(sp - 16)["stepsback"] == 1
+
+
+def test_conditional_breakpoints():
+    interpreter = buildInterpreter(LOOP_CODE)
+    # BNE boucle
+    interpreter.setBreakpointInstrCondition(18, "R1 = 100")
+    interpreter.execute('run')
+    assert interpreter.getCurrentLine() == 18
+    assert interpreter.getRegisters()['User'][1] == 100
+    interpreter.setBreakpointInstr([])
+
+    # STR R3, [R4, R2, LSL #2] on the second word of tab, 1 + 17 + 33 > 50
+    tab = interpreter.getRegisters()['User'][4]
+    interpreter.setBreakpointMem(tab + 4, 'w', "value > 50 and R1 > 100")
+    interpreter.setBreakpointRegister('user', 5, 'w', "value == 1")
+    interpreter.execute('run')
+    assert interpreter.getCurrentLine() == 11
+    assert interpreter.getRegisters()['User'][1] == 113
+    hits = {(hit["type"], hit["target"]): hit for hit in interpreter.getBreakpointHits()}
+    assert hits[("memory", interpreter.line2addr[18])] == {"type": "memory", "target": interpreter.line2addr[18],
+                                                           "line": 18, "condition": None, "hits": 1}
+    assert hits[("memory", tab + 4)]["hits"] == 1
+    assert ("register", ("User", 5)) not in hits
+
+    with pytest.raises(ConditionSyntaxError):
+        interpreter.setBreakpointMem(tab, 'w', "__import__('os')")
+    # The arithmetic is done on 32 bits, so a condition cannot build a huge integer
+    with pytest.raises(ConditionSyntaxError):
+        interpreter.setBreakpointMem(tab, 'w', "R0 << 0xFFFFFFFF")
+    regs = interpreter.sim.regs
+    regs[0], regs[1] = 0xFFFFFFFF, 0xFFFFFFFF
+    assert BreakpointCondition("R0 << R1 == 0x80000000").check(regs, None)
+    assert BreakpointCondition("R0 * R0 * R0 * R0 == 1").check(regs, None)
+    assert BreakpointCondition("R1 + 1 == 0").check(regs, None)
+    regs[0], regs[1] = 1, 1
+    assert BreakpointCondition("~R0 == 0xFFFFFFFE").check(regs, None)
+    assert BreakpointCondition("-R1 == 0xFFFFFFFF and R1 == -0xFFFFFFFF").check(regs, None)
+    assert BreakpointCondition("not R0 == 0").check(regs, None)
+
+
+PAGE_CROSSING_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    LDR R1, =tab
+    ADD R1, R1, #0x1000
+    LDR R2, =0xFFF
+    BIC R1, R1, R2
+    SUB R1, R1, #4
+    LDMIA R1, {R2-R4}
+    MOV R2, #1
+    MOV R3, #2
+    MOV R4, #3
+    STMIA R1, {R2-R4}
+fin B fin
+SECTION DATA
+tab ALLOC8 0x2000
+"""
+
+
+def test_hooks():
+    interpreter = buildInterpreter(LOOP_CODE)
+    interpreter.sim.maxit = 20000
+    tab = interpreter.sim.mem.startAddr['DATA']
+    executions, branches, writes = Counter(), Counter(), []
+    interpreter.sim.addHook("exec", lambda addr, instr, executed: executions.update([(addr, executed)]))
+    interpreter.sim.addHook("branch", lambda addr, target: branches.update([(addr, target)]))
+    writeHook = interpreter.sim.addHook("memwrite", lambda addr, size, value: writes.append((addr, size, value)), tab, tab + 64)
+    interpreter.execute('run')
+    # BNE boucle
+    bne = interpreter.line2addr[18]
+    assert executions[(bne, True)] == 1023 and executions[(bne, False)] == 1
+    assert branches[(bne, interpreter.line2addr[8])] == 1023
+    assert len(writes) == 1024 and writes[-1] == (tab + 60, 4, interpreter.getRegisters()['User'][3])
+
+    # Without hooks, the methods of the classes are used again
+    interpreter.sim.removeHook(writeHook)
+    assert "set" not in interpreter.sim.mem.__dict__
+
+    # LDM and STM crossing a page boundary are reported once for each word
+    interpreter = buildInterpreter(PAGE_CROSSING_CODE)
+    tab, accesses = interpreter.sim.mem.startAddr['DATA'], []
+    interpreter.sim.addHook("memread", lambda addr, size, value: accesses.append(("r", addr, value)), tab, tab + 0x2000)
+    interpreter.sim.addHook("memwrite", lambda addr, size, value: accesses.append(("w", addr, value)), tab, tab + 0x2000)
+    interpreter.execute('run')
+    boundary = interpreter.getRegisters()['User'][1] + 4
+    assert boundary & 0xFFF == 0
+    # The memory is initialized with 0xFF bytes
+    assert accesses == [("r", boundary - 4, 0xFFFFFFFF), ("r", boundary, 0xFFFFFFFF), ("r", boundary + 4, 0xFFFFFFFF),
+                        ("w", boundary - 4, 1), ("w", boundary, 2), ("w", boundary + 4, 3)]
+
+    interpreter = buildInterpreter(INTERRUPT_CODE)
+    interrupts = []
+    interpreter.sim.addHook("interrupt", lambda addr, type: interrupts.append((addr, type)))
+    interpreter.setInterrupt("IRQ", False, 10, 20)
+    for i in range(11):
+        interpreter.execute('into')
+    assert len(interrupts) == 1 and interrupts[0][1] == "IRQ"
+
+
+def test_profiler():
+    interpreter = buildInterpreter(LOOP_CODE)
+    interpreter.sim.maxit = 20000
+    interpreter.setProfiling(True)
+    clone = interpreter.clone()
+    interpreter.execute('run')
+    profile = interpreter.getProfile()
+    # LDR R3, [R4, R2, LSL #2], STR R3, [R4, R2, LSL #2] and BNE boucle
+    assert profile[9] == {"executions": 1024, "conditionfailed": 0, "memread": 4096, "memwrite": 0}
+    assert profile[11] == {"executions": 1024, "conditionfailed": 0, "memread": 0, "memwrite": 4096}
+    assert profile[18]["conditionfailed"] == 1
+    assert interpreter.getProfile(byLine=False)[interpreter.line2addr[18]] == profile[18]
+
+    # The copy has its own counters
+    assert clone.getProfile() == {}
+    clone.execute('run')
+    assert clone.getProfile() == profile
+
+    interpreter.setProfiling(False, clear=True)
+    assert not interpreter.sim.hasHooks and interpreter.getProfile() == {}
+
+
+# Without any section, the program is in snippet mode
+SNIPPET_CODE = """    MOV R0, #3
+boucle
+    SUBS R0, R0, #1
+    BNE boucle
+"""
+
+
+def test_profiler_snippet():
+    interpreter = buildInterpreter(SNIPPET_CODE)
+    interpreter.setProfiling(True)
+    for i in range(7):
+        interpreter.execute('into')
+    profile = interpreter.getProfile()
+    assert profile[2]["executions"] == 3
+    assert profile[3] == {"executions": 3, "conditionfailed": 1, "memread": 0, "memwrite": 0}
+
+
+COVERAGE_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    MOV R0, #3
+boucle
+    SUBS R0, R0, #1
+    BNE boucle
+    CMP R0, #0
+    BNE erreur
+fin B fin
+erreur
+    MOV R1, #1
+    B fin
+SECTION DATA
+"""
+
+
+def test_coverage():
+    interpreter = buildInterpreter(COVERAGE_CODE)
+    interpreter.setCoverage(True)
+    clone = interpreter.clone()
+    interpreter.execute('run')
+    coverage = interpreter.getCoverage()
+    # The error handler was never executed
+    assert coverage["notexecuted"] == [12, 13]
+    assert coverage["executed"] == [1, 4, 6, 7, 8, 9, 10]
+    assert coverage["branches"] == {7: {"taken": True, "nottaken": True},
+                                    9: {"taken": False, "nottaken": True}}
+
+    # The copy has its own coverage
+    assert clone.getCoverage()["executed"] == []
+    clone.setCoverage(False, clear=True)
+    assert not clone.sim.hasHooks
+    assert interpreter.getCoverage() == coverage
+
+    interpreter = buildInterpreter(SNIPPET_CODE)
+    interpreter.setCoverage(True)
+    for i in range(7):
+        interpreter.execute('into')
+    assert interpreter.getCoverage() == {"executed": [0, 2, 3], "notexecuted": [],
+                                         "branches": {3: {"taken": True, "nottaken": True}}}
+
+
+TIMING_CODE = """SECTION INTVEC
+B main
+SECTION CODE
+main
+    MOV R0, #3
+    LDR R1, =tab
+    LDMIA R1, {R2-R4}
+    STMIA R1, {R2-R4}
+    MUL R5, R0, R0
+    CMP R0, #0
+    BEQ main
+    B fin
+fin B fin
+SECTION DATA
+tab ALLOC32 3
+"""
+
+
+# Rs is also a destination register
+MULTIPLY_CODE = """    MOV R0, #3
+    MOV R1, #0x01000000
+    MUL R0, R1, R0
+    UMULL R2, R1, R0, R1
+"""
+
+
+def test_cycle_timing():
+    interpreter = buildInterpreter(TIMING_CODE)
+    interpreter.setCycleTiming(True)
+    costs = []
+    for i in range(9):
+        cycles = interpreter.getCycleCount()
+        interpreter.execute('into')
+        costs.append(interpreter.getCycleCount() - cycles)
+    # B (2S + 1N), MOV (1S), LDR (1S + 1N + 1I), LDM (3S + 1N + 1I), STM (2S + 2N), MUL (1S + 1I),
+    # CMP (1S), BEQ not taken (1S), B (2S + 1N)
+    assert costs == [3, 1, 3, 5, 4, 2, 1, 1, 3]
+    interpreter.stepBack(2)
+    assert interpreter.getCycleCount() == 1 + sum(costs[:7])
+    assert interpreter.getInstructionCount() == 7
+
+    interpreter.setCycleTiming(False)
+    interpreter.execute('into')
+    assert interpreter.getCycleCount() == 2 + sum(costs[:7])
+
+    # The multiplier operand (Rs) is read before the multiplication writes it: 3 for MUL (S + 1I), then
+    # 0x01000000 for UMULL (S + 4I + 1I)
+    interpreter = buildInterpreter(MULTIPLY_CODE)
+    interpreter.setCycleTiming(True)
+    costs = []
+    for i in range(4):
+        cycles = interpreter.getCycleCount()
+        interpreter.execute('into')
+        costs.append(interpreter.getCycleCount() - cycles)
+    assert costs == [1, 1, 2, 6]
+
+    # The maximum number of iterations in run mode is a number of instructions
+    interpreter = buildInterpreter(LOOP_CODE)
+    interpreter.setCycleTiming(True)
+    interpreter.sim.maxit = 100
+    interpreter.execute('run')
+    assert interpreter.getInstructionCount() == 100
+    assert interpreter.getCycleCount() > 101
+
+
+def test_cache_simulation():
+    reference = buildInterpreter(LOOP_CODE)
+    interpreter = buildInterpreter(LOOP_CODE)
+    # The 64 bytes of tab do not fit in the data cache (2 sets of 2 lines of 8 bytes)
+    interpreter.setCacheSimulation(icache={'size': 256, 'linesize': 16},
+                                   dcache={'size': 32, 'linesize': 8, 'ways': 2, 'replacement': "LRU"},
+                                   missPenalty=10)
+    for interp in (reference, interpreter):
+        interp.sim.maxit = 100000
+        # SUB R8, PC, #4, after the loop
+        interp.setBreakpointInstr([19])
+        interp.execute('run')
+        assert interp.getCurrentLine() == 19
+    stats = interpreter.getCacheStats()
+    # LDR R3, [R4, R2, LSL #2] misses on the first word of each line, then STR R3, [R4, R2, LSL #2] hits.
+    # The first misses fill the empty entries of the cache (one of them holds the address of tab)
+    assert stats['dcache']['lines'][9] == (512, 512, 509)
+    assert stats['dcache']['lines'][11] == (1024, 0, 0)
+    assert stats['dcache']['writebacks'] == 508
+    # The loop fits in the instruction cache
+    assert stats['icache']['lines'][9] == (1023, 1, 0)
+    transfers = stats['icache']['misses'] + stats['dcache']['misses'] + stats['dcache']['writebacks']
+    assert interpreter.getCycleCount() == reference.getCycleCount() + 10 * transfers
+
+    with pytest.raises(ValueError):
+        interpreter.setCacheSimulation(dcache={'size': 48})
+
+    # The 3 instructions of the snippet fit in a single line
+    interpreter = buildInterpreter(SNIPPET_CODE)
+    interpreter.setCacheSimulation(icache={'size': 64, 'linesize': 16})
+    for i in range(7):
+        interpreter.execute('into')
+    assert interpreter.getCacheStats()['icache']['lines'] == {0: (0, 1, 0), 2: (3, 0, 0), 3: (3, 0, 0)}
+
+
+def test_trace(tmp_path):
+    interpreter = buildInterpreter(TIMING_CODE)
+    path = str(tmp_path / "trace.bin")
+    interpreter.startTrace(capacity=64, path=path)
+    for i in range(9):
+        interpreter.execute('into')
+    # The trace can be read while it is recorded: the instructions, and the writes of MOV, LDR,
+    # LDM, STM, MUL and CMP
+    assert len(list(readTrace(path))) == 9 + 1 + 1 + 3 + 3 + 1 + 1
+    interpreter.stopTrace()
+    out = io.StringIO()
+    interpreter.exportTrace(out)
+    instructions = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [instr["addr"] for instr in instructions] == [0] + [interpreter.line2addr[line] for line in range(4, 12)]
+    tab = interpreter.getRegisters()['User'][1]
+    # STMIA R1, {R2-R4}
+    assert instructions[4]["mem"] == [{"addr": tab + 4*i, "size": 4, "value": 0xFFFFFFFF} for i in range(3)]
+    # MUL R5, R0, R0 and BEQ main
+    assert instructions[5]["regs"] == [{"bank": "User", "reg": 5, "value": 9}]
+    assert instructions[6]["regs"] == [{"bank": "User", "reg": "CPSR", "value": 0x20000010}]
+    assert not instructions[7]["executed"]
+
+    out = io.StringIO()
+    interpreter.exportTrace(out, format="chrome")
+    events = json.loads(out.getvalue())
+    assert len(events) == 9 and events[1]["name"] == "Ligne 5"
+
+    # The writes done when entering an interrupt are recorded with it, not with the next instruction
+    interpreter = buildInterpreter(INTERRUPT_CODE)
+    interpreter.setInterrupt("IRQ", False, 4, 100)
+    interpreter.startTrace(capacity=64)
+    for i in range(6):
+        interpreter.execute('into')
+    out = io.StringIO()
+    interpreter.exportTrace(out)
+    entries = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert entries[4]["interrupt"] == "IRQ" and entries[4]["addr"] == interpreter.line2addr[12]
+    assert [(write["reg"], write["value"]) for write in entries[4]["regs"]] == [("CPSR", 0x12), ("SPSR", 0x10), ("CPSR", 0x92),
+                                                                                 (14, interpreter.line2addr[12] + 4)]
+    assert entries[5]["addr"] == 0x18 and entries[5]["regs"] == []
+
+
+class FaultyBackend(InterpreterBackend):
+    """
+    Flip a bit of R7 after "ADD R1, R1, #1" when R1 reaches 500 (the fault only depends on the
+    state, so it also happens in the copies made by the bisection).
+    """
+    def run(self, count):
+        regs = self.interpreter.sim.regs.banks['User']
+        for i in range(count):
+            super().run(1)
+            if regs[15].val - self.interpreter.sim.pcoffset == self.interpreter.line2addr[17] and regs[1].val == 500:
+                regs[7].val ^= 1
+
+    def clone(self):
+        return FaultyBackend(self.interpreter.clone())
+
+
+def test_lockstep():
+    reference = buildInterpreter(LOOP_CODE)
+    reference.setTranslation(False)
+    translated = buildInterpreter(LOOP_CODE)
+    translated.setTranslation(True)
+    checker = LockstepChecker(reference, translated, interval=1000)
+    assert checker.run(12000) is None
+    assert checker.executed == 12000
+
+    checker = LockstepChecker(buildInterpreter(LOOP_CODE), FaultyBackend(buildInterpreter(LOOP_CODE)), interval=1000)
+    divergence = checker.run(8000)
+    # B main, 3 instructions before the loop, 499 iterations of 11 instructions, then the 9th one of the loop
+    assert divergence.index == 4 + 499 * 11 + 9
+    assert divergence.line == 16
+    assert [d[0] for d in divergence.differences] == ["R7"]
+    assert divergence.differences[0][1] ^ divergence.differences[0][2] == 1
+
+
+def test_lockstep_translation(monkeypatch):
+    # Broken translation of "EOR R7, R7, R6", when R1 is 460
+    translateDataOp = _RegionBuilder._translateDataOp
+    def brokenDataOp(self, info, addr):
+        code = translateDataOp(self, info, addr)
+        return code + ["if r1 == 460: r7 ^= 1"] if info.opcode == "EOR" else code
+    monkeypatch.setattr(_RegionBuilder, "_translateDataOp", brokenDataOp)
+
+    reference = buildInterpreter(LOOP_CODE)
+    reference.setTranslation(False)
+    translated = buildInterpreter(LOOP_CODE)
+    translated.setTranslation(True)
+    divergence = LockstepChecker(reference, translated, interval=1000).run(8000)
+    # The copies used by the bisection keep the translated regions, so the fault happens again. The
+    # loop body is translated as a single block, the divergence is found at its end: B main,
+    # 3 instructions before the loop, then 461 iterations (BNE boucle)
+    assert divergence.index == 4 + 461 * 11
+    assert divergence.line == 18
+    assert [d[0] for d in divergence.differences] == ["R7"]
+
+
+def test_fuzzer(tmp_path, monkeypatch):
+    assert fuzzer.fuzz(20, length=30) == []
+    # The programs may execute more instructions than the default length of the history
+    assert fuzzer.fuzz(2, length=150) == []
+    # The cases are reproducible
+    assert fuzzer.FuzzCase.fromSeed(5).source() == fuzzer.FuzzCase.fromSeed(5).source()
+
+    def brokenSwap(self, *args, **kwargs):
+        raise KeyError("SWP")
+    monkeypatch.setattr(SwapOp, "execute", brokenSwap)
+    failures = fuzzer.fuzz(2, firstSeed=2, length=40, corpus=str(tmp_path))
+    assert len(failures) == 1
+    case, failure = failures[0]
+    # Shrunk to the swap alone
+    assert failure[0] == "crash"
+    assert [line.split()[0][:3] for line in case.body] == ["SWP"]
+    assert len(fuzzer.replayCorpus(str(tmp_path))) == 1
+
+    monkeypatch.undo()
+    assert fuzzer.replayCorpus(str(tmp_path)) == {}
+
+    # Broken translation of ADD, found in the loops
+    translateDataOp = _RegionBuilder._translateDataOp
+    def brokenDataOp(self, info, addr):
+        code = translateDataOp(self, info, addr)
+        return [line.replace("res = x + y", "res = 1 + x + y") for line in code] if info.opcode == "ADD" else code
+    monkeypatch.setattr(_RegionBuilder, "_translateDataOp", brokenDataOp)
+    failures = fuzzer.fuzz(1, firstSeed=11, length=30)
+    assert len(failures) == 1
+    case, failure = failures[0]
+    assert failure[0] == "divergence"
+    assert [line.split()[0] for line in case.body] == ["MOV", "boucle17", "ADDGT", "SUBS", "BNE"]
+
+
+def test_metrics():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests")
+    requests.inc(type="run")
+    requests.inc(3, type="run")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    for val in (0.05, 0.5, 2):
+        latency.observe(val)
+    registry.gauge("sessions", "Sessions", lambda: {(("stat", "max"),): 2})
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests", "# TYPE requests_total counter", 'requests_total{type="run"} 4',
+        "# HELP latency_seconds Latency", "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1', 'latency_seconds_bucket{le="1"} 2', 'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 2.55", "latency_seconds_count 3",
+        "# HELP sessions Sessions", "# TYPE sessions gauge", 'sessions{stat="max"} 2']
+
+    # Rate of a counter between two renderings
+    now = [100.0]
+    rate = Registry().rate("requests_per_second", "Rate", requests, clock=lambda: now[0])
+    requests.inc(6, type="stop")
+    now[0] = 102.0
+    assert list(rate.samples()) == [("", (), 3.0)]
+    requests.inc(5, type="run")
+    now[0] = 107.0
+    assert list(rate.samples()) == [("", (), 1.0)]
+    now[0] = 108.0
+    assert list(rate.samples()) == [("", (), 0.0)]
+
+    interpreter = buildInterpreter(LOOP_CODE)
+    assert interpreter.getMemoryEstimate() == 0
+    interpreter.sim.maxit = 1000
+    interpreter.execute('run')
+    # The loop writes in the data page, and the history records its changes
+    assert interpreter.getMemoryEstimate() > 4096